@@ -25,6 +25,14 @@ def int2bytes4(n, pack=struct.pack):
     '''将整数转换为大端序字节'''
     return pack('>I', n)
 
+def ip2int6(ip, unpack=struct.unpack, inet_pton=socket.inet_pton):
+    '''将 IPv6 地址的前 64 位转换为整数'''
+    return unpack('>Q', inet_pton(socket.AF_INET6, ip)[:8])[0]
+
+def int2bytes8(n, pack=struct.pack):
+    '''将整数转换为大端序字节'''
+    return pack('>Q', n)
+
 Url_APNIC = 'https://ftp.apnic.net/apnic/stats/apnic/delegated-apnic-latest'
 Url_17MON = 'https://raw.githubusercontent.com/17mon/china_ip_list/master/china_ip_list.txt'
 Url_GAOYIFAN = 'https://raw.githubusercontent.com/gaoyifan/china-operator-ip/ip-lists/china.txt'
@@ -53,24 +61,65 @@ keeprange = (
       #'224.0.0.0/4',  #组播地址（D类）
       #'240.0.0.0/4',  #保留地址（E类）
     )
+# https://www.iana.org/assignments/iana-ipv6-special-registry/iana-ipv6-special-registry.xhtml
+#只保存地址的前 64 位，更长的前缀会扩展为 /64
+keeprange6 = (
+            '::/127',  #未指定地址、环回地址，IPv4 映射地址按 IPv4 查询
+          '100::/64',  #丢弃前缀
+     '2001:db8::/32',  #文档地址
+         'fc00::/7',   #唯一本地地址
+         'fe80::/10',  #链路本地
+         'fec0::/10',  #站点本地（已弃用）
+      #连续地址直到 IP 结束，特殊处理
+      #'ff00::/8',    #组播地址
+    )
 keeplist = []
 for iprange in keeprange:
     ip, mask = iprange.split('/')
     keeplist.append((ip2int(ip), 32 - int(mask)))
+keeplist6 = []
+for iprange in keeprange6:
+    ip, mask = iprange.split('/')
+    keeplist6.append((ip2int6(ip), max(64 - int(mask), 0)))
 update = None
 
-def save_iplist_as_db(ipdb, iplist, padding=b'\xff\xff'):
+def merge_iplist(iplist):
+    '''合并排序后的 IP 段，生成连续的范围'''
+    lastip_s = 0
+    lastip_e = 0
+    for ip, mask in iplist:
+        ip_s = ip >> mask << mask
+        ip_e = (ip >> mask) + 1 << mask
+        #判断连续
+        if ip_s <= lastip_e:
+            #判断覆盖
+            if ip_e > lastip_e:
+                lastip_e = ip_e
+            continue
+        #排除初始值
+        if lastip_e:
+            yield lastip_s, lastip_e
+        lastip_s = ip_s
+        lastip_e = ip_e
+    #添加最后一段范围
+    yield lastip_s, lastip_e
+
+def save_iplist_as_db(ipdb, iplist, iplist6=[], padding=b'\xff\xff'):
     #    +---------+
     #    | 4 bytes |                     <- data length
     #    +---------------+
     #    | 224 * 4 bytes |               <- first ip number index
     #    +---------------+
     #    |  2n * 4 bytes |               <- cn ip ranges data
+    #    +---------------------+
+    #    | b'IPv6' and 4 bytes |         <- IPv6 data length
+    #    +---------------------+
+    #    | 65537 * 4 bytes |             <- first 16 bits index
+    #    +-----------------+
+    #    |  2m * 8 bytes |               <- cn ip ranges data
     #    +------------------------+
     #    | b'end' and update info |      <- end verify
     #    +------------------------+
-    lastip_s = 0
-    lastip_e = 0
     index = {}
     index_n = 0
     index_fip = -1
@@ -81,58 +130,67 @@ def save_iplist_as_db(ipdb, iplist, padding=b'\xff\xff'):
     #随便算一下
     buffering = len(iplist) * 8 + 224 * 4 + 64 + 4
     buffer = bytearray(buffering)
-    for ip, mask in iplist:
-        ip_s = ip >> mask << mask
-        ip_e = (ip >> mask) + 1 << mask
-        #判断连续
-        if ip_s <= lastip_e:
-            #判断覆盖
-            if ip_e > lastip_e:
-                lastip_e = ip_e
-            continue
-        #排除初始值
-        if lastip_e:
-            #一段范围分为包含和排除
-            buffer[offset:] = lastip_s = int2bytes4(lastip_s)
-            buffer[offset + 4:] = int2bytes4(lastip_e)
-            #一个索引分为开始和结束
-            fip = lastip_s[0] * 2
-            if fip != index_fip:
-                #前一个索引结束，序数多 1
-                #避免无法搜索从当前索引结尾地址到下个索引开始地址
-                index[index_fip + 1] = index_b = int2bytes2(index_n)
-                #当前索引开始
-                index[fip] = index_b
-                index_fip = fip
-            index_n += 2
-            offset += 8
-        lastip_s = ip_s
-        lastip_e = ip_e
-    #添加最后一段范围
-    buffer[offset:] = lastip_s = int2bytes4(lastip_s)
-    buffer[offset + 4:] = int2bytes4(lastip_e)
-    fip = lastip_s[0] * 2
-    if fip != index_fip:
-        index[index_fip + 1] = index_b = int2bytes2(index_n)
-        index[fip] = index_b
-    index_n += 2
-    offset += 8
+    for ip_s, ip_e in merge_iplist(iplist):
+        #一段范围分为包含和排除
+        buffer[offset:] = ip_s = int2bytes4(ip_s)
+        buffer[offset + 4:] = int2bytes4(ip_e)
+        #一个索引分为开始和结束
+        fip = ip_s[0] * 2
+        if fip != index_fip:
+            #前一个索引结束，序数多 1
+            #避免无法搜索从当前索引结尾地址到下个索引开始地址
+            index[index_fip + 1] = index_b = int2bytes2(index_n)
+            #当前索引开始
+            index[fip] = index_b
+            index_fip = fip
+        index_n += 2
+        offset += 8
     #添加最后一个结束索引
     index[fip + 1] = int2bytes2(index_n)
+    #IPv6 范围
+    iplist6 = iplist6 + keeplist6
+    iplist6.sort(key=lambda x: x[0])
+    buffer6 = bytearray(len(iplist6) * 16)
+    index6 = bytearray(65537 * 4)
+    index6_n = 0
+    index6_fip = 0
+    offset6 = 0
+    for ip_s, ip_e in merge_iplist(iplist6):
+        buffer6[offset6:] = int2bytes8(ip_s)
+        buffer6[offset6 + 8:] = int2bytes8(ip_e)
+        #索引保存每个前 16 位之前的范围边界数量，跨越多个前 16 位的范围也能正确查找
+        for ip in (ip_s, ip_e):
+            fip = ip >> 48
+            while index6_fip <= fip:
+                index6[index6_fip * 4:index6_fip * 4 + 4] = int2bytes4(index6_n)
+                index6_fip += 1
+            index6_n += 1
+        offset6 += 16
+    while index6_fip <= 65536:
+        index6[index6_fip * 4:index6_fip * 4 + 4] = int2bytes4(index6_n)
+        index6_fip += 1
     #写入文件
     fd = open(ipdb, 'wb', buffering)
     fd.write(int2bytes4(offset))
     for i in range(224 * 2):
         fd.write(index.get(i, padding))
     fd.write(buffer[:offset])
+    fd.write(b'IPv6')
+    fd.write(int2bytes4(offset6))
+    fd.write(index6)
+    fd.write(buffer6[:offset6])
     fd.write(b'endCN IP from ')
     fd.write(update.encode('ascii'))
     fd.write(b', range count: ')
     count = str(index_n // 2)
     fd.write(count.encode('ascii'))
+    fd.write(b', IPv6 range count: ')
+    count6 = str(index6_n // 2)
+    fd.write(count6.encode('ascii'))
     fd.close()
     logger.debug('更新信息：%s' % update)
     logger.debug('包含 IP 范围条目数：%s' % count)
+    logger.debug('包含 IPv6 范围条目数：%s' % count6)
     logger.debug('保存地址：%s' % ipdb)
 
 def parse_apnic_iplist(fd, ds):
@@ -147,11 +205,12 @@ def parse_apnic_iplist(fd, ds):
             if linesp[2] == 'ipv4' and (linesp[1] == 'CN' or ds.check(linesp[1])):
                 ds.itemlist.append((ip2int(linesp[3]), mask_dict[linesp[4]]))
                 ll = 0
+            elif linesp[2] == 'ipv6' and (linesp[1] == 'CN' or ds.check(linesp[1])):
+                #IPv6 记录的数值是前缀长度
+                ds.itemlist6.append((ip2int6(linesp[3]), max(64 - int(linesp[4]), 0)))
+                ll = 0
             elif linesp[0] == '2' and not ds.update:
                 ds.update = '%s/%s' % (linesp[2], linesp[5])
-            elif linesp[2] == 'ipv6':
-                #不需要 IPv6 数据，提前结束
-                return None, None
     except Exception as e:
         logger.warning('parse_apnic_iplist 解析出错：%s', e)
     return read, ll
@@ -165,11 +224,11 @@ def parse_cidr_iplist(fd, ds):
             if line[:1] in b'#;':
                 continue
             if b'/' in line:
-                if b':' in line:
-                    #不需要 IPv6 数据，提前结束
-                    return None, None
                 ip, mask = line.decode().strip('\r\n').split('/')
-                ds.itemlist.append((ip2int(ip), 32 - int(mask)))
+                if ':' in ip:
+                    ds.itemlist6.append((ip2int6(ip), max(64 - int(mask), 0)))
+                else:
+                    ds.itemlist.append((ip2int(ip), 32 - int(mask)))
                 ll = 0
     except Exception as e:
         logger.warning('parse_cidr_iplist 解析出错：%s', e)
@@ -183,11 +242,13 @@ def download_cniplist_as_db(ipdb, p=1):
         return msg
     downloading = True
     iplist = []
+    iplist6 = []
     _update = []
 
     def add(ds):
         download_as_list(ds)
         iplist.extend(ds.itemlist)
+        iplist6.extend(ds.itemlist6)
         _update.append(ds.update)
 
     try:
@@ -196,7 +257,7 @@ def download_cniplist_as_db(ipdb, p=1):
                 add(ds)
 
         update = ' and '.join(_update)
-        save_iplist_as_db(ipdb, iplist)
+        save_iplist_as_db(ipdb, iplist, iplist6)
         logger.info('直连 IP 库已保存完毕')
     except Exception as e:
         logger.warning('更新直连 IP 库 %r 失败：%s', ipdb, e)
@@ -134,6 +134,7 @@ class DataSource:
         self.req = None
         self.update = None
         self.itemlist = []
+        self.itemlist6 = []
 
     def __getattr__(self, name):
         return getattr(self._cconfig, name)
@@ -159,6 +160,7 @@ class DataSource:
 
     def clear_data(self):
         self.itemlist.clear()
+        self.itemlist6.clear()
         for child_ds in self.get_children():
             child_ds.clear_data()
 
@@ -343,6 +345,7 @@ def download_as_list(ds):
     else:
         ds.update = time.strftime(ds.datefmt, time.localtime(time.time()))
     ds.itemlist.clear()
+    ds.itemlist6.clear()
     read = 0
     fd, l = download(ds.req)
     while True:
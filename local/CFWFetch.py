@@ -8,7 +8,7 @@ import math
 import random
 import logging
 import threading
-from time import sleep, mtime
+from time import sleep
 from io import BytesIO
 from gzip import GzipFile, _PaddedFile
 from collections import deque
@@ -119,7 +119,7 @@ def fetch_server_version():
             if noerror and response:
                 response.close()
                 if GC.CFW_KEEPALIVE:
-                    http_cfw.ssl_connection_cache[worker_params.connection_cache_key].append((mtime(), response.sock))
+                    http_cfw.ssl_connection_cache.checkin(worker_params.connection_cache_key, response.sock)
                 else:
                     response.sock.close()
     if errors:
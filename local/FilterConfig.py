@@ -68,6 +68,135 @@ elif GC.LINK_PROFILE == 'ipv6':
     pickip = lambda str: [ip.strip() for ip in str.split('|') if isipv6(ip.strip())]
     isipuse = isipv6
 
+class FilterMatcher:
+    #将全部主机规则编译为查找结构，一次查找返回所有匹配规则的序号
+    # exact/suffix 规则使用倒序域名标签树，^ 前缀规则使用字符前缀树
+    # $ 后缀规则使用倒序字符树，@ 正则和包含规则每个分组合并为一个正则预筛选
+    _self = object()
+    _sub = object()
+    _end = object()
+    _hasbackref = re.compile(r'\\\d|\(\?P=').search
+
+    def __init__(self, config):
+        self.labels = {}
+        self.prefixes = {}
+        self.suffixes = {}
+        self.trees = []
+        self.sections = []
+        #序号对应的规则：分组动作，协议，路径，目标
+        self.rules = rules = []
+        for filters in config:
+            others = []
+            patterns = []
+            for schemefilter, hostfilter, pathfilter, target in filters:
+                index = len(rules)
+                rules.append((filters.action, schemefilter, pathfilter, target))
+                if isinstance(hostfilter, DomainsTree):
+                    self.trees.append((index, hostfilter))
+                    continue
+                if not isinstance(hostfilter, str):
+                    regex = getattr(hostfilter, '__self__', None)
+                    if isinstance(regex, re.Pattern) and \
+                            not (regex.groups and self._hasbackref(regex.pattern)):
+                        patterns.append('(?:%s)' % regex.pattern)
+                    else:
+                        #无法合并的规则每次都进行匹配
+                        patterns = None
+                    others.append((index, hostfilter))
+                    continue
+                kind, value = self.classify(hostfilter)
+                if kind == 'self' or kind == 'sub':
+                    node = self.labels
+                    for label in reversed(value.split('.')):
+                        node = node.setdefault(label, {})
+                    node.setdefault(self._self if kind == 'self' else self._sub, []).append(index)
+                elif kind == 'prefix':
+                    self._add_chars(self.prefixes, value, index)
+                elif kind == 'suffix':
+                    self._add_chars(self.suffixes, value[::-1], index)
+                else:
+                    if patterns is not None:
+                        patterns.append(re.escape(value))
+                    others.append((index, partial(self._contains, value)))
+            if others:
+                search = None
+                if patterns:
+                    try:
+                        search = re.compile('|'.join(patterns)).search
+                    except re.error:
+                        pass
+                self.sections.append((search, others))
+
+    @staticmethod
+    def _contains(value, host):
+        return value in host
+
+    @classmethod
+    def _add_chars(cls, node, value, index):
+        for char in value:
+            node = node.setdefault(char, {})
+        node.setdefault(cls._end, []).append(index)
+
+    @staticmethod
+    def classify(filter):
+        #与 FilterUtil.match_host_filter 的匹配方式保持一致
+        if filter:
+            if filter[0] == '^':
+                if filter[-1] == '$':
+                    return 'self', filter[1:-1]
+                return 'prefix', filter[1:]
+            if filter[-1] == '$':
+                return 'suffix', filter[:-1]
+            if '.' in filter:
+                if filter[-1] != '.':
+                    if filter[0] == '.':
+                        return 'sub', filter[1:]
+                    return 'self', filter
+                if filter[0] != '.':
+                    return 'prefix', filter
+        return 'contains', filter
+
+    def _match_chars(self, node, chars, result):
+        end = self._end
+        if end in node:
+            result.extend(node[end])
+        for char in chars:
+            node = node.get(char)
+            if node is None:
+                break
+            if end in node:
+                result.extend(node[end])
+
+    def match(self, host):
+        result = []
+        node = self.labels
+        labels = host.split('.')
+        n = len(labels)
+        for label in reversed(labels):
+            node = node.get(label)
+            if node is None:
+                break
+            n -= 1
+            if n:
+                if self._sub in node:
+                    result.extend(node[self._sub])
+            elif self._self in node:
+                result.extend(node[self._self])
+        if self.prefixes:
+            self._match_chars(self.prefixes, host, result)
+        if self.suffixes:
+            self._match_chars(self.suffixes, reversed(host), result)
+        for index, tree in self.trees:
+            if host in tree:
+                result.append(index)
+        for search, others in self.sections:
+            if search is None or search(host):
+                for index, hostfilter in others:
+                    if hostfilter(host):
+                        result.append(index)
+        result.sort()
+        return result
+
 class ACTION_FILTERS:
 
     CONFIG_FILENAME = os.path.join(config_dir, 'ActionFilter.ini')
@@ -75,11 +204,40 @@ class ACTION_FILTERS:
     CONFIG._optcre = re.compile(r'(?P<option>[^\s]+)(?P<vi>\s+=)?\s*(?P<value>.*)')
 
     def __init__(self):
+        #已解析的规则分组和列表文件，重新加载时复用未修改的部分
+        self.sections = {}
+        self.lists = {}
+        self.config = []
         self.readconfig()
         self.mtime = os.path.getmtime(self.CONFIG_FILENAME)
         self.reset = False
         start_new_thread(self.check_modify, ())
 
+    @staticmethod
+    def list_stat(file):
+        try:
+            stat = os.stat(file)
+        except OSError:
+            return
+        return stat.st_mtime_ns, stat.st_size
+
+    def load_list(self, file, lists):
+        #列表文件未修改时复用已载入的域名树
+        stat = self.list_stat(file)
+        for _lists in (lists, self.lists):
+            try:
+                _stat, host = _lists[file]
+            except KeyError:
+                continue
+            if _stat == stat:
+                lists[file] = stat, host
+                return host
+        host = DomainsTree(os.path.basename(file))
+        host.add_file(file, GC.MISC_DOMAINSCACHE)
+        host.freeze()
+        lists[file] = stat, host
+        return host
+
     def readconfig(self):
         self.CONFIG.read(self.CONFIG_FILENAME)
 
@@ -91,100 +249,136 @@ class ACTION_FILTERS:
             except:
                 continue
         order_sections.sort(key=lambda x: x[0])
-        self.config = []
+        config = []
+        sections = {}
+        lists = {}
         for order, action, proxy, section in order_sections:
             action = action.upper()
             if action not in actToNum:
                 continue
-            filters = classlist()
-            filters.action = actToNum[action]
-            for k, v in self.CONFIG._sections[section].items():
-                scheme = ''
-                if k.startswith('list@'):
-                    file = k[5:]
-                    if file.startswith('file://'):
-                        file = file[7:].lstrip('/')
-                    else:
-                        file = os.path.join(data_dir, file)
-                    if not os.path.exists(file):
-                        file += '.txt'
-                    if os.path.exists(file):
-                        host = DomainsTree(os.path.basename(file))
-                        host.add_file(file)
-                    else:
-                        logging.warning('没有找到列表文件 %r !', k[5:])
-                        continue
-                    path = ''
+            items = tuple(self.CONFIG._sections[section].items())
+            #分组内容和引用的列表文件都未修改时复用上次的解析结果
+            try:
+                _items, files, filters = self.sections[section]
+            except KeyError:
+                filters = None
+            else:
+                if _items != items or any(self.list_stat(file) != stat for file, stat in files):
+                    filters = None
                 else:
-                    if k.find('://', 0, 9) > 0 :
-                        scheme, _, k = k.partition('://')
-                    host, _, path = k.partition('/')
-                    if host[:1] == '@':
-                        host = re.compile(host[1:]).search
-                    else:
-                        host = host.lower()
-                    if path[:1] == '@':
-                        path = re.compile(path[1:]).search
-                v = v.rstrip()
-                if action == 'PROXY':
-                    if proxy and not v:
-                        v = proxy
-                elif action in ['FAKECERT', 'CFW']:
-                    if not v:
-                        v = None
-                elif action in ['BLOCK', 'GAE']:
+                    for file, _ in files:
+                        lists[file] = self.lists[file]
+            if filters is None:
+                filters, files = self.parse_section(action, proxy, items, lists)
+            sections[section] = items, files, filters
+            config.append(filters)
+        self.matcher = FilterMatcher(config)
+        self.config = config
+        self.sections = sections
+        self.lists = lists
+
+        self.CONFIG._sections.clear()
+        self.CONFIG._proxies.clear()
+
+    @staticmethod
+    def diff_config(old, new):
+        #比较新旧规则，返回被删除和新增的分组
+        #保留分组的相对顺序改变时，匹配结果可能改变，返回 None 表示需要全部重置
+        news = set(map(id, new))
+        olds = set(map(id, old))
+        if [id(f) for f in old if id(f) in news] != [id(f) for f in new if id(f) in olds]:
+            return
+        return [f for f in old if id(f) not in news] + \
+               [f for f in new if id(f) not in olds]
+
+    def parse_section(self, action, proxy, items, lists):
+        filters = classlist()
+        filters.action = actToNum[action]
+        files = []
+        for k, v in items:
+            scheme = ''
+            if k.startswith('list@'):
+                file = k[5:]
+                if file.startswith('file://'):
+                    file = file[7:].lstrip('/')
+                else:
+                    file = os.path.join(data_dir, file)
+                if not os.path.exists(file):
+                    file += '.txt'
+                if os.path.exists(file):
+                    host = self.load_list(file, lists)
+                    files.append((file, lists[file][0]))
+                else:
+                    logging.warning('没有找到列表文件 %r !', k[5:])
+                    continue
+                path = ''
+            else:
+                if k.find('://', 0, 9) > 0 :
+                    scheme, _, k = k.partition('://')
+                host, _, path = k.partition('/')
+                if host[:1] == '@':
+                    host = re.compile(host[1:]).search
+                else:
+                    host = host.lower()
+                if path[:1] == '@':
+                    path = re.compile(path[1:]).search
+            v = v.rstrip()
+            if action == 'PROXY':
+                if proxy and not v:
+                    v = proxy
+            elif action in ['FAKECERT', 'CFW']:
+                if not v:
                     v = None
-                elif action in ['FORWARD', 'DIRECT']:
-                    if v[:1] == '@':
-                        p, _, v = v.partition(' ')
-                    else:
-                        p = None
-                    if isempty(v):
-                        v = None
-                    elif '|' in v:
-                        v = pickip(v.lower()) or None
-                    elif isipuse(v):
-                        v = [v]
-                    elif isip(v) or not (v in GC.IPLIST_MAP or v.find('.') > 0):
-                        v = None
-                    v = v, p
-                elif action in ['REDIRECT', 'IREDIRECT']:
-                    if v[:1] == '!':
-                        v = v[1:].lstrip()
-                        mhost = False
-                    else:
-                        mhost = True
-                    if '>>' in v:
-                        patterns, _, replaces = v.partition('>>')
-                        patterns = patterns.rstrip()
-                        replaces = replaces.lstrip()
-                        if ' ' in replaces:
-                            raction, _, replaces = replaces.partition(' ')
-                            if raction in ('forward', 'direct', 'gae'):
-                                raction = 'do_' + raction.upper()
-                            elif raction.startswith('proxy='):
-                                raction = 'do_PROXY', raction[6:]
-                            else:
-                                raction = None
-                            replaces = replaces.rstrip()
+            elif action in ['BLOCK', 'GAE']:
+                v = None
+            elif action in ['FORWARD', 'DIRECT']:
+                if v[:1] == '@':
+                    p, _, v = v.partition(' ')
+                else:
+                    p = None
+                if isempty(v):
+                    v = None
+                elif '|' in v:
+                    v = pickip(v.lower()) or None
+                elif isipuse(v):
+                    v = [v]
+                elif isip(v) or not (v in GC.IPLIST_MAP or v.find('.') > 0):
+                    v = None
+                v = v, p
+            elif action in ['REDIRECT', 'IREDIRECT']:
+                if v[:1] == '!':
+                    v = v[1:].lstrip()
+                    mhost = False
+                else:
+                    mhost = True
+                if '>>' in v:
+                    patterns, _, replaces = v.partition('>>')
+                    patterns = patterns.rstrip()
+                    replaces = replaces.lstrip()
+                    if ' ' in replaces:
+                        raction, _, replaces = replaces.partition(' ')
+                        if raction in ('forward', 'direct', 'gae'):
+                            raction = 'do_' + raction.upper()
+                        elif raction.startswith('proxy='):
+                            raction = 'do_PROXY', raction[6:]
                         else:
                             raction = None
-                        unquote = replaces[:1] == '@'
-                        if unquote:
-                            replaces = replaces[1:].lstrip()
-                        if patterns[:1] == '@':
-                            patterns = patterns[1:].lstrip()
-                            rule = partial(re.compile(patterns).sub, replaces)
-                        else:
-                            rule = patterns, replaces, 1
-                        v = rule, unquote, mhost, raction
+                        replaces = replaces.rstrip()
                     else:
-                        v = v, None, mhost, None
-                filters.append((scheme.lower(), host, path, v))
-            self.config.append(filters)
-
-        self.CONFIG._sections.clear()
-        self.CONFIG._proxies.clear()
+                        raction = None
+                    unquote = replaces[:1] == '@'
+                    if unquote:
+                        replaces = replaces[1:].lstrip()
+                    if patterns[:1] == '@':
+                        patterns = patterns[1:].lstrip()
+                        rule = partial(re.compile(patterns).sub, replaces)
+                    else:
+                        rule = patterns, replaces, 1
+                    v = rule, unquote, mhost, raction
+                else:
+                    v = v, None, mhost, None
+            filters.append((scheme.lower(), host, path, v))
+        return filters, tuple(files)
 
     def check_modify(self):
         while True:
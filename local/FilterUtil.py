@@ -1,6 +1,5 @@
 # coding:utf-8
 
-import threading
 import logging
 from copy import copy
 from time import mtime, sleep
@@ -14,27 +13,20 @@ from .common.util import LRUCache, DomainsTree
 from .GlobalConfig import GC
 from .FilterConfig import (
     FORWARD, DIRECT, FAKECERT,
-    numToAct, numToSSLAct, action_filters as _action_filters )
+    numToAct, numToSSLAct, FilterMatcher, action_filters as _action_filters )
 
-gLock = threading.Lock()
-gn = 0
-action_filters = _action_filters.config
-filters_cache = LRUCache(256)
-ssl_filters_cache = LRUCache(256)
-reset_method_list = [reset_dns]
-
-def lock_filters_cache(func):
-    def newfunc(*args, **kwargs):
-        global gn
-        with gLock:
-            gn += 1
-        try:
-            return func(*args, **kwargs)
-        finally:
-            with gLock:
-                gn -= 1
+class FilterSnapshot:
+    #规则快照，读取时直接引用当前快照无需加锁
+    #重新加载时建立新快照和新缓存，然后整体替换发布
+    def __init__(self, version):
+        self.version = version
+        self.config = _action_filters.config
+        self.matcher = _action_filters.matcher
+        self.filters_cache = LRUCache(256)
+        self.ssl_filters_cache = LRUCache(256)
 
-    return newfunc
+snapshot = FilterSnapshot(0)
+reset_method_list = [reset_dns]
 
 def check_reset():
     while True:
@@ -45,20 +37,42 @@ def check_reset():
             logging.warning('check_reset 发生错误：%s', e)
         sleep(1)
 
+def _carry_cache(old_cache, new_cache, matcher):
+    #保留不会被修改的规则匹配到的缓存条目，包括临时规则
+    count = 0
+    for key, value, expire in old_cache.items():
+        host = key.partition('://')[2] or key
+        if not matcher.match(host):
+            new_cache.set(key, value, expire)
+            count += 1
+    return count
+
 def _check_reset():
-    while _action_filters.reset and gn > 0:
-        sleep(0.01)
+    global snapshot
+    old_snapshot = snapshot
+    new_snapshot = FilterSnapshot(old_snapshot.version + 1)
+    #与当前发布的快照比较，多次修改后才执行时也包含全部修改
+    changed = _action_filters.diff_config(old_snapshot.config, new_snapshot.config)
+    if changed is None:
+        reset = True
+    else:
+        #只影响被修改规则匹配到的主机
+        matcher = FilterMatcher(changed)
+        count = _carry_cache(old_snapshot.filters_cache, new_snapshot.filters_cache, matcher)
+        count += _carry_cache(old_snapshot.ssl_filters_cache, new_snapshot.ssl_filters_cache, matcher)
+        #转发、直连和伪造证书规则会改变 IP 列表和连接设置
+        reset = any(filters.action in (FORWARD, DIRECT, FAKECERT) for filters in changed)
+    #旧快照由仍在使用它的请求继续使用直到完成
+    snapshot = new_snapshot
+    if reset:
+        for reset_method in reset_method_list:
+            reset_method()
+    _action_filters.reset = False
+    if changed is None:
+        logging.warning('自动规则缓存已重置。')
     else:
-        with gLock:
-            if gn == 0 and _action_filters.reset:
-                global action_filters
-                action_filters = _action_filters.config
-                filters_cache.clear()
-                ssl_filters_cache.clear()
-                for reset_method in reset_method_list:
-                    reset_method()
-                _action_filters.reset = False
-                logging.warning('自动规则缓存已重置。')
+        logging.warning('自动规则缓存已更新，%d 个分组发生变化，保留 %d 个条目%s。',
+                        len(changed), count, '，已重置 DNS 和连接缓存' if reset else '')
 
 start_new_thread(check_reset, ())
 
@@ -145,6 +159,7 @@ ssl_filter_DEF = numToSSLAct[GC.FILTER_SSLACTION], None
 
 def set_temp_action(host):
     #将临时规则插入缓存规则中第一个位置
+    filters_cache = snapshot.filters_cache
     try:
         filters = filters_cache[host]
     except KeyError:
@@ -157,6 +172,7 @@ def set_temp_action(host):
 
 def set_temp_connect_action(host):
     #将缓存规则替换为临时规则
+    ssl_filters_cache = snapshot.ssl_filters_cache
     filter = ssl_filters_cache[host]
     action = filter[0]
     if action != 'do_FAKECERT':
@@ -165,6 +181,7 @@ def set_temp_connect_action(host):
 
 def set_temp_fakesni(host):
     #将缓存规则替换为伪造规则
+    ssl_filters_cache = snapshot.ssl_filters_cache
     filter = ssl_filters_cache.get(host)
     if filter is not TEMPFAKESNI:
         ssl_filters_cache[host] = TEMPFAKESNI
@@ -172,6 +189,7 @@ def set_temp_fakesni(host):
 
 def unset_temp_fakesni(host):
     #取消伪造规则
+    ssl_filters_cache = snapshot.ssl_filters_cache
     filter = ssl_filters_cache[host]
     if filter is TEMPFAKESNI:
         ssl_filters_cache[host] = 'do_FAKECERT', None
@@ -220,8 +238,9 @@ def parse_profile(action, target):
             target = _, profile
     return target
 
-@lock_filters_cache
 def get_action(scheme, host, path, url):
+    _snapshot = snapshot
+    filters_cache = _snapshot.filters_cache
     schemes = '', scheme
     key = '%s://%s' % (scheme, host)
     filters = filters_cache.gettill(key)
@@ -256,33 +275,35 @@ def get_action(scheme, host, path, url):
     #建立缓存条目
     filters_cache.setpadding(key)
     _filters = []
-    for filters in action_filters:
-        if filters.action == FAKECERT:
+    matcher = _snapshot.matcher
+    rules = matcher.rules
+    for index in matcher.match(host):
+        _action, schemefilter, pathfilter, target = rules[index]
+        if _action == FAKECERT or schemefilter not in schemes:
             continue
-        for schemefilter, hostfilter, pathfilter, target in filters:
-            if schemefilter in schemes and match_host_filter(hostfilter, host):
-                action = numToAct[filters.action]
-                target = parse_profile(filters.action, target)
-                #填充规则到缓存
-                _filters.append((pathfilter, action, target))
-                #匹配第一个，后面忽略
-                if not filter and match_path_filter(pathfilter, path):
-                    #计算重定向网址
-                    if action in REDIRECTS:
-                        target = get_redirect(target, url)
-                        if target is not None:
-                            durl, mhost = target
-                            if durl and durl != url:
-                                filter = action, target
-                    else:
+        action = numToAct[_action]
+        target = parse_profile(_action, target)
+        #填充规则到缓存
+        _filters.append((pathfilter, action, target))
+        #匹配第一个，后面忽略
+        if not filter and match_path_filter(pathfilter, path):
+            #计算重定向网址
+            if action in REDIRECTS:
+                target = get_redirect(target, url)
+                if target is not None:
+                    durl, mhost = target
+                    if durl and durl != url:
                         filter = action, target
+            else:
+                filter = action, target
     #添加默认规则
     _filters.append(filter_DEF)
     filters_cache[key] = _filters
     return filter or filter_DEF[1:]
 
-@lock_filters_cache
 def get_connect_action(ssl, host):
+    _snapshot = snapshot
+    ssl_filters_cache = _snapshot.ssl_filters_cache
     scheme = 'https' if ssl else 'http'
     schemes = '', scheme
     key = '%s://%s' % (scheme, host)
@@ -295,18 +316,20 @@ def get_connect_action(ssl, host):
             filter = ssl_filters_cache.gettill(key)
         return filter
     ssl_filters_cache.setpadding(key)
-    for filters in action_filters:
-        for schemefilter, hostfilter, _, target in filters:
-            if schemefilter in schemes and match_host_filter(hostfilter, host):
-                #填充结果到缓存
-                action = numToSSLAct[filters.action]
-                if filters.action == FORWARD:
-                    target = parse_profile(filters.action, target)
-                if action == 'do_FAKECERT' and filters.action != FAKECERT and isinstance(target, str):
-                    target = (target, )
-                ssl_filters_cache[key] = filter = action, target
-                #匹配第一个，后面忽略
-                return filter
+    matcher = _snapshot.matcher
+    rules = matcher.rules
+    for index in matcher.match(host):
+        _action, schemefilter, _, target = rules[index]
+        if schemefilter in schemes:
+            #填充结果到缓存
+            action = numToSSLAct[_action]
+            if _action == FORWARD:
+                target = parse_profile(_action, target)
+            if action == 'do_FAKECERT' and _action != FAKECERT and isinstance(target, str):
+                target = (target, )
+            ssl_filters_cache[key] = filter = action, target
+            #匹配第一个，后面忽略
+            return filter
     #添加默认规则
     ssl_filters_cache[key] = ssl_filter_DEF
     return ssl_filter_DEF
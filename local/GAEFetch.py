@@ -6,7 +6,7 @@ import struct
 import logging
 from io import BytesIO
 from gzip import _PaddedFile
-from time import time, mtime, sleep, timezone, localtime, strftime, strptime, mktime
+from time import time, sleep, timezone, localtime, strftime, strptime, mktime
 from http.client import HTTPResponse, parse_headers
 from .FilterUtil import get_action
 from .GlobalConfig import GC
@@ -86,7 +86,7 @@ def check_appid_exists(appid):
                 if err is None:
                     exists = response.status in (200, 503)
                     if exists and GC.GAE_KEEPALIVE:
-                        http_util.ssl_connection_cache[connection_cache_key].append((mtime(), sock))
+                        http_util.ssl_connection_cache.checkin(connection_cache_key, sock)
                     return exists
 
 @_lock_appid
@@ -800,7 +800,7 @@ class IPManager:
                             result.args[0][-3:] == ' ms' and
                             self.pick_worker_cnt >= self.max_threads)) or \
                             len(self.ip_list) <= self.min_cnt:
-                    http_gws.ssl_connection_time[result.xip] = http_gws.timeout + 1
+                    http_gws.record_connection_fail(result.xip)
                     self.ip_list.append(self.ip_list.popleft())
                     self.logger.warning('%s 测试失败（超时：%d ms）%s，%s',
                             self.pick_worker_cnt, timeout, ip, result)
@@ -54,6 +54,10 @@ class GC:
     MISC_CHECKSYSCA = CONFIG.getboolean('misc', 'checksysca', fallback=True)
     MISC_GEVENTPATCH = CONFIG.getboolean('misc', 'geventpatch', fallback=False)
     MISC_REVERTGEVENTPATCH = CONFIG.getboolean('misc', 'revertgeventpatch', fallback=False)
+    MISC_SNAPSHOT = CONFIG.getboolean('misc', 'snapshot', fallback=True)
+    MISC_SNAPSHOTINTERVAL = max(CONFIG.getint('misc', 'snapshotinterval', fallback=600), 60)
+    MISC_SNAPSHOTMAXAGE = CONFIG.getint('misc', 'snapshotmaxage', fallback=86400)
+    MISC_DOMAINSCACHE = CONFIG.getboolean('misc', 'domainscache', fallback=True)
 
     LISTEN_IP = CONFIG.get('listen', 'ip')
     LISTEN_IPHOST = CONFIG.get('listen', 'iphost')
@@ -71,6 +75,7 @@ class GC:
     LISTEN_AUTH = min(CONFIG.getint('listen', 'auth', fallback=0), 2)
     LISTEN_AUTHWHITELIST = CONFIG.gettuple('listen', 'authwhitelist')
     LISTEN_AUTHUSER = CONFIG.gettuple('listen', 'authuser', fallback=':')
+    LISTEN_SERVERMODE = CONFIG.get('listen', 'servermode', fallback='thread').lower()
 
     LOG_VISIBLE = CONFIG.getboolean('log', 'visible', fallback=True)
     LOG_PRINT = CONFIG.getboolean('log', 'print', fallback=True)
@@ -89,6 +94,8 @@ class GC:
     LINK_FAKEUDPCHECK = CONFIG.getboolean('link', 'fakeudpcheck', fallback=False)
     LINK_FASTV6CHECK = CONFIG.getboolean('link', 'fastv6check', fallback=True)
     LINK_WINDOW = max(min(CONFIG.getint('link', 'window', fallback=3), 12), 2)
+    LINK_EXPLORE = max(min(CONFIG.getfloat('link', 'explore', fallback=0.5), 1.0), 0.0)
+    LINK_ATTEMPTDELAY = max(min(CONFIG.getint('link', 'attemptdelay', fallback=250), 2000), 0) / 1000
     LINK_MAXPERIP = max(min(CONFIG.getint('link', 'maxperip', fallback=6), 32), 3)
     LINK_RECVBUFFER = max(min(CONFIG.getint('link', 'recvbuffer', fallback=1024 * 64), 1024 * 1024 *4), 1024 * 8)
     LINK_SENDBUFFER = max(min(CONFIG.getint('link', 'sendbuffer', fallback=1024 * 16), 1024 * 1024), 1024 * 8)
@@ -102,11 +109,19 @@ class GC:
             LINK_LOCALSSLTXT = k
         if LINK_REMOTESSL == v:
             LINK_REMOTESSLTXT = k
+    LINK_LOCALKEY = CONFIG.get('link', 'localkey', fallback='rsa').lower()
+    if LINK_LOCALKEY not in ('rsa', 'ecc'):
+        LINK_LOCALKEY = 'rsa'
     LINK_REQUESTCOMPRESS = _brotli and CONFIG.getboolean('link', 'requestcompress', fallback=False)
     LINK_TIMEOUT = max(CONFIG.getint('link', 'timeout', fallback=5), 3)
     LINK_FWDTIMEOUT = max(CONFIG.getint('link', 'fwdtimeout', fallback=8), 3)
     LINK_KEEPTIME = CONFIG.getint('link', 'keeptime', fallback=180)
+    LINK_SESSIONREUSE = CONFIG.getboolean('link', 'sessionreuse', fallback=True)
+    LINK_SESSIONTIME = max(CONFIG.getint('link', 'sessiontime', fallback=3600), 0)
+    LINK_POOLMAXPERKEY = max(CONFIG.getint('link', 'poolmaxperkey', fallback=16), 1)
+    LINK_POOLMAX = max(CONFIG.getint('link', 'poolmax', fallback=512), 16)
     LINK_FWDKEEPTIME = CONFIG.getint('link', 'fwdkeeptime', fallback=120)
+    LINK_FWDENGINE = CONFIG.getboolean('link', 'fwdengine', fallback=False)
     LINK_TEMPTIME = CONFIG.getint('link', 'temptime', fallback=900)
     LINK_TEMPTIME_S = LINK_TEMPTIME % 60
     if LINK_TEMPTIME_S:
@@ -228,17 +243,32 @@ class GC:
     else:
         proxy = ''
 
+    AUTORANGE_ACTIONS = CONFIG.gettuple('autorange/fast', 'actions', fallback=('GAE',))
     AUTORANGE_FAST_ENDSWITH = CONFIG.gettuple('autorange/fast', 'endswith')
     AUTORANGE_FAST_THREADS = CONFIG.getint('autorange/fast', 'threads', fallback=5)
     AUTORANGE_FAST_FIRSTSIZE = CONFIG.getint('autorange/fast', 'firstsize', fallback=1024 * 32)
     AUTORANGE_FAST_MAXSIZE = CONFIG.getint('autorange/fast', 'maxsize', fallback=1024 * 256)
     AUTORANGE_FAST_LOWSPEED = CONFIG.getint('autorange/fast', 'lowspeed', fallback=1024)
+    AUTORANGE_FAST_RANGETIME = CONFIG.getfloat('autorange/fast', 'rangetime', fallback=2.0)
+    AUTORANGE_FAST_HEDGETIME = CONFIG.getfloat('autorange/fast', 'hedgetime', fallback=3.0)
 
     AUTORANGE_BIG_ONSIZE = CONFIG.getint('autorange/big', 'onsize', fallback=1024 * 1024 * 32)
     AUTORANGE_BIG_THREADS = CONFIG.getint('autorange/big', 'threads', fallback=2)
     AUTORANGE_BIG_MAXSIZE = CONFIG.getint('autorange/big', 'maxsize', fallback=1024 * 1024 * 4)
     AUTORANGE_BIG_SLEEPTIME = CONFIG.getint('autorange/big', 'sleeptime', fallback=5)
     AUTORANGE_BIG_LOWSPEED = CONFIG.getint('autorange/big', 'lowspeed', fallback=0)
+    AUTORANGE_BIG_RANGETIME = CONFIG.getfloat('autorange/big', 'rangetime', fallback=0.0)
+    AUTORANGE_BIG_HEDGETIME = CONFIG.getfloat('autorange/big', 'hedgetime', fallback=0.0)
+
+    AUTORANGE_CACHE_ENABLE = CONFIG.getboolean('autorange/cache', 'enable', fallback=False)
+    AUTORANGE_CACHE_DIR = get_realpath(CONFIG.get('autorange/cache', 'dir', fallback='') or 'rangecache', data_dir)
+    AUTORANGE_CACHE_SIZE = CONFIG.getint('autorange/cache', 'size', fallback=2048) * 1024 * 1024
+
+    HTTPCACHE_ENABLE = CONFIG.getboolean('httpcache', 'enable', fallback=False)
+    HTTPCACHE_DIR = get_realpath(CONFIG.get('httpcache', 'dir', fallback='') or 'httpcache', data_dir)
+    HTTPCACHE_MEMSIZE = CONFIG.getint('httpcache', 'memsize', fallback=64) * 1024 * 1024
+    HTTPCACHE_DISKSIZE = CONFIG.getint('httpcache', 'disksize', fallback=512) * 1024 * 1024
+    HTTPCACHE_MAXOBJECT = CONFIG.getint('httpcache', 'maxobject', fallback=4096) * 1024
 
     DNS_SERVERS = CONFIG.gettuple('dns', 'servers')
     DNS_LOCAL_SERVERS = CONFIG.gettuple('dns', 'localservers')
@@ -249,6 +279,8 @@ class GC:
     DNS_LOCAL_BLACKLIST = CONFIG.gettuple('dns', 'localblacklist')
     DNS_OVER_HTTPS = CONFIG.getboolean('dns', 'overhttps', fallback=True)
     DNS_OVER_HTTPS_SERVERS = CONFIG.gettuple('dns', 'overhttpsservers', fallback='cloudflare-dns.com')
+    DNS_OVER_HTTPS_H2 = CONFIG.getboolean('dns', 'overhttpsh2', fallback=True)
+    DNS_OVER_HTTPS_HEDGE = max(CONFIG.getint('dns', 'overhttpshedge', fallback=300), 0) / 1000
 
     DNS_DEF_PRIORITY = ['remote', 'overhttps', 'system']
     DNS_PRIORITY = CONFIG.getlist('dns', 'priority', fallback=DNS_DEF_PRIORITY)
@@ -263,5 +295,9 @@ class GC:
 
     DNS_CACHE_ENTRIES = CONFIG.getint('dns/cache', 'entries', fallback=1024)
     DNS_CACHE_EXPIRATION = CONFIG.getint('dns/cache', 'expiration', fallback=7200)
+    DNS_CACHE_MINTTL = max(CONFIG.getint('dns/cache', 'minttl', fallback=60), 0)
+    DNS_CACHE_MAXTTL = max(CONFIG.getint('dns/cache', 'maxttl', fallback=DNS_CACHE_EXPIRATION), DNS_CACHE_MINTTL)
+    DNS_CACHE_STALE = max(CONFIG.getint('dns/cache', 'stale', fallback=3600), 0)
+    DNS_CACHE_PREFETCH = max(CONFIG.getint('dns/cache', 'prefetch', fallback=3), 0)
 
 del CONFIG
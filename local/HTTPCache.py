@@ -0,0 +1,398 @@
+# coding:utf-8
+'''HTTP Cache，在 GAE、CFW 代理前缓存可共享的响应（RFC 9111 的子集）'''
+
+import os
+import re
+import marshal
+import hashlib
+import logging
+import threading
+from io import BytesIO
+from time import time
+from http.client import parse_headers
+from email.utils import parsedate_tz, mktime_tz
+from collections import OrderedDict
+from .GlobalConfig import GC
+
+cache_version = 1
+#可以使用启发式过期时间的状态码
+heuristic_status = 200, 203, 204, 300, 301, 308, 404, 405, 410, 414, 501
+#验证时更新的头域
+update_headers = 'Date', 'Expires', 'Cache-Control', 'Etag', 'Last-Modified', 'Age'
+getdirective = re.compile(r'([\w-]+)\s*(?:=\s*(?:"([^"]*)"|([^,\s]*)))?').findall
+
+def parse_cache_control(value):
+    if not value:
+        return {}
+    return {k.lower(): v or v2 for k, v, v2 in getdirective(value)}
+
+def parse_date(value):
+    if value:
+        try:
+            return mktime_tz(parsedate_tz(value))
+        except (TypeError, ValueError, OverflowError):
+            pass
+
+def parse_int(value):
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        pass
+
+def get_header(headers, name):
+    # CFW 返回的源站头域可能带有 Source- 前缀
+    value = headers.get(name)
+    if value is None:
+        value = headers.get('Source-' + name)
+    return value
+
+def get_vary(headers):
+    vary = get_header(headers, 'Vary')
+    if vary:
+        return tuple(sorted(set(v.strip().title() for v in vary.split(',') if v.strip())))
+    return ()
+
+class CacheEntry:
+    #缓存的响应，status 为 0 时只记录网址的 Vary 头域
+
+    __slots__ = 'url', 'status', 'reason', 'headers', 'vary', 'request_time', 'response_time', 'body'
+
+    def __init__(self, url, status, reason, headers, vary, request_time, response_time, body):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = dict(headers)
+        self.vary = vary
+        self.request_time = request_time
+        self.response_time = response_time
+        self.body = body
+
+    @property
+    def size(self):
+        return len(self.body) + 512
+
+    def dump(self):
+        return (cache_version, self.url, self.status, self.reason,
+                tuple(self.headers.items()), self.vary,
+                self.request_time, self.response_time, self.body)
+
+    @classmethod
+    def load(cls, data):
+        if data[0] != cache_version:
+            raise ValueError('缓存版本不匹配')
+        return cls(*data[1:])
+
+    @property
+    def cache_control(self):
+        return parse_cache_control(get_header(self.headers, 'Cache-Control'))
+
+    def freshness_lifetime(self):
+        cc = self.cache_control
+        for directive in ('s-maxage', 'max-age'):
+            if directive in cc:
+                lifetime = parse_int(cc[directive])
+                if lifetime is not None:
+                    return lifetime
+        date = parse_date(self.headers.get('Date')) or self.response_time
+        expires = get_header(self.headers, 'Expires')
+        if expires is not None:
+            expires = parse_date(expires)
+            #无效的 Expires 表示已过期
+            return max(expires - date, 0) if expires else 0
+        last_modified = parse_date(get_header(self.headers, 'Last-Modified'))
+        if last_modified and self.status in heuristic_status:
+            return min((date - last_modified) // 10, 86400)
+        return 0
+
+    def current_age(self, now):
+        date = parse_date(self.headers.get('Date')) or self.response_time
+        apparent_age = max(0, self.response_time - date)
+        age = parse_int(self.headers.get('Age')) or 0
+        corrected_age = age + self.response_time - self.request_time
+        return max(apparent_age, corrected_age) + now - self.response_time
+
+    def is_fresh(self, request_headers):
+        cc = self.cache_control
+        if 'no-cache' in cc:
+            return False
+        request_cc = parse_cache_control(request_headers.get('Cache-Control'))
+        if 'no-cache' in request_cc or \
+                'no-cache' in request_headers.get('Pragma', '').lower():
+            return False
+        age = self.current_age(time())
+        if 'max-age' in request_cc:
+            max_age = parse_int(request_cc['max-age'])
+            if max_age is not None and age > max_age:
+                return False
+        return age < self.freshness_lifetime()
+
+    def validators(self):
+        return get_header(self.headers, 'Etag'), get_header(self.headers, 'Last-Modified')
+
+    def not_modified(self, request_headers):
+        #判断客户端的条件请求
+        etag, last_modified = self.validators()
+        if_none_match = request_headers.get('If-None-Match')
+        if if_none_match:
+            if not etag:
+                return False
+            etag = etag[2:] if etag.startswith('W/') else etag
+            return if_none_match.strip() == '*' or etag in (
+                    tag.strip()[2:] if tag.strip().startswith('W/') else tag.strip()
+                    for tag in if_none_match.split(','))
+        if_modified_since = parse_date(request_headers.get('If-Modified-Since'))
+        last_modified = parse_date(last_modified)
+        return bool(if_modified_since and last_modified and last_modified <= if_modified_since)
+
+class CacheResponse(BytesIO):
+    #代替 HTTPResponse 发送缓存的响应
+
+    def __init__(self, entry, status, age):
+        body = b'' if status == 304 else entry.body
+        BytesIO.__init__(self, body)
+        self.status = status
+        self.reason = 'Not Modified' if status == 304 else entry.reason
+        headers = entry.headers.copy()
+        headers['Age'] = str(age)
+        headers = ''.join('%s: %s\r\n' % x for x in headers.items()) + '\r\n'
+        self.headers = self.msg = parse_headers(BytesIO(headers.encode('iso-8859-1')))
+        self.length = len(body)
+
+class HTTPCache:
+    #内存和磁盘两级缓存，分别按最近使用顺序在超过预算时删除
+    #内存中的缓存同时保存在磁盘上，从内存删除后仍可从磁盘载入
+
+    def __init__(self, dir, mem_size, disk_size, max_object):
+        self.dir = dir
+        self.mem_size = mem_size
+        self.disk_size = disk_size
+        self.max_object = max_object
+        self.lock = threading.Lock()
+        self.mem = OrderedDict()
+        self.mem_total = 0
+        self.disk = OrderedDict()
+        self.disk_total = 0
+        self.hits = self.revalidated = self.misses = self.stores = 0
+        self.last_report = None
+        if disk_size:
+            self.load_index()
+
+    def load_index(self):
+        try:
+            os.makedirs(self.dir, exist_ok=True)
+            files = [(os.stat(os.path.join(self.dir, name)), name) for name in os.listdir(self.dir)]
+        except OSError as e:
+            logging.warning('载入 HTTP 缓存目录 %r 失败：%r', self.dir, e)
+            self.disk_size = 0
+            return
+        for stat, key in sorted(files, key=lambda x: x[0].st_mtime):
+            #未完成保存的临时文件
+            if '.' in key:
+                self.remove_file(key)
+                continue
+            self.disk[key] = stat.st_size
+            self.disk_total += stat.st_size
+        with self.lock:
+            self.evict()
+
+    @staticmethod
+    def get_key(url, vary=()):
+        key = url
+        if vary:
+            key += '\n' + '\n'.join('%s: %s' % x for x in vary)
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def evict(self):
+        while self.mem_total > self.mem_size and self.mem:
+            _, entry = self.mem.popitem(last=False)
+            self.mem_total -= entry.size
+        while self.disk_total > self.disk_size and self.disk:
+            key, size = self.disk.popitem(last=False)
+            self.disk_total -= size
+            self.remove_file(key)
+
+    def remove_file(self, key):
+        try:
+            os.remove(os.path.join(self.dir, key))
+        except OSError:
+            pass
+
+    def get(self, key):
+        with self.lock:
+            entry = self.mem.get(key)
+            if entry is not None:
+                self.mem.move_to_end(key)
+                if key in self.disk:
+                    self.disk.move_to_end(key)
+                return entry
+            if key not in self.disk:
+                return
+            self.disk.move_to_end(key)
+        try:
+            with open(os.path.join(self.dir, key), 'rb') as fd:
+                entry = CacheEntry.load(marshal.load(fd))
+        except (OSError, EOFError, ValueError, TypeError) as e:
+            logging.debug('载入 HTTP 缓存 %s 失败：%r', key, e)
+            self.delete(key)
+            return
+        with self.lock:
+            self._put_mem(key, entry)
+        return entry
+
+    def _put_mem(self, key, entry):
+        old = self.mem.pop(key, None)
+        if old is not None:
+            self.mem_total -= old.size
+        self.mem[key] = entry
+        self.mem_total += entry.size
+        self.evict()
+
+    def put(self, key, entry):
+        size = 0
+        if self.disk_size:
+            file = os.path.join(self.dir, key)
+            try:
+                with open(file + '.tmp', 'wb') as fd:
+                    marshal.dump(entry.dump(), fd)
+                os.replace(file + '.tmp', file)
+                size = os.path.getsize(file)
+            except OSError as e:
+                logging.debug('保存 HTTP 缓存 %r 失败：%r', entry.url, e)
+        with self.lock:
+            self._put_mem(key, entry)
+            if size:
+                self.disk_total += size - self.disk.pop(key, 0)
+                self.disk[key] = size
+                self.evict()
+
+    def delete(self, key):
+        with self.lock:
+            entry = self.mem.pop(key, None)
+            if entry is not None:
+                self.mem_total -= entry.size
+            size = self.disk.pop(key, None)
+            if size is not None:
+                self.disk_total -= size
+                self.remove_file(key)
+
+    @staticmethod
+    def cacheable_request(command, request_headers, payload):
+        #只缓存不带内容和范围的 GET 请求，其它方法的响应不能用于 GET
+        return command == 'GET' and not payload and \
+                'Range' not in request_headers and \
+                'no-store' not in parse_cache_control(request_headers.get('Cache-Control'))
+
+    def lookup(self, command, url, request_headers, payload):
+        #返回网址对应的缓存，不可缓存的请求返回 None
+        if not self.cacheable_request(command, request_headers, payload) or \
+                'Authorization' in request_headers:
+            return
+        entry = self.get(self.get_key(url))
+        if entry is not None and entry.status == 0:
+            vary = tuple((field, request_headers.get(field, '')) for field in entry.vary)
+            entry = self.get(self.get_key(url, vary))
+        if entry is None:
+            with self.lock:
+                self.misses += 1
+        return entry
+
+    def add_conditions(self, entry, request_headers):
+        #使用缓存的验证信息，客户端的条件请求改为由缓存判断
+        etag, last_modified = entry.validators()
+        request_headers.pop('If-None-Match', None)
+        request_headers.pop('If-Modified-Since', None)
+        if etag:
+            request_headers['If-None-Match'] = etag
+        if last_modified:
+            request_headers['If-Modified-Since'] = last_modified
+        return bool(etag or last_modified)
+
+    def is_fresh(self, entry, request_headers):
+        fresh = entry.is_fresh(request_headers)
+        with self.lock:
+            if fresh:
+                self.hits += 1
+            else:
+                #验证成功时改为计入 revalidated
+                self.misses += 1
+        return fresh
+
+    def store(self, command, url, request_headers, payload, response, request_time):
+        #保存可共享的响应，完整读取内容后替换响应的读取对象
+        if not self.cacheable_request(command, request_headers, payload):
+            return
+        headers = {k.title(): v for k, v in response.headers.items()}
+        status = response.status
+        length = response.length
+        cc = parse_cache_control(get_header(headers, 'Cache-Control'))
+        vary = get_vary(headers)
+        #RFC 9111 3.5，带验证信息的请求的响应需明确允许才能共享
+        if 'Authorization' in request_headers and \
+                not ('public' in cc or 's-maxage' in cc or 'must-revalidate' in cc):
+            return
+        if status not in heuristic_status or \
+                'no-store' in cc or 'private' in cc or '*' in vary or \
+                'Set-Cookie' in headers or \
+                headers.get('X-Fetch-Status', 'ok') != 'ok' or \
+                length is None or length > self.max_object or \
+                getattr(response, 'chunked', False):
+            return
+        entry = CacheEntry(url, status, response.reason, headers,
+                           tuple((field, request_headers.get(field, '')) for field in vary),
+                           request_time, time(), b'')
+        if not (entry.freshness_lifetime() or any(entry.validators())):
+            return
+        body = response.read(length) if length else b''
+        if len(body) != length:
+            response.fp = BytesIO(body)
+            response.length = len(body)
+            return
+        response.fp = BytesIO(body)
+        response.length = length
+        entry.body = body
+        if vary:
+            self.put(self.get_key(url), CacheEntry(url, 0, '', {}, vary, 0, 0, b''))
+        self.put(self.get_key(url, entry.vary), entry)
+        with self.lock:
+            self.stores += 1
+
+    def update(self, entry, response, request_time):
+        #验证成功，使用 304 响应更新头域
+        with self.lock:
+            self.misses -= 1
+            self.revalidated += 1
+        headers = {k.title(): v for k, v in response.headers.items()}
+        entry = CacheEntry(entry.url, entry.status, entry.reason, entry.headers,
+                           entry.vary, request_time, time(), entry.body)
+        for name in update_headers:
+            value = get_header(headers, name)
+            if value is not None:
+                entry.headers[name] = value
+        if 'Age' not in headers:
+            entry.headers.pop('Age', None)
+        self.put(self.get_key(entry.url, entry.vary), entry)
+        return entry
+
+    def make_response(self, entry, request_headers):
+        status = 304 if entry.not_modified(request_headers) else entry.status
+        return CacheResponse(entry, status, int(entry.current_age(time())))
+
+    def report(self):
+        with self.lock:
+            counts = hits, revalidated, misses, stores = \
+                    self.hits, self.revalidated, self.misses, self.stores
+            mem_total, disk_total = self.mem_total, self.disk_total
+        if counts == self.last_report:
+            return
+        self.last_report = counts
+        total = hits + revalidated + misses
+        logging.info('HTTP 缓存：命中 %d，验证 %d，未命中 %d，保存 %d，命中率 %.1f%%，'
+                     '内存 %d 字节，磁盘 %d 字节',
+                     hits, revalidated, misses, stores,
+                     (hits + revalidated) * 100 / total if total else 0,
+                     mem_total, disk_total)
+
+if GC.HTTPCACHE_ENABLE:
+    http_cache = HTTPCache(GC.HTTPCACHE_DIR, GC.HTTPCACHE_MEMSIZE, GC.HTTPCACHE_DISKSIZE, GC.HTTPCACHE_MAXOBJECT)
+else:
+    http_cache = None
@@ -12,7 +12,8 @@ import OpenSSL
 import logging
 import threading
 from time import mtime, sleep
-from queue import Queue
+from queue import Queue, Empty
+from itertools import zip_longest
 from _thread import start_new_thread
 from http.client import HTTPResponse
 from .GlobalConfig import GC
@@ -26,6 +27,7 @@ from .common.net import (
     isip, check_connection_dead )
 from .common.decorator import make_lock_decorator
 from .common.path import cert_dir
+from .common.pool import ConnectionPool
 from .common.proxy import parse_proxy, proxy_no_rdns
 from .common.util import LRUCache, LimiterFull, LimitDictBase, wait_exit
 from .FilterUtil import reset_method_list, get_fakesni, unset_temp_fakesni
@@ -321,6 +323,8 @@ vQIDAQAB
 gws_servername = GC.GAE_SERVERNAME
 gae_testgwsiplist = GC.GAE_TESTGWSIPLIST
 autorange_threads = GC.AUTORANGE_FAST_THREADS
+link_explore = GC.LINK_EXPLORE
+link_attemptdelay = GC.LINK_ATTEMPTDELAY
 _lock_context = make_lock_decorator()
 maxperip_settings = LRUCache(128, 600)
 
@@ -377,6 +381,82 @@ def limit_connect(func):
 
     return newfunc
 
+def interleave_addresses(addrs):
+    #按 RFC 8305 交错排列 IPv6/IPv4 地址，首个地址的地址族优先
+    addrs6 = [addr for addr in addrs if ':' in addr[0]]
+    if not addrs6 or len(addrs6) == len(addrs):
+        return addrs
+    addrs4 = [addr for addr in addrs if ':' not in addr[0]]
+    if addrs6[0] is not addrs[0]:
+        addrs4, addrs6 = addrs6, addrs4
+    return [addr for pair in zip_longest(addrs6, addrs4) for addr in pair if addr]
+
+class IPStats:
+    'Connection statistics for remote IP.'
+
+    __slots__ = 'ewma', 'samples', 'failrate'
+
+    TCP = 0
+    SSL = 1
+    #平滑系数、尾部延迟权重、最近采样数量
+    alpha = 0.25
+    tail_weight = 0.3
+    sample_size = 10
+
+    def __init__(self):
+        #连接用时、握手用时的指数加权移动平均
+        self.ewma = [None, None]
+        #最近的采样，失败时按超时记录
+        self.samples = (collections.deque(maxlen=self.sample_size),
+                        collections.deque(maxlen=self.sample_size))
+        self.failrate = 0.0
+
+    def update(self, kind, t):
+        ewma = self.ewma[kind]
+        if ewma is None:
+            self.ewma[kind] = t
+        else:
+            self.ewma[kind] = ewma + self.alpha * (t - ewma)
+        self.samples[kind].append(t)
+        self.failrate -= self.alpha * self.failrate
+
+    def fail(self, kind, timeout):
+        self.samples[kind].append(timeout)
+        self.failrate += self.alpha * (1 - self.failrate)
+
+    def dump(self):
+        return self.ewma, [list(samples) for samples in self.samples], self.failrate
+
+    @classmethod
+    def load(cls, data):
+        ewma, samples, failrate = data
+        self = cls()
+        self.ewma = list(ewma)
+        for kind, _samples in enumerate(samples):
+            self.samples[kind].extend(_samples)
+        self.failrate = failrate
+        return self
+
+    def known(self, kind):
+        return bool(self.samples[kind])
+
+    def p95(self, kind):
+        samples = self.samples[kind]
+        if samples:
+            samples = sorted(samples)
+            return samples[int(0.95 * (len(samples) - 1) + 0.5)]
+
+    def score(self, kind, timeout):
+        #用于排序的评分：平均用时与尾部延迟的加权，加上失败惩罚
+        ewma = self.ewma[kind]
+        if ewma is None:
+            ewma = timeout
+        p95 = self.p95(kind)
+        if p95 is not None:
+            ewma += self.tail_weight * (p95 - ewma)
+        return ewma + self.failrate * timeout
+
+
 class BaseHTTPUtil:
     '''Basic HTTP Request Class'''
 
@@ -392,6 +472,7 @@ class BaseHTTPUtil:
             self.context_cache.clear()
             self.tcp_connection_cache.clear()
             self.ssl_connection_cache.clear()
+            self.ssl_session_cache.clear()
             self._cert_store = OpenSSL.crypto.X509Store()
             self.load_cacert(cacert)
         if ssl_ciphers:
@@ -404,11 +485,14 @@ class BaseHTTPUtil:
             self.keeptime = GC.LINK_KEEPTIME
             self.max_per_ip = GC.LINK_MAXPERIP
         self.context_cache = LRUCache(min(GC.DNS_CACHE_ENTRIES, 256))
-        self.tcp_connection_cache = collections.defaultdict(collections.deque)
-        self.ssl_connection_cache = collections.defaultdict(collections.deque)
+        self.tcp_connection_cache = ConnectionPool(self.keeptime, GC.LINK_POOLMAXPERKEY, GC.LINK_POOLMAX, 'tcp')
+        self.ssl_connection_cache = ConnectionPool(self.keeptime, GC.LINK_POOLMAXPERKEY, GC.LINK_POOLMAX, 'ssl')
+        #按 (IP, SNI) 缓存 TLS 会话，用于重新连接时的简短握手
+        self.ssl_session_cache = LRUCache(512 if gws else 1024, GC.LINK_SESSIONTIME)
+        self.session_lock = threading.Lock()
+        self.session_hits = 0
+        self.session_misses = 0
         self.init_cert_store = init_cert_store() or init_cert_store
-        start_new_thread(self.check_connection_cache, ('tcp',))
-        start_new_thread(self.check_connection_cache, ('ssl',))
 
     def load_cacert(self, cacert):
         if os.path.isdir(cacert):
@@ -450,9 +534,12 @@ class BaseHTTPUtil:
         ssl_options |= SSL.OP_NO_COMPRESSION
         #通用问题修复
         ssl_options |= SSL.OP_ALL
-        #会话重用
-        ssl_options |= SSL.OP_NO_TICKET
-        context.set_session_cache_mode(SSL.SESS_CACHE_OFF)
+        #会话重用，会话由 ssl_session_cache 管理
+        if GC.LINK_SESSIONREUSE:
+            context.set_session_cache_mode(SSL.SESS_CACHE_CLIENT | SSL.SESS_CACHE_NO_INTERNAL)
+        else:
+            ssl_options |= SSL.OP_NO_TICKET
+            context.set_session_cache_mode(SSL.SESS_CACHE_OFF)
         #证书验证
         context.set_cert_store(self._cert_store)
         context.set_verify(SSL.VERIFY_PEER, self._verify_callback)
@@ -460,9 +547,51 @@ class BaseHTTPUtil:
         context.set_cipher_list(self.ssl_ciphers)
         #应用设置
         context.set_options(ssl_options)
+        #以 h2: 开头的连接键值协商使用 HTTP/2
+        if cache_key and cache_key.startswith('h2:'):
+            context.set_alpn_protos([b'h2', b'http/1.1'])
         self.context_cache[cache_key] = context
         return context
 
+    def set_ssl_session(self, ssl_sock, ipaddr, sock):
+        if not GC.LINK_SESSIONREUSE:
+            return
+        #会话恢复时不会再进行证书验证，所以键值包含验证用的主机名和参数
+        cert_params = sock.cert_params and tuple(sock.cert_params)
+        key = ipaddr, ssl_sock.get_servername(), sock.proof_hostname, cert_params
+        ssl_sock.session_key = key
+        session = self.ssl_session_cache.get(key)
+        if session is not None:
+            try:
+                ssl_sock.set_session(session)
+            except Exception as e:
+                logging.debug('%s set_ssl_session 失败：%r', ipaddr[0], e)
+
+    def check_ssl_session(self, ssl_sock):
+        try:
+            reused = ssl_sock.session_reused()
+        except Exception:
+            reused = False
+        with self.session_lock:
+            if reused:
+                self.session_hits += 1
+            else:
+                self.session_misses += 1
+        self.save_ssl_session(ssl_sock)
+
+    def save_ssl_session(self, ssl_sock):
+        #TLSv1.3 的会话票据在握手完成后才会收到，读取响应后需再次保存
+        key = getattr(ssl_sock, 'session_key', None)
+        if key is None:
+            return
+        try:
+            session = ssl_sock.get_session()
+        except Exception as e:
+            logging.debug('%s save_ssl_session 失败：%r', key[0][0], e)
+            return
+        if session:
+            self.ssl_session_cache[key] = session
+
     def _verify_callback(self, sock, cert, error_number, depth, ok):
         cert_params = sock.cert_params
         if cert_params and 'allow insecure' in cert_params:
@@ -597,41 +726,6 @@ class BaseHTTPUtil:
             raise CertificateError(-1, '谷歌域名没有获取到正确的证书链：CA 公钥不匹配。')
         return certs[0]
 
-    @staticmethod
-    def check_connection_alive(sock, keeptime, ctime):
-        if mtime() - ctime > keeptime:
-            sock.close()
-            return
-        return not check_connection_dead(sock)
-
-    def check_connection_cache(self, type='tcp'):
-        check_connection_alive = self.check_connection_alive
-        if type == 'tcp':
-            connection_cache = self.tcp_connection_cache
-        elif type == 'ssl':
-            connection_cache = self.ssl_connection_cache
-        else:
-            raise ValueError('unknown connection cache type: %r' % type)
-        keeptime = self.keeptime
-        while True:
-            sleep(1)
-            #将键名放入元组
-            keys = tuple(connection_cache.keys())
-            for cache_key in keys:
-                if cache_key not in connection_cache:
-                    continue
-                cache = connection_cache[cache_key]
-                try:
-                    while cache:
-                        ctime, connection = cached_connection = cache.popleft()
-                        if check_connection_alive(connection, keeptime, ctime):
-                            cache.appendleft(cached_connection)
-                            break
-                except Exception as e:
-                    logging.error('check_connection_cache(type=%r, key=%r) 错误：%s', type, cache_key, e)
-                if not cache:
-                    del connection_cache[cache_key]
-
     def clear_all_connection_cache(self):
         self.tcp_connection_cache.clear()
         self.ssl_connection_cache.clear()
@@ -653,8 +747,7 @@ class HTTPUtil(BaseHTTPUtil):
         self.max_retry = max_retry
         self.timeout = timeout
         self.proxy = proxy
-        self.tcp_connection_time = LRUCache(512 if self.gws else 4096)
-        self.ssl_connection_time = LRUCache(512 if self.gws else 4096)
+        self.ip_stats = LRUCache(512 if self.gws else 4096)
 
         if self.gws and GC.GAE_ENABLEPROXY:
             self.gws_front_connection_time = LRUCache(128)
@@ -669,46 +762,134 @@ class HTTPUtil(BaseHTTPUtil):
         self.create_connection = limit_connect(self.create_connection)
         self.create_ssl_connection = limit_connect(self.create_ssl_connection)
 
-    def get_tcp_ssl_connection_time(self, addr):
-        t = self.tcp_connection_time.get(addr) or self.ssl_connection_time.get(addr, self.timeout)
+    @_lock_context
+    def get_ip_stats(self, addr):
+        stats = self.ip_stats.get(addr)
+        if stats is None:
+            stats = self.ip_stats[addr] = IPStats()
+        return stats
+
+    def record_connection_time(self, addr, kind, t):
+        self.get_ip_stats(addr).update(kind, t)
+
+    def record_connection_fail(self, addr, kind=IPStats.SSL):
+        self.get_ip_stats(addr).fail(kind, self.timeout + 1)
+
+    def get_connection_score(self, addr, kind):
+        stats = self.ip_stats.get(addr)
+        if stats is None:
+            t = self.timeout
+        else:
+            if kind is None:
+                kind = IPStats.TCP if stats.known(IPStats.TCP) else IPStats.SSL
+            t = stats.score(kind, self.timeout)
         if LimitConnection.full(addr[0]):
             t += self.timeout
         return t
 
+    def get_tcp_ssl_connection_time(self, addr):
+        return self.get_connection_score(addr, None)
+
     def get_tcp_connection_time(self, addr):
-        t = self.tcp_connection_time.get(addr, self.timeout)
-        if LimitConnection.full(addr[0]):
-            t += self.timeout
-        return t
+        return self.get_connection_score(addr, IPStats.TCP)
 
     def get_ssl_connection_time(self, addr):
-        t = self.ssl_connection_time.get(addr, self.timeout)
-        if LimitConnection.full(addr[0]):
-            t += self.timeout
-        return t
+        return self.get_connection_score(addr, IPStats.SSL)
+
+    def pick_addresses(self, addresses, get_connection_time, retry):
+        #评分靠前的 IP 必选，其余位置按探索概率随机抽取较慢的 IP，以便更新其统计
+        addresses.sort(key=get_connection_time)
+        window = min((self.max_window + 1)//2 + min(retry, 1), len(addresses))
+        addrs = addresses[:window]
+        others = addresses[window:]
+        for _ in range(self.max_window - window):
+            if random.random() < link_explore:
+                addrs.append(others.pop(random.randrange(len(others))))
+            else:
+                addrs.append(others.pop(0))
+        return addrs
 
-    def _cache_connection(self, cache, count, queobj):
+    def _cache_connection(self, connection_cache, cache_key, count, queobj):
         for _ in range(count):
             sock = queobj.get()
             if hasattr(sock, '_sock'):
-                cache.append((mtime(), sock))
+                connection_cache.checkin(cache_key, sock)
+
+    def _close_connection(self, connection_cache, cache_key, count, queobj):
+        #取自连接池的连接放回连接池，新建的连接关闭
+        for _ in range(count):
+            sock = queobj.get()
+            if hasattr(sock, '_sock'):
+                if getattr(sock, 'pooled', False):
+                    connection_cache.checkin(cache_key, sock)
+                else:
+                    sock.close()
 
-    def _create_connection(self, ipaddr, queobj, timeout=None, get_cache_sock=None):
+    def _iter_connection(self, addrs, connect, connection_cache, cache_key, staged):
+        #逐个返回连接结果，结束时处理剩余的连接
+        #staged 为真时按地址族交错排列，间隔 attemptdelay 依次发起连接，
+        #前一个连接失败时立即发起下一个，多余的连接会被关闭而不是放入连接池，
+        #取消尚未完成的连接，取自连接池的连接仍放回连接池
+        queobj = Queue()
+        cancel = threading.Event()
+        running = 0
+        try:
+            if staged:
+                pending = collections.deque(interleave_addresses(addrs))
+                last_failed = True
+                while pending or running:
+                    if pending and (not running or last_failed):
+                        start_new_thread(connect, (pending.popleft(), queobj, cancel))
+                        running += 1
+                        last_failed = False
+                    try:
+                        result = queobj.get(timeout=link_attemptdelay if pending else None)
+                    except Empty:
+                        start_new_thread(connect, (pending.popleft(), queobj, cancel))
+                        running += 1
+                        continue
+                    running -= 1
+                    last_failed = isinstance(result, Exception)
+                    yield result
+            else:
+                for addr in addrs:
+                    start_new_thread(connect, (addr, queobj, cancel))
+                running = len(addrs)
+                while running:
+                    result = queobj.get()
+                    running -= 1
+                    yield result
+        finally:
+            if running:
+                if staged:
+                    cancel.set()
+                    start_new_thread(self._close_connection, (connection_cache, cache_key, running, queobj))
+                else:
+                    start_new_thread(self._cache_connection, (connection_cache, cache_key, running, queobj))
+
+    def _create_connection(self, ipaddr, queobj, timeout=None, get_cache_sock=None, cancel=None):
         if get_cache_sock:
             sock = get_cache_sock()
             if sock:
+                sock.pooled = True
                 queobj.put(sock)
                 return
 
         sock = None
         try:
             sock = self.get_tcp_socket(ipaddr[0], timeout)
+            #已有其它连接胜出，放弃本次连接
+            if cancel and cancel.is_set():
+                sock.close()
+                queobj.put(None)
+                return
             # start connection time record
             start_time = mtime()
             # TCP connect
             sock.connect(ipaddr)
             # record TCP connection time
-            self.tcp_connection_time[ipaddr] = sock.tcp_time = mtime() - start_time
+            sock.tcp_time = mtime() - start_time
+            self.record_connection_time(ipaddr, IPStats.TCP, sock.tcp_time)
             # put socket object to output queobj
             sock.xip = ipaddr
             queobj.put(sock)
@@ -718,28 +899,12 @@ class HTTPUtil(BaseHTTPUtil):
             # any socket.error, put Excpetions to output queobj.
             e.xip = ipaddr
             queobj.put(e)
-            # reset a large and random timeout to the ipaddr
-            self.tcp_connection_time[ipaddr] = self.timeout + 1
+            # record a failure to the ipaddr
+            self.record_connection_fail(ipaddr, IPStats.TCP)
 
     def create_connection(self, address, hostname, cache_key, ssl=None, forward=None, **kwargs):
-        def get_cache_sock(cache=None):
-            if cache is None:
-                cache = self.tcp_connection_cache.get(cache_key)
-            used_sock = []
-            try:
-                while cache:
-                    ctime, sock = cachedsock = cache.pop()
-                    if newconn and hasattr(sock, 'used'):
-                        used_sock.append(cachedsock)
-                        continue
-                    if self.check_connection_alive(sock, self.keeptime, ctime):
-                        return sock
-            except IndexError:
-                pass
-            finally:
-                if newconn and used_sock:
-                    used_sock.reverse()
-                    cache.extend(used_sock)
+        def get_cache_sock(key=cache_key):
+            return self.tcp_connection_cache.checkout(key, newconn)
 
         def get_cache_sock_ex():
             if cache_key is None or '|' in hostname:
@@ -752,13 +917,10 @@ class HTTPUtil(BaseHTTPUtil):
                 del names[0]
             chost = '.'.join(names)
             ckey = '%s:%s' % (chost, cache_key.partition(':')[-1])
-            keys = tuple(self.tcp_connection_cache.keys())
-            for key in keys:
-                if key not in self.tcp_connection_cache or\
-                         '|' in key or not key.endswith(ckey):
+            for key in self.tcp_connection_cache.keys():
+                if '|' in key or not key.endswith(ckey):
                     continue
-                cache = self.tcp_connection_cache[key]
-                sock = get_cache_sock(cache)
+                sock = get_cache_sock(key)
                 if sock:
                     if key != cache_key:
                         logging.warning(
@@ -774,6 +936,9 @@ class HTTPUtil(BaseHTTPUtil):
         if sock:
             return sock
 
+        def connect(addr, queobj, cancel):
+            self._create_connection(addr, queobj, forward, get_cache_sock, cancel)
+
         result = None
         host, port = address
         addresses = [(x, port) for x in dns[hostname]]
@@ -784,17 +949,11 @@ class HTTPUtil(BaseHTTPUtil):
         for i in range(self.max_retry):
             addresseslen = len(addresses)
             if addresseslen > self.max_window:
-                addresses.sort(key=get_connection_time)
-                window = min((self.max_window+1)//2 + min(i, 1), addresseslen)
-                addrs = addresses[:window] + random.sample(addresses[window:], self.max_window-window)
+                addrs = self.pick_addresses(addresses, get_connection_time, i)
             else:
                 addrs = addresses
-            queobj = Queue()
-            for addr in addrs:
-                start_new_thread(self._create_connection, (addr, queobj, forward, get_cache_sock))
-            addrslen = len(addrs)
-            for n in range(addrslen):
-                result = queobj.get()
+            results = self._iter_connection(addrs, connect, self.tcp_connection_cache, cache_key, link_attemptdelay)
+            for n, result in enumerate(results):
                 if isinstance(result, Exception):
                     addr = result.xip
                     if addresseslen > 1:
@@ -813,19 +972,18 @@ class HTTPUtil(BaseHTTPUtil):
                             #only output first error
                             logging.warning('%s _create_connection %r 返回 %r，重试', addr[0], host, result)
                 else:
-                    if addrslen - n > 1:
-                        cache = self.tcp_connection_cache[cache_key]
-                        start_new_thread(self._cache_connection, (cache, addrslen-n-1, queobj))
+                    results.close()
                     return result
         if result:
             raise result
 
-    def _create_ssl_connection(self, ipaddr, cache_key, host, queobj, timeout=None, get_cache_sock=None, callback=None):
+    def _create_ssl_connection(self, ipaddr, cache_key, host, queobj, timeout=None, get_cache_sock=None, callback=None, cancel=None):
         retry = None
         while True:
             if get_cache_sock:
                 sock = get_cache_sock()
                 if sock:
+                    sock.pooled = True
                     queobj.put(sock)
                     return
 
@@ -835,10 +993,16 @@ class HTTPUtil(BaseHTTPUtil):
                 sock = self.get_tcp_socket(ip, timeout)
                 server_name = self.get_server_hostname(host, cache_key)
                 ssl_sock = self.get_ssl_socket(sock, cache_key, server_name)
+                self.set_ssl_session(ssl_sock, ipaddr, sock)
                 # start connection time record
                 start_time = mtime()
                 # TCP connect
                 ssl_sock.connect(ipaddr)
+                #已有其它连接胜出，放弃握手
+                if cancel and cancel.is_set():
+                    ssl_sock.close()
+                    queobj.put(None)
+                    return
                 #connected_time = mtime()
                 # set a short timeout to trigger timeout retry more quickly.
                 if timeout is not None:
@@ -848,16 +1012,17 @@ class HTTPUtil(BaseHTTPUtil):
                 handshaked_time = mtime()
                 # record SSL connection time
                 ssl_sock.ssl_time = handshaked_time - start_time
+                self.check_ssl_session(ssl_sock)
                 # verify Google SSL certificate.
                 if self.gws:
                     self.google_verify(ssl_sock)
                 ssl_sock.xip = ipaddr
                 if callback:
                     cache_key = callback(ssl_sock) or cache_key
-                    self.ssl_connection_time[ipaddr] = ssl_sock.ssl_time
-                    self.ssl_connection_cache[cache_key].append((mtime(), ssl_sock))
+                    self.record_connection_time(ipaddr, IPStats.SSL, ssl_sock.ssl_time)
+                    self.ssl_connection_cache.checkin(cache_key, ssl_sock)
                     return True
-                self.ssl_connection_time[ipaddr] = ssl_sock.ssl_time
+                self.record_connection_time(ipaddr, IPStats.SSL, ssl_sock.ssl_time)
                 # put ssl socket object to output queobj
                 queobj.put(ssl_sock)
             except NetWorkIOError as e:
@@ -872,28 +1037,27 @@ class HTTPUtil(BaseHTTPUtil):
                     else:
                         callback(e)
                         return isinstance(e, LimiterFull)
-                # reset a large and random timeout to the ipaddr
-                try:
-                    self.ssl_connection_time[ipaddr] += 1
-                except KeyError:
-                    self.ssl_connection_time[ipaddr] = self.timeout + 1
+                # record a failure to the ipaddr
+                self.record_connection_fail(ipaddr)
+                queobj.put(e)
+            except Exception as e:
+                #其它异常也要返回，否则等待结果的线程会一直阻塞
+                if sock:
+                    sock.close()
+                logging.warning('%s _create_ssl_connection %r 发生意外错误：%r', ip, host, e)
+                e.xip = ipaddr
+                if callback:
+                    callback(e)
+                    return
                 queobj.put(e)
             break
 
     def create_ssl_connection(self, address, hostname, cache_key, getfast=None, forward=None, **kwargs):
-        def get_cache_sock(cache=None):
-            if cache is None:
-                cache = self.ssl_connection_cache.get(cache_key)
-            try:
-                while cache:
-                    ctime, ssl_sock = cache.pop()
-                    if self.check_connection_alive(ssl_sock, self.keeptime, ctime):
-                        return ssl_sock
-            except IndexError:
-                pass
+        def get_cache_sock(key=cache_key):
+            return self.ssl_connection_cache.checkout(key)
 
         def get_cache_sock_ex():
-            if cache_key is None or '|' in hostname:
+            if cache_key is None or '|' in hostname or cache_key.startswith('h2:'):
                 return
             names = hostname.split('.')
             if len(names[-1]) == 2 and len(names[-2]) <= 3:
@@ -903,13 +1067,10 @@ class HTTPUtil(BaseHTTPUtil):
                 del names[0]
             chost = '.'.join(names)
             ckey = '%s:%s' % (chost, cache_key.partition(':')[-1])
-            keys = tuple(self.ssl_connection_cache.keys())
-            for key in keys:
-                if key not in self.ssl_connection_cache or\
-                         '|' in key or not key.endswith(ckey):
+            for key in self.ssl_connection_cache.keys():
+                if '|' in key or key.startswith('h2:') or not key.endswith(ckey):
                     continue
-                cache = self.ssl_connection_cache[key]
-                sock = get_cache_sock(cache)
+                sock = get_cache_sock(key)
                 if sock:
                     if key != cache_key:
                         logging.warning(
@@ -920,6 +1081,9 @@ class HTTPUtil(BaseHTTPUtil):
                             sock.xip[0], hostname, key, chost, chost, chost, chost, chost)
                     return sock
 
+        def connect(addr, queobj, cancel):
+            self._create_ssl_connection(addr, cache_key, host, queobj, forward, get_cache_sock, cancel=cancel)
+
         sock = get_cache_sock()
         if sock:
             return sock
@@ -927,6 +1091,8 @@ class HTTPUtil(BaseHTTPUtil):
         result = None
         host, port = address
         addresses = [(x, port) for x in dns[hostname]]
+        #批量获取快速连接时同时发起连接，并缓存多余的连接
+        staged = link_attemptdelay and not (getfast and gae_testgwsiplist)
         for i in range(self.max_retry):
             addresseslen = len(addresses)
             if getfast and gae_testgwsiplist:
@@ -935,17 +1101,11 @@ class HTTPUtil(BaseHTTPUtil):
                 addrs = addresses[:autorange_threads + 1]
             else:
                 if addresseslen > self.max_window:
-                    addresses.sort(key=self.get_ssl_connection_time)
-                    window = min((self.max_window + 1)//2 + min(i, 1), addresseslen)
-                    addrs = addresses[:window] + random.sample(addresses[window:], self.max_window-window)
+                    addrs = self.pick_addresses(addresses, self.get_ssl_connection_time, i)
                 else:
                     addrs = addresses
-            queobj = Queue()
-            for addr in addrs:
-                start_new_thread(self._create_ssl_connection, (addr, cache_key, host, queobj, forward, get_cache_sock))
-            addrslen = len(addrs)
-            for n in range(addrslen):
-                result = queobj.get()
+            results = self._iter_connection(addrs, connect, self.ssl_connection_cache, cache_key, staged)
+            for n, result in enumerate(results):
                 if isinstance(result, Exception):
                     addr = result.xip
                     if addresseslen > 1:
@@ -964,9 +1124,7 @@ class HTTPUtil(BaseHTTPUtil):
                             #only output first error
                             logging.warning('%s _create_ssl_connection %r 返回 %r，重试', addr[0], host, result)
                 else:
-                    if addrslen - n > 1:
-                        cache = self.ssl_connection_cache[cache_key]
-                        start_new_thread(self._cache_connection, (cache, addrslen-n-1, queobj))
+                    results.close()
                     return result
         if result:
             raise result
@@ -1128,6 +1286,7 @@ class HTTPUtil(BaseHTTPUtil):
 #            raise e
         response = HTTPResponse(sock, method=method)
         response.begin()
+        self.save_ssl_session(sock)
 
         response.xip =  sock.xip
         response.sock = sock
@@ -1196,7 +1355,7 @@ class HTTPUtil(BaseHTTPUtil):
                     e.xip = ip
                     logging.warning('%s _request "%s %s" 失败：%r', ip[0], realmethod, realurl or url, e)
                     if realurl:
-                        self.ssl_connection_time[ip] = self.timeout + 1
+                        self.record_connection_fail(ip)
                 else:
                     logging.warning('request "%s %s" 失败：%r', realmethod, realurl or url, e)
                 if not realurl and (e.args[0] in reset_errno or (remote and e.args[0] in bypass_errno)):
@@ -1243,3 +1402,15 @@ http_gws = HTTPUtil(os.path.join(cert_dir, 'cacerts', 'gws.pem'), gws_ciphers, G
 reset_method_list.append(http_nor.clear_all_connection_cache)
 reset_method_list.append(http_cfw.clear_all_connection_cache)
 reset_method_list.append(http_gws.clear_all_connection_cache)
+
+def get_stats():
+    #连接池运行统计
+    stats = []
+    for name, http_util in (('nor', http_nor), ('cfw', http_cfw), ('gws', http_gws)):
+        for type in ('tcp', 'ssl'):
+            pool_stats = getattr(http_util, type + '_connection_cache').stats()
+            stats.append('pool %s/%s: %s' % (name, type,
+                         ', '.join('%s=%d' % kv for kv in pool_stats.items())))
+        stats.append('session %s: size=%d, hits=%d, misses=%d' % (name,
+                     len(http_util.ssl_session_cache), http_util.session_hits, http_util.session_misses))
+    return stats
@@ -11,26 +11,28 @@ import socks
 import logging
 import urllib.parse as urlparse
 from select import select
-from time import mtime, sleep
+from time import time, mtime, sleep
 from functools import partial
 from _thread import start_new_thread
 from http.server import BaseHTTPRequestHandler, SimpleHTTPRequestHandler
-from .compat.openssl import def_ciphers, SSL, SSLConnection, CertificateError
+from .compat.openssl import def_ciphers, def_ecc_ciphers, SSL, SSLConnection, CertificateError
 from .common import cert
 from .common.decompress import decompress_readers
-from .common.decorator import make_lock_decorator
 from .common.dns import reset_dns, set_dns, dns_resolve, dns, polluted_hosts
 from .common.net import (
     NetWorkIOError, reset_errno, closed_errno, bypass_errno,
-    isip, isipv4, isipv6, splitport, forward_socket, stop_all_forward )
+    isip, isipv4, isipv6, splitport, forward_socket, stop_all_forward,
+    forward_engine )
 from .common.path import web_dir
 from .common.proxy import parse_proxy, proxy_no_rdns
 from .common.region import isdirect
+from .common.snapshot import save_snapshot
 from .common.util import LRUCache, LimiterFull, message_html
 from .GlobalConfig import GC
-from .HTTPUtil import http_gws, http_nor, http_cfw, set_maxperip
-from .RangeFetch import RangeFetchs
+from .HTTPUtil import http_gws, http_nor, http_cfw, set_maxperip, get_stats
+from .RangeFetch import RangeFetchs, DirectFetcher, CFWFetcher
 from .CFWFetch import cfw_fetch
+from .HTTPCache import http_cache
 from .GAEFetch import (
     check_appid_exists, mark_badappid, make_errinfo, gae_urlfetch )
 from .FilterUtil import (
@@ -38,11 +40,11 @@ from .FilterUtil import (
     get_action, get_connect_action )
 from .FilterConfig import action_filters
 
+local_ciphers = def_ecc_ciphers if cert.sub_keytype == 'ecc' else def_ciphers
 gethttpproxy = partial(re.compile(r'^/(htt)?(ps?://)').subn, r'htt\2')
 normattachment = partial(re.compile(r'(?<=filename=)([^"\']+)').sub, r'"\1"')
 getbytes = re.compile(r'^bytes=(\d*)-(\d*)(,..)?').search
 getrange = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)').search
-_lock_context = make_lock_decorator()
 
 class AutoProxyHandler(BaseHTTPRequestHandler):
     protocol_version = 'HTTP/1.1'
@@ -74,6 +76,7 @@ class AutoProxyHandler(BaseHTTPRequestHandler):
 
     fwd_timeout = GC.LINK_FWDTIMEOUT
     fwd_keeptime = GC.LINK_FWDKEEPTIME
+    fwd_engine = GC.LINK_FWDENGINE
     listen_port = {GC.LISTEN_AUTOPORT, str(GC.LISTEN_AUTOPORT),
                    GC.LISTEN_ACTPORT, str(GC.LISTEN_ACTPORT)}
     request_compress = GC.LINK_REQUESTCOMPRESS
@@ -97,6 +100,7 @@ class AutoProxyHandler(BaseHTTPRequestHandler):
     conaborted = False
     action = ''
     target = None
+    parked = False
 
     def __init__(self, request, client_address, server):
         self.client_address = client_address
@@ -131,7 +135,40 @@ class AutoProxyHandler(BaseHTTPRequestHandler):
         try:
             self.handle()
         finally:
-            self.finish()
+            if not self.parked:
+                self.finish()
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            if self.server.parkable and self.can_park():
+                #暂停处理，等待下一个请求时不占用线程
+                self.parked = True
+                return
+            self.handle_one_request()
+
+    def resume(self):
+        #持久连接收到下一个请求，恢复处理
+        self.parked = False
+        try:
+            self.handle()
+        finally:
+            if not self.parked:
+                self.finish()
+
+    def can_park(self):
+        #只交还未加密且没有缓存后续请求数据的原始连接
+        if self.ssl_request or self.request is not self.connection or \
+                isinstance(self.request, SSLConnection):
+            return False
+        self.connection.settimeout(0)
+        try:
+            return not self.rfile.peek(1)
+        except (OSError, ValueError):
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
 
     def pick_certificate(self, connection):
         servername = connection.get_servername()
@@ -435,9 +472,8 @@ class AutoProxyHandler(BaseHTTPRequestHandler):
         logging.debug('request_headers=%s', request_headers)
         return request_headers.copy(), payload
 
-    def handle_response_headers(self, response):
-        #处理响应
-        ws_ok = self.ws and response.status == 101
+    def filter_response_headers(self, response, ws_ok=False):
+        #过滤响应头，返回响应头和 CFW 是否获取成功
         if ws_ok:
             response_headers = {k.title(): v for k, v in response.headers.items()}
             response_headers.pop('Expect-Ct', None)
@@ -445,13 +481,13 @@ class AutoProxyHandler(BaseHTTPRequestHandler):
         else:
             response_headers = {k.title(): v for k, v in response.headers.items()
                                 if k.title() not in self.skip_response_headers}
-        log =  logging.info
+        fetch_ok = True
         if self.action == 'do_CFW':
             response_headers = {k: v for k, v in response_headers.items()
                                 if not (k.startswith('Cf-') or
                                         k in ('Nel', 'Report-To', 'Server'))}
             if response_headers.pop('X-Fetch-Status', None) != 'ok':
-                log = logging.warning
+                fetch_ok = False
             else:
                 sheaders = tuple((k[7:], v) for k, v in response_headers.items()
                                  if k.startswith('Source-'))
@@ -462,6 +498,13 @@ class AutoProxyHandler(BaseHTTPRequestHandler):
             cookies = [cookie for cookie in cookies if '.workers.dev' not in cookie]
         if cookies:
             response_headers['Set-Cookie'] = '\r\nSet-Cookie: '.join(cookies)
+        return response_headers, fetch_ok
+
+    def handle_response_headers(self, response):
+        #处理响应
+        ws_ok = self.ws and response.status == 101
+        response_headers, fetch_ok = self.filter_response_headers(response, ws_ok)
+        log = logging.info if fetch_ok else logging.warning
         if ws_ok:
             data = need_chunked = None
             length = 0
@@ -543,11 +586,114 @@ class AutoProxyHandler(BaseHTTPRequestHandler):
                 self.send_504()
             return True
 
+    def check_http_cache(self, request_headers, payload):
+        #新鲜的缓存直接发送，过期的缓存添加验证信息后返回
+        if not http_cache or self.ws:
+            return None, False
+        cache = http_cache.lookup(self.command, self.url, request_headers, payload)
+        if cache is None:
+            return None, False
+        if http_cache.is_fresh(cache, request_headers):
+            self.write_http_cache(cache)
+            return cache, True
+        if not http_cache.add_conditions(cache, request_headers):
+            cache = None
+        return cache, False
+
+    def write_http_cache(self, cache):
+        #客户端条件请求匹配时返回 304
+        logging.debug('%s 使用 HTTP 缓存 "%s %s"', self.address_string(), self.command, self.url)
+        response = http_cache.make_response(cache, self.headers)
+        response, data, need_chunked, _ = self.handle_response_headers(response)
+        _, err = self.write_response_content(data, response, need_chunked)
+        if err:
+            raise err
+
+    def check_autorange(self, request_headers):
+        #根据请求判断是否使用 autorange，需要时修改首个请求的范围
+        url_parts = self.url_parts
+        #排除不支持 range 的请求
+        need_autorange = self.command != 'HEAD' and \
+                         self.action[3:] in GC.AUTORANGE_ACTIONS and \
+                         'range=' not in url_parts.query and \
+                         'range/' not in self.path and \
+                         'live=1' not in url_parts.query
+        self.range_end = range_end = range_start = 0
+        if need_autorange:
+            #匹配网址结尾
+            need_autorange = 1 if url_parts.path.endswith(GC.AUTORANGE_FAST_ENDSWITH) else 0
+            request_range = request_headers.get('Range')
+            if request_range is not None:
+                request_range = getbytes(request_range)
+                if request_range:
+                    range_start, range_end, range_other = request_range.group(1, 2, 3)
+                    if not range_start or range_other:
+                        # autorange 无法处理未指定开始范围和不连续范围
+                        range_start = 0
+                        need_autorange = 0
+                    else:
+                        range_start = int(range_start)
+                        if range_end:
+                            self.range_end = range_end = int(range_end)
+                            range_length = range_end + 1 - range_start
+                            #有明确范围时，根据阀值判断
+                            if need_autorange is 1:
+                                if range_length < self.rangesize:
+                                    need_autorange = -1
+                            else:
+                                need_autorange = 2 if range_length > GC.AUTORANGE_BIG_ONSIZE else -1
+                        else:
+                            self.range_end = range_end = 0
+                            #if need_autorange is 0:
+                            #    #非 autorange/fast 匹配
+                            #    need_autorange = 2
+            if need_autorange is 1:
+                logging.info('发现[autorange/fast]匹配：%r', self.url)
+                range_end = range_start + GC.AUTORANGE_FAST_FIRSTSIZE - 1
+            elif need_autorange is 2:
+                logging.info('发现[autorange/big]匹配：%r', self.url)
+                range_end = range_start + GC.AUTORANGE_BIG_MAXSIZE - 1
+            if need_autorange > 0:
+                request_headers['Range'] = 'bytes=%d-%d' % (range_start, range_end)
+        else:
+            need_autorange = -1
+        return need_autorange, range_start, range_end
+
+    def get_rangefetch(self, need_autorange, request_headers, payload, response, fetcher):
+        #根据首个响应判断是否开始自动多线程，用于 DIRECT、CFW
+        if need_autorange < 0 or response.status not in (200, 206):
+            return
+        content_length = response.length or 0
+        content_range = response.headers.get('Content-Range')
+        if content_range:
+            content_range = getrange(content_range)
+            #长度未知时无法使用 autorange
+            if not content_range or content_range.group(3) == '*':
+                return
+            if need_autorange is 0 and content_length > GC.AUTORANGE_BIG_ONSIZE:
+                #长度超过指定大小时启用 autorange
+                logging.info('发现[autorange/big]匹配：%r', self.url)
+                need_autorange = 2
+        elif need_autorange is 0 and \
+                response.status == 200 and \
+                response.headers.get('Accept-Ranges') == 'bytes' and \
+                content_length > GC.AUTORANGE_BIG_ONSIZE:
+            #长度超过指定大小时启用 autorange
+            logging.info('发现[autorange/big]匹配：%r', self.url)
+            response.status = 206
+            need_autorange = 2
+        if response.status == 206 and need_autorange > 0:
+            return RangeFetchs[need_autorange](self, request_headers, payload, response, fetcher)
+
     def do_DIRECT(self):
         #直接请求目标地址
         hostname = self.hostname
         http_util = http_gws if hostname.startswith('google') else http_nor
         request_headers, payload = self.handle_request_headers()
+        if self.command == 'GET' and not self.ws:
+            need_autorange, _, _ = self.check_autorange(request_headers)
+        else:
+            need_autorange = -1
         has_response = False
         for retry in range(2):
             if self.stop_retry(retry, payload, has_response):
@@ -555,6 +701,7 @@ class AutoProxyHandler(BaseHTTPRequestHandler):
             noerror = True
             response = None
             ws_ok = False
+            rangefetch = None
             self.close_connection = self.cc
             try:
                 connection_cache_key = '%s:%d' % (hostname, self.port)
@@ -588,6 +735,12 @@ class AutoProxyHandler(BaseHTTPRequestHandler):
                     logging.warning('%s do_DIRECT "%s %s" 连接被拒绝，尝试使用 "%s" 规则。',
                                     self.address_string(response), self.command, self.url, GC.LISTEN_ACT)
                     return self.go_TEMPACT()
+                #开始自动多线程
+                rangefetch = self.get_rangefetch(need_autorange, request_headers, payload, response,
+                                                 DirectFetcher(self, http_util))
+                if rangefetch:
+                    response = None
+                    return rangefetch.fetch()
                 response, data, need_chunked, ws_ok = self.handle_response_headers(response)
                 if ws_ok:
                     self.forward_websocket(response.sock)
@@ -627,7 +780,7 @@ class AutoProxyHandler(BaseHTTPRequestHandler):
                                     self.address_string(response or e), self.command, self.url, e)
                     raise e
             finally:
-                if ws_ok:
+                if ws_ok or rangefetch:
                     return
                 if not noerror or not response:
                     self.close_connection = True
@@ -637,13 +790,13 @@ class AutoProxyHandler(BaseHTTPRequestHandler):
                         #放入套接字缓存
                         if self.ssl:
                             if GC.GAE_KEEPALIVE or http_util is not http_gws:
-                                http_util.ssl_connection_cache[connection_cache_key].append((mtime(), response.sock))
+                                http_util.ssl_connection_cache.checkin(connection_cache_key, response.sock)
                             else:
                                 #干扰严重时考虑不复用 google 连接
                                 response.sock.close()
                         else:
                             response.sock.used = None
-                            http_util.tcp_connection_cache[connection_cache_key].append((mtime(), response.sock))
+                            http_util.tcp_connection_cache.checkin(connection_cache_key, response.sock)
                     else:
                         response.sock.close()
 
@@ -675,18 +828,39 @@ class AutoProxyHandler(BaseHTTPRequestHandler):
             options = {'redirect': 'true'}
         else:
             options = None
+        cache, sent = self.check_http_cache(request_headers, payload)
+        if sent:
+            return
+        if self.command == 'GET' and not self.ws:
+            need_autorange, _, _ = self.check_autorange(request_headers)
+        else:
+            need_autorange = -1
         for retry in range(GC.CFW_FETCHMAX):
             if self.stop_retry(retry, payload, has_response):
                 return
             noerror = True
             response = None
             ws_ok = False
+            rangefetch = None
             self.close_connection = self.cc
             try:
+                request_time = time()
                 response = cfw_fetch(self.command, self.host, self.url, request_headers, payload, options)
                 if not response:
                     continue
                 has_response = True
+                if http_cache and response.headers.get('X-Fetch-Status') == 'ok':
+                    if cache and response.status == 304:
+                        #缓存验证成功
+                        self.write_http_cache(http_cache.update(cache, response, request_time))
+                        return
+                    http_cache.store(self.command, self.url, request_headers, payload, response, request_time)
+                #开始自动多线程
+                rangefetch = self.get_rangefetch(need_autorange, request_headers, payload, response,
+                                                 CFWFetcher(self, options))
+                if rangefetch:
+                    response = None
+                    return rangefetch.fetch()
                 response, data, need_chunked, ws_ok = self.handle_response_headers(response)
                 if ws_ok:
                     self.forward_websocket(response.sock)
@@ -704,7 +878,7 @@ class AutoProxyHandler(BaseHTTPRequestHandler):
                                     self.address_string(response or e), self.command, self.url, e)
                     raise e
             finally:
-                if ws_ok:
+                if ws_ok or rangefetch:
                     return
                 if not has_response and retry + 1 == GC.CFW_FETCHMAX:
                     return self.send_504()
@@ -713,7 +887,7 @@ class AutoProxyHandler(BaseHTTPRequestHandler):
                 if response:
                     response.close()
                     if noerror and GC.CFW_KEEPALIVE:
-                        response.http_util.ssl_connection_cache[response.connection_cache_key].append((mtime(), response.sock))
+                        response.http_util.ssl_connection_cache.checkin(response.connection_cache_key, response.sock)
                     else:
                         response.sock.close()
 
@@ -731,50 +905,10 @@ class AutoProxyHandler(BaseHTTPRequestHandler):
             return
         if self.command == 'OPTIONS':
             return self.fake_OPTIONS(request_headers)
-        #排除不支持 range 的请求
-        need_autorange = self.command != 'HEAD' and \
-                         'range=' not in url_parts.query and \
-                         'range/' not in self.path and \
-                         'live=1' not in url_parts.query
-        self.range_end = range_end = range_start = 0
-        if need_autorange:
-            #匹配网址结尾
-            need_autorange = 1 if url_parts.path.endswith(GC.AUTORANGE_FAST_ENDSWITH) else 0
-            request_range = request_headers.get('Range')
-            if request_range is not None:
-                request_range = getbytes(request_range)
-                if request_range:
-                    range_start, range_end, range_other = request_range.group(1, 2, 3)
-                    if not range_start or range_other:
-                        # autorange 无法处理未指定开始范围和不连续范围
-                        range_start = 0
-                        need_autorange = 0
-                    else:
-                        range_start = int(range_start)
-                        if range_end:
-                            self.range_end = range_end = int(range_end)
-                            range_length = range_end + 1 - range_start
-                            #有明确范围时，根据阀值判断
-                            if need_autorange is 1:
-                                if range_length < self.rangesize:
-                                    need_autorange = -1
-                            else:
-                                need_autorange = 2 if range_length > GC.AUTORANGE_BIG_ONSIZE else -1
-                        else:
-                            self.range_end = range_end = 0
-                            #if need_autorange is 0:
-                            #    #非 autorange/fast 匹配
-                            #    need_autorange = 2
-            if need_autorange is 1:
-                logging.info('发现[autorange/fast]匹配：%r', self.url)
-                range_end = range_start + GC.AUTORANGE_FAST_FIRSTSIZE - 1
-            elif need_autorange is 2:
-                logging.info('发现[autorange/big]匹配：%r', self.url)
-                range_end = range_start + GC.AUTORANGE_BIG_MAXSIZE - 1
-            if need_autorange > 0:
-                request_headers['Range'] = 'bytes=%d-%d' % (range_start, range_end)
-        else:
-            need_autorange = -1
+        cache, sent = self.check_http_cache(request_headers, payload)
+        if sent:
+            return
+        need_autorange, range_start, range_end = self.check_autorange(request_headers)
         errors = []
         headers_sent = False
         need_chunked = False
@@ -793,6 +927,7 @@ class AutoProxyHandler(BaseHTTPRequestHandler):
             response = None
             self.close_connection = self.cc
             try:
+                request_time = time()
                 response = gae_urlfetch(self.command, self.url, request_headers, payload)
                 last_response = response or last_response
                 if response is None:
@@ -891,6 +1026,12 @@ class AutoProxyHandler(BaseHTTPRequestHandler):
                         response, data, need_chunked, _ = self.handle_response_headers(response)
                         self.write_response_content(data, response, need_chunked)
                     return
+                if http_cache and not headers_sent:
+                    if cache and response.status == 304:
+                        #缓存验证成功
+                        self.write_http_cache(http_cache.update(cache, response, request_time))
+                        return
+                    http_cache.store(self.command, self.url, request_headers, payload, response, request_time)
                 #发生异常时的判断条件，放在 read 操作之前
                 content_range = response.headers.get('Content-Range')
                 accept_ranges = response.headers.get('Accept-Ranges')
@@ -997,7 +1138,7 @@ class AutoProxyHandler(BaseHTTPRequestHandler):
                     response.close()
                     if noerror and GC.GAE_KEEPALIVE:
                         #放入套接字缓存
-                        response.http_util.ssl_connection_cache[response.connection_cache_key].append((mtime(), response.sock))
+                        response.http_util.ssl_connection_cache.checkin(response.connection_cache_key, response.sock)
                     else:
                         #干扰严重时考虑不复用
                         response.sock.close()
@@ -1079,7 +1220,11 @@ class AutoProxyHandler(BaseHTTPRequestHandler):
         else:
             logging.info('%s "FWD %s %s HTTP/1.1" - -',
                          self.address_string(remote), self.command, self.url)
-        if self.forward_connect(remote) and host in polluted_hosts:
+        self.forward_connect(remote, reset_callback=partial(self.set_polluted_fakesni, host))
+
+    def set_polluted_fakesni(self, host):
+        #转发被重置时将受污染的主机加入伪造 SNI 规则
+        if host in polluted_hosts:
             host = 'https://' + host
             if set_temp_fakesni(host):
                 logging.warning('将 %r 加入 "FAKESNI" 规则。', host)
@@ -1134,6 +1279,7 @@ class AutoProxyHandler(BaseHTTPRequestHandler):
                          self.address_string(), proxyip, proxyport, self.command, self.url or self.path, proxytype, self.target)
             proxy_sock.xip = proxyip, proxyport
             self.forward_connect(proxy_sock)
+            return
 
     def do_REDIRECT(self):
         #重定向到目标地址
@@ -1460,7 +1606,7 @@ class AutoProxyHandler(BaseHTTPRequestHandler):
                           self.address_string(remote), self.url)
             self.close_connection = True
 
-    def forward_connect(self, remote, timeout=0, tick=4, bufsize=32768, maxping=None, maxpong=None):
+    def forward_connect(self, remote, timeout=0, tick=4, bufsize=32768, maxping=None, maxpong=None, reset_callback=None):
         #在本地与远程连接间进行数据转发
         payload = None
         if self.command != 'CONNECT':
@@ -1483,10 +1629,21 @@ class AutoProxyHandler(BaseHTTPRequestHandler):
             #已经使用 MSG_PEEK 预读过一次<<加密连接>>
             # select 无法获取这次的可读状态，故先读取出来
             payload = self.connection.recv(65536)
+        if self.command != 'CONNECT':
+            reset_callback = None
+        if self.fwd_engine and forward_engine.forward(self.connection, remote, payload,
+                timeout or self.fwd_keeptime, tick, maxping, maxpong, reset_callback):
+            #转发引擎接管连接，释放当前线程
+            logging.debug('%s 转发交由转发引擎处理："%s"',
+                          self.address_string(remote), self.url or self.host)
+            self.close_connection = True
+            return
         try:
             forward_socket(self.connection, remote, payload, timeout or self.fwd_keeptime, tick, bufsize, maxping, maxpong)
         except ConnectionResetError:
             if self.command == 'CONNECT':
+                if reset_callback:
+                    reset_callback()
                 return True
             else:
                 raise
@@ -1501,7 +1658,6 @@ class AutoProxyHandler(BaseHTTPRequestHandler):
             #必须在这里设置关闭，前面关闭不起作用，但是中间并没有设置过不关闭？
             self.close_connection = True
 
-    @_lock_context
     def get_context(self, servername=None, callback=lambda *x: 1):
         #维护一个 ssl context 缓存
         host = servername or self.host
@@ -1515,7 +1671,8 @@ class AutoProxyHandler(BaseHTTPRequestHandler):
         try:
             return self.context_cache[host]
         except KeyError:
-            certfile, expire = cert.get_cert(host, ip)
+            #证书签署由 cert 模块按主机合并，不同主机可以同时进行
+            subcert, expire = cert.get_cert(host, ip)
             ssl_method = GC.LINK_LOCALSSL
             ssl_options = 0
             #使用兼容模式来指定 TLSv1.3
@@ -1533,12 +1690,12 @@ class AutoProxyHandler(BaseHTTPRequestHandler):
             #通用问题修复
             ssl_options |= SSL.OP_ALL
             #假证书
-            context.use_privatekey_file(cert.sub_keyfile)
-            context.use_certificate_file(certfile)
+            context.use_privatekey(cert.sub_privatekey)
+            context.use_certificate(subcert)
             #无客户端验证
             context.set_verify(SSL.VERIFY_NONE, callback)
             #加密选择
-            context.set_cipher_list(def_ciphers)
+            context.set_cipher_list(local_ciphers)
             ssl_options |= SSL.OP_CIPHER_SERVER_PREFERENCE
             #会话重用
             context.set_session_id(os.urandom(16))
@@ -1564,6 +1721,7 @@ class AutoProxyHandler(BaseHTTPRequestHandler):
 
     def do_CMD(self):
         exit = None
+        content = None
         reqs = urlparse.parse_qs(self.url_parts.query)
         cmd = reqs['cmd'][0] #只接受第一个命令
         if cmd == 'reset_cacerts':
@@ -1580,15 +1738,27 @@ class AutoProxyHandler(BaseHTTPRequestHandler):
         elif cmd == 'reset_autorule_cache':
             #重置自动规则缓存
             action_filters.reset = True
+        elif cmd == 'show_stats':
+            #显示运行统计
+            content = '\n'.join(get_stats()).encode()
         elif cmd in ('quit', 'exit', 'off', 'close', 'shutdown'):
             #关闭退出
             exit = True
         self.close_connection = False
-        self.write('HTTP/1.1 204 No Content\r\n'
-                   'Content-Length: 0\r\n\r\n')
-        logging.warning('%s "%s %s HTTP/1.1" 204 0，GotoX 命令 [%s] 执行完毕。',
-                        self.address_string(), self.command, self.url, cmd)
+        if content:
+            self.write(b'HTTP/1.1 200 Ok\r\n'
+                       b'Content-Type: text/plain; charset=utf-8\r\n'
+                       b'Content-Length: %d\r\n\r\n' % len(content))
+            self.write(content)
+            logging.warning('%s "%s %s HTTP/1.1" 200 %d，GotoX 命令 [%s] 执行完毕。',
+                            self.address_string(), self.command, self.url, len(content), cmd)
+        else:
+            self.write('HTTP/1.1 204 No Content\r\n'
+                       'Content-Length: 0\r\n\r\n')
+            logging.warning('%s "%s %s HTTP/1.1" 204 0，GotoX 命令 [%s] 执行完毕。',
+                            self.address_string(), self.command, self.url, cmd)
         if exit:
+            save_snapshot()
             os._exit(0)
 
     def log_error(self, format, *args):
@@ -4,11 +4,14 @@ import sys
 import socket
 import logging
 import socketserver
+import selectors
+import threading
+from time import mtime
 from _thread import start_new_thread
 from .common.decorator import sole_invoked
 from .common.dns import reset_dns
 from .common.internet_active import is_active, internet_v4, internet_v6
-from .common.net import NetWorkIOError, bypass_errno
+from .common.net import NetWorkIOError, bypass_errno, forward_engine
 from .common.proxy import get_listen_ip
 from .common.util import wait_exit
 from .GlobalConfig import GC
@@ -79,6 +82,8 @@ class LocalProxyServer(socketserver.TCPServer):
     '''Local Proxy Server'''
     request_queue_size = 192
     is_offline = True
+    #是否在请求间隙交还持久连接
+    parkable = False
 
     def __init__(self, server_address, RequestHandlerClass):
         socketserver.BaseServer.__init__(self, server_address, RequestHandlerClass)
@@ -121,6 +126,11 @@ class LocalProxyServer(socketserver.TCPServer):
             del exc_info, error
             super().handle_error(*args)
 
+    def shutdown_request(self, request):
+        #由转发引擎接管的连接由转发引擎关闭
+        if request not in forward_engine:
+            socketserver.TCPServer.shutdown_request(self, request)
+
     def process_request_thread(self, request, client_address):
         try:
             self.finish_request(request, client_address)
@@ -135,12 +145,134 @@ class LocalProxyServer(socketserver.TCPServer):
     def process_request(self, request, client_address):
         start_new_thread(self.process_request_thread, (request, client_address))
 
+class SelectorProxyServer(LocalProxyServer):
+    '''Local Proxy Server, idle connections are waited in a selector loop'''
+    parkable = True
+    #检查空闲连接超时的间隔
+    tick = 4
+
+    def __init__(self, server_address, RequestHandlerClass):
+        LocalProxyServer.__init__(self, server_address, RequestHandlerClass)
+        self.pending_lock = threading.Lock()
+        self.pending_requests = []
+        self.waker_w = None
+
+    def bind_and_activate(self):
+        LocalProxyServer.bind_and_activate(self)
+        #新连接和请求间隙的持久连接都在这里等待，可读后才分配线程处理
+        waker, self.waker_w = socket.socketpair()
+        waker.setblocking(False)
+        self.pending_requests = []
+        start_new_thread(self.serve_requests, (waker, self.waker_w, self.pending_requests))
+
+    def server_close(self):
+        LocalProxyServer.server_close(self)
+        self.wakeup()
+
+    def wakeup(self):
+        try:
+            self.waker_w.send(b'\0')
+        except OSError:
+            pass
+
+    def wait_request(self, request, client_address, handler=None):
+        with self.pending_lock:
+            is_offline = self.is_offline
+            if not is_offline:
+                self.pending_requests.append((request, client_address, handler))
+        if is_offline:
+            self.close_request_handler(request, handler)
+        else:
+            self.wakeup()
+
+    def serve_requests(self, waker, waker_w, pending_requests):
+        selector = selectors.DefaultSelector()
+        selector.register(waker, selectors.EVENT_READ)
+        next_check = mtime() + self.tick
+        try:
+            while not self.is_offline:
+                for key, _ in selector.select(self.tick):
+                    if key.fileobj is waker:
+                        try:
+                            while waker.recv(1024):
+                                pass
+                        except OSError:
+                            pass
+                        continue
+                    selector.unregister(key.fileobj)
+                    request, client_address, handler, _ = key.data
+                    start_new_thread(self.process_request_thread, (request, client_address, handler))
+                with self.pending_lock:
+                    requests = pending_requests[:]
+                    del pending_requests[:]
+                for request, client_address, handler in requests:
+                    timeout = handler.timeout if handler else self.RequestHandlerClass.timeout
+                    try:
+                        selector.register(request, selectors.EVENT_READ,
+                                          (request, client_address, handler, mtime() + timeout))
+                    except (ValueError, OSError):
+                        self.close_request_handler(request, handler)
+                now = mtime()
+                if now > next_check:
+                    next_check = now + self.tick
+                    #关闭超时的空闲连接
+                    for key in list(selector.get_map().values()):
+                        if key.fileobj is not waker and key.data[3] < now:
+                            selector.unregister(key.fileobj)
+                            self.close_request_handler(key.data[0], key.data[2])
+        finally:
+            for key in list(selector.get_map().values()):
+                if key.fileobj is not waker:
+                    self.close_request_handler(key.data[0], key.data[2])
+            with self.pending_lock:
+                requests = pending_requests[:]
+                del pending_requests[:]
+            for request, _, handler in requests:
+                self.close_request_handler(request, handler)
+            selector.close()
+            waker.close()
+            waker_w.close()
+
+    def close_request_handler(self, request, handler):
+        if handler:
+            try:
+                handler.finish()
+            except:
+                pass
+        self.shutdown_request(request)
+
+    def process_request_thread(self, request, client_address, handler=None):
+        try:
+            if handler:
+                handler.resume()
+            else:
+                handler = self.RequestHandlerClass(request, client_address, self)
+        except NetWorkIOError as e:
+            if e.args[0] not in bypass_errno:
+                self.handle_error(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            if handler and handler.parked:
+                #请求处理完毕，将持久连接交还选择器循环等待下一个请求
+                self.wait_request(request, client_address, handler)
+            else:
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        self.wait_request(request, client_address)
+
+if GC.LISTEN_SERVERMODE == 'selector':
+    ProxyServer = SelectorProxyServer
+else:
+    ProxyServer = LocalProxyServer
+
 from .ProxyHandler import AutoProxyHandler, ACTProxyHandler
 
 if GC.LISTEN_AUTH > 0:
     from .ProxyAuthHandler import AutoProxyAuthHandler, ACTProxyAuthHandler
-    AutoProxy = LocalProxyServer((GC.LISTEN_IP, GC.LISTEN_AUTOPORT), AutoProxyAuthHandler)
-    GAEProxy = LocalProxyServer((GC.LISTEN_IP, GC.LISTEN_ACTPORT), ACTProxyAuthHandler)
+    AutoProxy = ProxyServer((GC.LISTEN_IP, GC.LISTEN_AUTOPORT), AutoProxyAuthHandler)
+    GAEProxy = ProxyServer((GC.LISTEN_IP, GC.LISTEN_ACTPORT), ACTProxyAuthHandler)
 else:
-    AutoProxy = LocalProxyServer((GC.LISTEN_IP, GC.LISTEN_AUTOPORT), AutoProxyHandler)
-    GAEProxy = LocalProxyServer((GC.LISTEN_IP, GC.LISTEN_ACTPORT), ACTProxyHandler)
+    AutoProxy = ProxyServer((GC.LISTEN_IP, GC.LISTEN_AUTOPORT), AutoProxyHandler)
+    GAEProxy = ProxyServer((GC.LISTEN_IP, GC.LISTEN_ACTPORT), ACTProxyHandler)
@@ -0,0 +1,241 @@
+# coding:utf-8
+'''Range Cache，在磁盘上保存 autorange 下载的分段'''
+
+import os
+import marshal
+import hashlib
+import logging
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+from .GlobalConfig import GC
+
+cache_version = 1
+
+def get_cache_key(url, headers, length):
+    #以网址和验证信息作为键值，内容变化后会使用新的缓存
+    #弱 ETag 不保证字节一致，不能用于分段
+    etag = headers.get('Etag')
+    if etag and etag.startswith('W/'):
+        etag = None
+    last_modified = headers.get('Last-Modified')
+    if not (etag or last_modified):
+        return
+    key = '\n'.join((url, etag or '', last_modified or '',
+                     headers.get('Content-Encoding', ''), str(length)))
+    return hashlib.sha1(key.encode()).hexdigest()
+
+class RangeCacheEntry:
+    #一个文件的缓存，数据保存在同样大小的稀疏文件中
+    #starts、ends 为已保存的分段，分段互不相邻、按顺序排列
+
+    def __init__(self, cache, key, url, length):
+        self.cache = cache
+        self.key = key
+        self.url = url
+        self.length = length
+        self.file = os.path.join(cache.dir, key)
+        self.lock = threading.Lock()
+        self.refs = 0
+        self.fd = None
+        self.starts = []
+        self.ends = []
+
+    @property
+    def size(self):
+        return sum(self.ends) - sum(self.starts)
+
+    def open(self):
+        try:
+            with open(self.file + '.idx', 'rb') as fd:
+                version, url, length, starts, ends = marshal.load(fd)
+            if version == cache_version and url == self.url and length == self.length:
+                self.starts = list(starts)
+                self.ends = list(ends)
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+        try:
+            if self.starts and os.path.getsize(self.file) == self.length:
+                self.fd = open(self.file, 'r+b')
+            else:
+                self.starts = []
+                self.ends = []
+                self.fd = open(self.file, 'w+b')
+                self.fd.truncate(self.length)
+        except OSError as e:
+            logging.warning('打开分段缓存 %r 失败：%r', self.file, e)
+            self.fd = None
+            self.starts = []
+            self.ends = []
+
+    def close(self):
+        with self.lock:
+            fd, self.fd = self.fd, None
+            if fd is None:
+                return
+            fd.close()
+            data = cache_version, self.url, self.length, tuple(self.starts), tuple(self.ends)
+            try:
+                with open(self.file + '.idx', 'wb') as f:
+                    marshal.dump(data, f)
+            except OSError as e:
+                logging.warning('保存分段缓存索引 %r 失败：%r', self.file, e)
+
+    def cached(self, pos):
+        #返回从 pos 开始连续保存的字节数
+        i = bisect_right(self.starts, pos) - 1
+        if i >= 0 and self.ends[i] > pos:
+            return self.ends[i] - pos
+        return 0
+
+    def next_missing(self, pos):
+        #返回 pos 及其后第一个未保存的位置
+        return pos + self.cached(pos)
+
+    def next_cached(self, pos):
+        #返回 pos 之后第一个已保存分段的开始位置
+        i = bisect_right(self.starts, pos)
+        if i < len(self.starts):
+            return self.starts[i]
+        return self.length
+
+    def read(self, pos, size):
+        with self.lock:
+            size = min(self.cached(pos), size)
+            if size <= 0 or self.fd is None:
+                return
+            try:
+                self.fd.seek(pos)
+                return self.fd.read(size)
+            except OSError as e:
+                logging.warning('读取分段缓存 %r 失败：%r', self.file, e)
+
+    def write(self, pos, data):
+        with self.lock:
+            if self.fd is None:
+                return
+            try:
+                self.fd.seek(pos)
+                self.fd.write(data)
+            except OSError as e:
+                logging.warning('写入分段缓存 %r 失败：%r', self.file, e)
+                self.fd.close()
+                self.fd = None
+                self.starts = []
+                self.ends = []
+                return
+            self.add_segment(pos, pos + len(data))
+
+    def add_segment(self, begin, end):
+        #合并重叠和相邻的分段
+        starts = self.starts
+        ends = self.ends
+        i = bisect_right(ends, begin - 1)
+        j = bisect_right(starts, end)
+        if i < j:
+            begin = min(begin, starts[i])
+            end = max(end, ends[j - 1])
+        starts[i:j] = [begin]
+        ends[i:j] = [end]
+
+class RangeCache:
+    #按最近使用顺序在总大小超过预算时删除文件，正在使用的文件不会被删除
+    #文件按完整长度预先分配，不支持稀疏文件的文件系统（如 FAT、exFAT）会实际占用全部空间，
+    #所以预算按文件长度而不是已保存的大小计算
+
+    def __init__(self, dir, max_size):
+        self.dir = dir
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.sizes = OrderedDict()
+        self.total = 0
+        self.load_index()
+
+    def load_index(self):
+        try:
+            os.makedirs(self.dir, exist_ok=True)
+            names = os.listdir(self.dir)
+        except OSError as e:
+            logging.warning('载入分段缓存目录 %r 失败：%r', self.dir, e)
+            return
+        files = []
+        for name in names:
+            if not name.endswith('.idx'):
+                continue
+            file = os.path.join(self.dir, name)
+            try:
+                with open(file, 'rb') as fd:
+                    _, _, length, _, _ = marshal.load(fd)
+                files.append((os.path.getmtime(file), name[:-4], length))
+            except (OSError, EOFError, ValueError, TypeError):
+                self.remove(name[:-4])
+        #没有索引的数据文件无法使用
+        keys = set(key for _, key, _ in files)
+        for name in names:
+            if '.' not in name and name not in keys:
+                self.remove(name)
+        for _, key, size in sorted(files):
+            self.sizes[key] = size
+            self.total += size
+        self.evict()
+
+    def remove(self, key):
+        file = os.path.join(self.dir, key)
+        for file in (file, file + '.idx'):
+            try:
+                os.remove(file)
+            except OSError:
+                pass
+
+    def evict(self):
+        for key in list(self.sizes):
+            if self.total <= self.max_size:
+                break
+            if key in self.entries:
+                continue
+            self.total -= self.sizes.pop(key)
+            self.remove(key)
+            logging.debug('删除分段缓存 %s', key)
+
+    def open(self, url, headers, length):
+        key = get_cache_key(url, headers, length)
+        if key is None:
+            return
+        if length > self.max_size:
+            return
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                if key not in self.sizes:
+                    #先删除其它文件腾出预算，正在使用的文件过多时不缓存
+                    self.total += length
+                    self.evict()
+                    if self.total > self.max_size:
+                        self.total -= length
+                        return
+                    self.sizes[key] = length
+                entry = RangeCacheEntry(self, key, url, length)
+                entry.open()
+                if entry.fd is None:
+                    self.total -= self.sizes.pop(key)
+                    self.remove(key)
+                    return
+                self.entries[key] = entry
+            self.sizes.move_to_end(key)
+            entry.refs += 1
+            return entry
+
+    def release(self, entry):
+        with self.lock:
+            entry.refs -= 1
+            if entry.refs:
+                return
+            del self.entries[entry.key]
+            entry.close()
+            self.evict()
+
+if GC.AUTORANGE_CACHE_ENABLE:
+    range_cache = RangeCache(GC.AUTORANGE_CACHE_DIR, GC.AUTORANGE_CACHE_SIZE)
+else:
+    range_cache = None
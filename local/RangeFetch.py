@@ -3,30 +3,215 @@
 
 
 import re
-import queue
 import random
 import logging
 import threading
 from time import mtime, sleep
 from urllib.parse import urljoin
-from .common.util import LimiterFull, spawn_later
+from .common.util import LimiterFull, LRUCache, spawn_later
 from .GAEFetch import mark_badappid, gae_urlfetch
+from .CFWFetch import cfw_fetch
+from .RangeCache import range_cache
 from .GlobalConfig import GC
 from .GIPManager import ip_manager_gae
 
 getrange = re.compile(r'bytes (\d+)-(\d+)/(\d+)').search
+#各 IP 的下载速度，字节/秒
+ip_speeds = LRUCache(1024)
 
-class RangeFetch:
-    '''Range Fetch Class'''
+def record_ip_speed(ip, speed):
+    #指数加权平均
+    old_speed = ip_speeds.get(ip)
+    if old_speed:
+        speed = old_speed * 0.7 + speed * 0.3
+    ip_speeds[ip] = speed
+
+class RangeTask:
+    #一个下载范围，pos 为下一个需要的字节，end 可能因被分割而缩小
+    __slots__ = 'pos', 'end', 'fetchers', 'hedged'
+
+    def __init__(self, begin, end):
+        self.pos = begin
+        self.end = end
+        self.fetchers = 0
+        self.hedged = False
+
+class RangeBuffer:
+    #按偏移保存已下载的数据块，写入线程在下一个连续数据块到达时被唤醒
+    #缓存数据超过预算时，超前的下载线程等待写入线程消耗数据
+    # reader 用于从磁盘缓存读取下一个数据块
+
+    def __init__(self, begin, window, budget, reader=None):
+        self.cond = threading.Condition()
+        self.chunks = {}
+        self.expect_begin = begin
+        self.window = window
+        self.budget = budget
+        self.reader = reader
+        self.size = 0
+        self.stopped = False
+
+    def put(self, begin, data):
+        with self.cond:
+            self._put(begin, data)
+
+    def _put(self, begin, data):
+        #已写入或重复的数据直接丢弃
+        if begin < self.expect_begin:
+            data = data[self.expect_begin - begin:]
+            begin = self.expect_begin
+            if not data:
+                return
+        if begin in self.chunks:
+            return
+        self.chunks[begin] = data
+        self.size += len(data)
+        if begin == self.expect_begin:
+            self.cond.notify_all()
+
+    def get(self, timeout):
+        #返回下一个连续数据块，超时或停止时返回 None
+        with self.cond:
+            endtime = mtime() + timeout
+            while True:
+                data = self.chunks.pop(self.expect_begin, None)
+                if data is not None:
+                    self.size -= len(data)
+                elif self.reader:
+                    data = self.reader(self.expect_begin)
+                if data:
+                    self.expect_begin += len(data)
+                    if self.reader:
+                        self._trim()
+                    self.cond.notify_all()
+                    return data
+                if self.stopped:
+                    return
+                timeleft = endtime - mtime()
+                if timeleft <= 0:
+                    return
+                self.cond.wait(timeleft)
+
+    def _trim(self):
+        #从磁盘读取的数据可能与已下载的数据重叠
+        for begin in [begin for begin in self.chunks if begin < self.expect_begin]:
+            data = self.chunks.pop(begin)
+            self.size -= len(data)
+            self._put(begin, data)
+
+    def wait_room(self, begin):
+        #限制超前下载，停止时返回 False
+        with self.cond:
+            while begin - self.expect_begin > self.window and \
+                    self.size > self.budget and not self.stopped:
+                self.cond.wait()
+            return not self.stopped
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.chunks.clear()
+            self.size = 0
+            self.cond.notify_all()
+
+class RangeFetcher:
+    #分段请求的来源，子类实现 urlfetch(command, url, headers, payload, timeout)，
+    #返回的响应需带有 xip、http_util、connection_cache_key 属性
+    #iplist 为 None 时不限制响应 IP，delable 为真时移除慢速和故障 IP
+
+    delable = False
+    redirect = True
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    def last_update(self):
+        return 0
+
+    def get_iplist(self):
+        return None
+
+    def check_response(self, response, url, headers):
+        return True
+
+    def checkin(self, response):
+        #放入套接字缓存
+        response.http_util.ssl_connection_cache.checkin(response.connection_cache_key, response.sock)
+
+class GAEFetcher(RangeFetcher):
 
     delable = GC.GAE_TESTGWSIPLIST
 
-    def __init__(self, handler, headers, payload, response):
+    def last_update(self):
+        return ip_manager_gae.last_update
+
+    def get_iplist(self):
+        return GC.IPLIST_MAP['google_gae'].copy()
+
+    def urlfetch(self, command, url, headers, payload, timeout):
+        return gae_urlfetch(command, url, headers, payload, getfast=timeout)
+
+    def check_response(self, response, url, headers):
+        if response.app_status == 503:
+            if hasattr(response, 'appid'):
+                mark_badappid(response.appid)
+            return False
+        elif response.app_status != 200:
+            logging.warning('%s Range Fetch "%s %s" %s 返回 %s', self.handler.address_string(response), self.handler.command, url, headers['Range'], response.app_status)
+            return False
+        return True
+
+class DirectFetcher(RangeFetcher):
+
+    #直连请求使用原始请求路径，无法跟随跳转
+    redirect = False
+
+    def __init__(self, handler, http_util):
+        self.handler = handler
+        self.http_util = http_util
+        self.connection_cache_key = '%s:%d' % (handler.hostname, handler.port)
+
+    def urlfetch(self, command, url, headers, payload, timeout):
+        response = self.http_util.request(self.handler, payload, headers, self.handler.bufsize, self.connection_cache_key, getfast=timeout)
+        if response:
+            response.http_util = self.http_util
+            response.connection_cache_key = self.connection_cache_key
+        return response
+
+    def checkin(self, response):
+        if self.handler.ssl:
+            RangeFetcher.checkin(self, response)
+        else:
+            response.sock.used = None
+            self.http_util.tcp_connection_cache.checkin(self.connection_cache_key, response.sock)
+
+class CFWFetcher(RangeFetcher):
+
+    def __init__(self, handler, options=None):
+        self.handler = handler
+        self.options = options
+
+    def urlfetch(self, command, url, headers, payload, timeout):
+        return cfw_fetch(command, self.handler.host, url, headers, payload, self.options)
+
+    def checkin(self, response):
+        if GC.CFW_KEEPALIVE:
+            RangeFetcher.checkin(self, response)
+        else:
+            response.sock.close()
+
+class RangeFetch:
+    '''Range Fetch Class'''
+
+    def __init__(self, handler, headers, payload, response, fetcher=None):
         self.tLock = threading.Lock()
-        self.expect_begin = 0
+        self.buffer = None
+        self.cache = None
         self._stopped = False
-        self.lastupdate = ip_manager_gae.last_update
-        self.iplist = GC.IPLIST_MAP['google_gae'].copy()
+        self.fetcher = fetcher = fetcher or GAEFetcher(handler)
+        self.delable = fetcher.delable
+        self.lastupdate = fetcher.last_update()
+        self.iplist = fetcher.get_iplist()
 
         self.handler = handler
         self.write = handler.wfile.write
@@ -43,7 +228,8 @@ class RangeFetch:
         isRangeFetchBig = self.__class__ is RangeFetchBig
         response = self.response
         response_status = response.status
-        response_headers = {k.title(): v for k, v in response.headers.items()}
+        #与普通响应相同的过滤，DIRECT、CFW 的响应中包含不能转发的头部
+        response_headers, _ = self.handler.filter_response_headers(response)
         if 'Content-Range' in response_headers:
             start, end, length = tuple(int(x) for x in getrange(response_headers['Content-Range']).group(1, 2, 3))
             content_length = end + 1 - start
@@ -74,82 +260,189 @@ class RangeFetch:
             return
         logging.info('%s >>>> RangeFetch 开始 %r %d-%d', self.address_string(response), self.url, start, range_end)
 
-        data_queue = queue.PriorityQueue()
-        range_queue = queue.PriorityQueue()
+        #已保存在磁盘缓存中的部分直接读取，只下载缺少的部分
+        self.cache = cache = range_cache and range_cache.open(self.url, response_headers, _end + 1)
+        if cache and cache.starts:
+            logging.info('%s RangeFetch 使用磁盘缓存 %r，已保存 %d 字节', self.address_string(), self.url, cache.size)
+
+        #按字节计算的缓存预算
+        self.buffer = buffer = RangeBuffer(start, self.threads * self.delaysize,
+                                           3 * self.threads * self.delaysize,
+                                           cache and self.read_cache)
+        #未分配的范围从 next_begin 开始按需切分，大小由 IP 的下载速度决定
+        self.length = length
+        self.next_begin = end + 1
+        self.tasks = []
+        self.retry_tasks = []
+        self.blocking = None
+        self.blockpos = None
         if self.response is not None:
-            self.firstrange = start, end
-        # py2 弃用，xrange 参数太大时会出错，range 不出错但耗时太多
-        #for begin in range(end+1, length, self.maxsize):
-        #    range_queue.put((begin, min(begin+self.maxsize-1, length-1)))
-        a = end + 1
-        b = end
-        n = (length - a) // self.maxsize
-        for _ in range(n):
-            b += self.maxsize
-            range_queue.put((a, b))
-            a = b + 1
-        if length > a:
-            range_queue.put((a, length - 1))
+            self.firsttask = self.new_task(start, end)
 
         for i in range(self.threads):
             if isRangeFetchBig:
-                spawn_later(self.sleeptime * i if i else 0, self.__fetchlet, range_queue, data_queue, i + 1)
+                spawn_later(self.sleeptime * i if i else 0, self.__fetchlet, buffer, i + 1)
             else:
-                spawn_later(self.sleeptime / i if i else 0, self.__fetchlet, range_queue, data_queue, i + 1)
-        has_peek = hasattr(data_queue, 'peek')
+                spawn_later(self.sleeptime / i if i else 0, self.__fetchlet, buffer, i + 1)
         peek_timeout = 30
-        self.expect_begin = start
-        while self.expect_begin < length:
-            try:
-                if has_peek:
-                    begin, data = data_queue.peek(timeout=peek_timeout)
-                    if self.expect_begin == begin:
-                        data_queue.get()
-                    elif self.expect_begin < begin:
-                        sleep(0.1)
-                        continue
-                    else:
-                        logging.error('%s RangeFetch 错误：begin(%r) < expect_begin(%r)，退出', self.address_string(), begin, self.expect_begin)
-                        break
-                else:
-                    begin, data = data_queue.get(timeout=peek_timeout)
-                    if self.expect_begin == begin:
-                        pass
-                    elif self.expect_begin < begin:
-                        data_queue.put((begin, data))
-                        sleep(0.1)
-                        continue
-                    else:
-                        logging.error('%s RangeFetch 错误：begin(%r) < expect_begin(%r)，退出', self.address_string(), begin, self.expect_begin)
-                        break
-            except queue.Empty:
-                logging.error('%s data_queue peek 超时，break', self.address_string())
-                break
+        wait_timeout = min(self.hedgetime / 2 or peek_timeout, peek_timeout)
+        waittime = 0
+        while buffer.expect_begin < length:
+            data = buffer.get(wait_timeout)
+            if self.hedgetime:
+                #阻塞写入的范围下载过慢，同时使用另一个线程下载
+                self.hedge_task()
+            if data is None:
+                waittime += wait_timeout
+                if waittime >= peek_timeout or buffer.stopped:
+                    logging.error('%s RangeFetch 等待数据超时，break', self.address_string())
+                    break
+                continue
+            waittime = 0
             try:
                 self.write(data)
-                self.expect_begin += len(data)
             except Exception as e:
                 logging.info('%s RangeFetch 本地连接断开：%r, %r', self.address_string(), self.url, e)
                 break
         else:
             logging.info('%s RangeFetch 成功完成 %r', self.address_string(), self.url)
         self._stopped = True
-        if self.expect_begin < length:
+        buffer.stop()
+        if cache:
+            range_cache.release(cache)
+        if buffer.expect_begin < length:
             self.handler.close_connection = True
 
     def address_string(self, response=None):
         return self.handler.address_string(response)
 
-    def __fetchlet(self, range_queue, data_queue, threadorder):
+    def read_cache(self, pos):
+        return self.cache.read(pos, min(self.bufsize * 8, self.length - pos))
+
+    def new_task(self, begin, end):
+        task = RangeTask(begin, end)
+        self.tasks.append(task)
+        return task
+
+    def get_range_size(self, xip):
+        #按 IP 下载速度计算范围大小，使每个范围约需 rangetime 秒完成
+        if not self.rangetime:
+            return self.maxsize
+        speed = xip and ip_speeds.get(xip)
+        if speed is None:
+            speeds = [ip_speeds.get(ip) for ip in self.iplist or ()]
+            speeds = [speed for speed in speeds if speed]
+            if not speeds:
+                return self.maxsize
+            speed = sum(speeds) / len(speeds)
+        size = int(speed * self.rangetime) // self.bufsize * self.bufsize
+        return max(min(size, self.maxsize), self.minsize)
+
+    def _get_retry_task(self):
+        if self.retry_tasks:
+            task = min(self.retry_tasks, key=lambda task: task.pos)
+            self.retry_tasks.remove(task)
+            task.fetchers += 1
+            return task
+
+    def get_retry_task(self):
+        with self.tLock:
+            return self._get_retry_task()
+
+    def get_task(self, xip):
+        with self.tLock:
+            #优先重试失败的范围
+            task = self._get_retry_task()
+            if task:
+                return task
+            begin = self.next_begin
+            if self.cache and begin < self.length:
+                #跳过磁盘缓存中已保存的部分
+                with self.cache.lock:
+                    begin = self.cache.next_missing(begin)
+                    next_cached = self.cache.next_cached(begin)
+            else:
+                next_cached = self.length
+            if begin < self.length:
+                end = min(begin + self.get_range_size(xip), next_cached, self.length)
+                self.next_begin = end
+                task = self.new_task(begin, end - 1)
+                task.fetchers += 1
+                return task
+            self.next_begin = begin
+            #空闲线程分割剩余最多的范围
+            if self.tasks:
+                task = max(self.tasks, key=lambda task: task.end - task.pos)
+                left = task.end + 1 - task.pos
+                if left >= 2 * self.minsize:
+                    begin = task.pos + left // 2
+                    new_task = self.new_task(begin, task.end)
+                    task.end = begin - 1
+                    new_task.fetchers += 1
+                    logging.debug('%s RangeFetch 分割范围 %d-%d', self.address_string(), begin, new_task.end)
+                    return new_task
+
+    def hedge_task(self):
+        now = mtime()
+        with self.tLock:
+            tasks = [task for task in self.tasks if task.fetchers]
+            if not tasks:
+                return
+            task = min(tasks, key=lambda task: task.pos)
+            #阻塞的范围改变或有新数据到达时重新计时
+            if task is not self.blocking or task.pos != self.blockpos:
+                self.blocking = task
+                self.blockpos = task.pos
+                self.blocktime = now
+                return
+            if task.hedged or task.pos != self.buffer.expect_begin or \
+                    now - self.blocktime < self.hedgetime:
+                return
+            task.hedged = True
+            task.fetchers += 1
+        logging.warning('%s RangeFetch 范围 %d-%d 下载过慢，发起对冲请求', self.address_string(), task.pos, task.end)
+        spawn_later(0, self.__fetchlet, self.buffer, 0, task)
+
+    def retry_task(self, task):
+        #没有其它线程下载时放回重试
+        with self.tLock:
+            task.fetchers -= 1
+            if task.fetchers == 0 and task.pos <= task.end and task in self.tasks:
+                self.retry_tasks.append(task)
+
+    def put_data(self, task, start, data):
+        #多个线程下载同一范围时只保留先到的数据，超出范围的数据被丢弃
+        with self.tLock:
+            pos = task.pos
+            if start + len(data) <= pos:
+                return task.pos <= task.end
+            if start < pos:
+                data = data[pos - start:]
+            if pos + len(data) > task.end + 1:
+                data = data[:task.end + 1 - pos]
+            if data:
+                self.buffer.put(pos, data)
+                task.pos = pos + len(data)
+            wanted = task.pos <= task.end
+            if not wanted and task in self.tasks:
+                self.tasks.remove(task)
+        if data and self.cache:
+            self.cache.write(pos, data)
+        return wanted
+
+    def __fetchlet(self, buffer, threadorder, task=None):
         headers = {k.title(): v for k, v in self.headers.items()}
         #headers['Connection'] = 'close'
+        xip = None
         while True:
             try:
                 with self.tLock:
-                    if self.lastupdate != ip_manager_gae.last_update:
-                        self.lastupdate = ip_manager_gae.last_update
-                        self.iplist = GC.IPLIST_MAP['google_gae'].copy()
+                    lastupdate = self.fetcher.last_update()
+                    if self.lastupdate != lastupdate:
+                        self.lastupdate = lastupdate
+                        self.iplist = self.fetcher.get_iplist()
                 noerror = True
+                cutoff = False
                 response = None
                 starttime = None
                 if self._stopped: return
@@ -157,65 +450,74 @@ class RangeFetch:
                     if self.response:
                         response = self.response
                         self.response = None
-                        start, end = self.firstrange
+                        task = self.firsttask
+                        task.fetchers += 1
+                        start = task.pos
                     else:
-                        start, end = range_queue.get(timeout=1)
-                        headers['Range'] = 'bytes=%d-%d' % (start, end)
-                        while start - self.expect_begin > self.threads * self.delaysize and \
-                                data_queue.qsize() * self.bufsize > 3 * self.threads * self.delaysize:
-                            if self._stopped: return
-                            sleep(0.1)
-                        response = gae_urlfetch(self.command, self.url, headers, self.payload, getfast=self.timeout)
+                        if task is None:
+                            if threadorder:
+                                task = self.get_task(xip)
+                            else:
+                                #对冲线程不分配新的范围，只接手失败后无人下载的范围
+                                task = self.get_retry_task()
+                            if task is None:
+                                return
+                        start = task.pos
+                        headers['Range'] = 'bytes=%d-%d' % (start, task.end)
+                        if not buffer.wait_room(start):
+                            return
+                        response = self.fetcher.urlfetch(self.command, self.url, headers, self.payload, self.timeout)
                     if response:
                         xip = response.xip[0]
-                        if xip in self.iplist:
+                        if self.iplist is None or xip in self.iplist:
                             realstart = start
                             starttime = mtime()
                         else:
-                            range_queue.put((start, end))
+                            self.retry_task(task)
+                            task = None
                             noerror = False
                             continue
-                except queue.Empty:
-                    return
                 except LimiterFull:
-                    range_queue.put((start, end))
+                    self.retry_task(task)
+                    task = None
                     sleep(2)
                     continue
                 except Exception as e:
                     logging.warning('%s Response %r in __fetchlet', self.address_string(response), e)
-                    range_queue.put((start, end))
+                    self.retry_task(task)
+                    task = None
                     continue
                 if self._stopped: return
                 if not response:
                     logging.warning('%s RangeFetch %s 没有响应，重试', self.address_string(response), headers['Range'])
-                    range_queue.put((start, end))
-                elif response.app_status == 503:
-                    if hasattr(response, 'appid'):
-                        mark_badappid(response.appid)
-                    range_queue.put((start, end))
+                    self.retry_task(task)
+                elif not self.fetcher.check_response(response, self.url, headers):
+                    self.retry_task(task)
                     noerror = False
-                elif response.app_status != 200:
-                    logging.warning('%s Range Fetch "%s %s" %s 返回 %s', self.address_string(response), self.command, self.url, headers['Range'], response.app_status)
-                    range_queue.put((start, end))
-                    noerror = False
-                elif response.getheader('Location'):
+                elif self.fetcher.redirect and response.getheader('Location'):
                     self.url = urljoin(self.url, response.getheader('Location'))
                     logging.info('%s RangeFetch Redirect(%r)', self.address_string(response), self.url)
-                    range_queue.put((start, end))
+                    self.retry_task(task)
                 elif 200 <= response.status < 300:
                     content_range = response.getheader('Content-Range')
                     if not content_range:
                         logging.warning('%s RangeFetch "%s %s" 返回 Content-Range=%r: response headers=%r', self.address_string(response), self.command, self.url, content_range, response.getheaders())
-                        range_queue.put((start, end))
+                        self.retry_task(task)
+                        task = None
                         continue
                     content_length = int(response.getheader('Content-Length', 0))
                     logging.test('%s >>>> %s: 线程 %s %s %s', self.address_string(response), self.host, threadorder, content_length, content_range)
+                    wanted = True
                     try:
                         data = response.read(self.bufsize)
                         while data:
-                            data_queue.put((start, data))
+                            wanted = self.put_data(task, start, data)
                             start += len(data)
                             if self._stopped: return
+                            if not wanted:
+                                #范围已由其它线程完成或被分割
+                                cutoff = start < realstart + content_length
+                                break
                             if (start-realstart) / (mtime()-starttime) < self.lowspeed:
                                 #移除慢速 ip
                                 if self.delable: 
@@ -229,17 +531,21 @@ class RangeFetch:
                                 data = response.read(self.bufsize)
                     except Exception as e:
                         noerror = False
-                        logging.warning('%s RangeFetch "%s %s" %s 失败：%r', self.address_string(response), self.command, self.url, headers['Range'], e)
+                        logging.warning('%s RangeFetch "%s %s" %s 失败：%r', self.address_string(response), self.command, self.url, headers.get('Range'), e)
+                    if start > realstart:
+                        record_ip_speed(xip, (start - realstart) / (mtime() - starttime))
                     if self._stopped: return
-                    if start < end + 1:
-                        logging.warning('%s RangeFetch "%s %s" 重试 %s-%s', self.address_string(response), self.command, self.url, start, end)
-                        range_queue.put((start, end))
+                    if wanted:
+                        logging.warning('%s RangeFetch "%s %s" 重试 %s-%s', self.address_string(response), self.command, self.url, task.pos, task.end)
+                        self.retry_task(task)
+                        task = None
                         continue
                     logging.test('%s >>>> %s: 线程 %s 成功接收到 %d 字节', self.address_string(response), self.host, threadorder, start)
                 else:
                     logging.error('%s RangeFetch %r 返回 %s', self.address_string(response), self.url, response.status)
-                    range_queue.put((start, end))
+                    self.retry_task(task)
                     noerror = False
+                task = None
             except Exception as e:
                 logging.exception('%s RangeFetch._fetchlet 错误：%r', self.address_string(), e)
                 noerror = False
@@ -247,12 +553,11 @@ class RangeFetch:
             finally:
                 if response:
                     response.close()
-                    if noerror:
-                        #放入套接字缓存
-                        response.http_util.ssl_connection_cache[response.connection_cache_key].append((mtime(), response.sock))
+                    if noerror and not cutoff:
+                        self.fetcher.checkin(response)
                     else:
                         response.sock.close()
-                        if self.delable:
+                        if not noerror and self.delable:
                             with self.tLock:
                                  if xip in self.iplist and len(self.iplist) > self.minip:
                                     self.iplist.remove(xip)
@@ -265,6 +570,9 @@ class RangeFetchFast(RangeFetch):
     threads = GC.AUTORANGE_FAST_THREADS or 2
     minip = int(threads * 1.5)
     lowspeed = GC.AUTORANGE_FAST_LOWSPEED or 1024
+    minsize = min(maxsize, 1024 * 64)
+    rangetime = GC.AUTORANGE_FAST_RANGETIME
+    hedgetime = GC.AUTORANGE_FAST_HEDGETIME
     timeout = max(GC.PICKER_GAE_MAXTIMEOUT / 500, 4)
     sleeptime = GC.PICKER_GAE_MAXTIMEOUT / 500.0
     delaysize = max(min(maxsize, 1024 * 1024), 1024 * 128)
@@ -274,6 +582,9 @@ class RangeFetchBig(RangeFetch):
     threads = GC.AUTORANGE_BIG_THREADS or 2
     minip = int(threads * 1.5)
     lowspeed = GC.AUTORANGE_BIG_LOWSPEED or 0
+    minsize = min(maxsize, 1024 * 1024)
+    rangetime = GC.AUTORANGE_BIG_RANGETIME
+    hedgetime = GC.AUTORANGE_BIG_HEDGETIME
     timeout = max(GC.LINK_FWDTIMEOUT, 5)
     sleeptime = GC.AUTORANGE_BIG_SLEEPTIME
     delaysize = GC.AUTORANGE_BIG_ONSIZE / 4
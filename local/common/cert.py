@@ -9,10 +9,14 @@ import random
 import logging
 import OpenSSL
 from OpenSSL import crypto
+from cryptography.hazmat.primitives.asymmetric import ec
 from time import time
+from queue import Queue
 from datetime import datetime
+from _thread import start_new_thread
 from ..GlobalConfig import GC
 from .path import cert_dir
+from .net import isip
 from .util import LRUCache
 
 ca_vendor = 'GotoX'
@@ -25,16 +29,36 @@ ca_digest = 'sha256'
 ca_years = 20
 ca_time_b = -3600 * 24
 ca_time_a = 3600 * 24 * (365 * ca_years + ca_years // 4) + ca_time_b
-sub_keyfile = os.path.join(cert_dir, 'subkey.pem')
-sub_certdir = os.path.join(cert_dir, 'certs')
+#伪造网站证书的密钥类型，ECDSA 密钥与 RSA 密钥分开保存
+sub_keytype = GC.LINK_LOCALKEY
+if sub_keytype == 'ecc':
+    sub_keyfile = os.path.join(cert_dir, 'subkey_ecc.pem')
+    sub_certdir = os.path.join(cert_dir, 'certs_ecc')
+else:
+    sub_keyfile = os.path.join(cert_dir, 'subkey.pem')
+    sub_certdir = os.path.join(cert_dir, 'certs')
 sub_publickey = None
+sub_privatekey = None
 sub_lock = threading.Lock()
 sub_serial = 3600 * 24 * 365 * 46
 sub_years = 1
 sub_time_b = -3600
 sub_time_a = 3600 * 24 * (365 * sub_years + sub_years // 4) + sub_time_b
 sub_time_e = sub_time_a - 3600 * 24
-sub_certs = LRUCache(128)
+sub_time_r = 3600 * 24 * 30  # 最早在过期 30 天前更新证书
+sub_time_u = 3600 * 24  # 剩余有效时间大于 1 天的证书可以先使用，并在后台更新
+#内存中的证书 commonname -> X509
+sub_certs = LRUCache(512)
+#正在签署的证书 commonname -> Event，同一主机的并发请求只签署一次
+sub_signing = {}
+#后台保存证书
+sub_dump_queue = Queue()
+sub_dumping = False
+#后台预先签署证书
+sub_presign_queue = Queue()
+sub_presigning = set()
+#启动时预先载入的最近使用的证书数量
+sub_warm_count = 128
 
 def create_ca():
     pkey = crypto.PKey()
@@ -72,15 +96,19 @@ def dump_ca():
         fp.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, pkey))
 
 def dump_subkey():
-    global sub_publickey
-    sub_key = crypto.PKey()
-    sub_key.generate_key(crypto.TYPE_RSA, 2048)
+    global sub_publickey, sub_privatekey
+    if sub_keytype == 'ecc':
+        #ECDSA P-256 的签名运算比 RSA 2048 快很多，可以减少本地握手用时
+        sub_key = crypto.PKey.from_cryptography_key(ec.generate_private_key(ec.SECP256R1()))
+    else:
+        sub_key = crypto.PKey()
+        sub_key.generate_key(crypto.TYPE_RSA, 2048)
     with open(sub_keyfile, 'wb') as fp:
         fp.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, sub_key))
         fp.write(crypto.dump_publickey(crypto.FILETYPE_PEM, sub_key))
-    sub_publickey = sub_key
+    sub_publickey = sub_privatekey = sub_key
 
-def create_subcert(certfile, commonname, ip=False):
+def create_subcert(commonname, ip=False):
     cert = crypto.X509()
     cert.set_version(2)
     cert.set_serial_number(int((int(time() - sub_serial) + random.random()) * 100)) #setting the only number
@@ -102,42 +130,156 @@ def create_subcert(certfile, commonname, ip=False):
         sans = 'DNS: %s, DNS: *.%s' % (commonname, commonname)
     cert.add_extensions([crypto.X509Extension(b'subjectAltName', True, sans.encode())])
     cert.sign(ca_privatekey, ca_digest)
+    return cert
 
-    with open(certfile, 'wb') as fp:
-        fp.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
-
-def get_cert(commonname, ip=False):
+def get_certfile(commonname, ip=False):
     if ip:
         certfilename = commonname.replace(':', '.')
     else:
         certfilename = '.'.join(reversed(commonname.split('.')))
-    certfile = os.path.join(sub_certdir, certfilename + '.crt')
+    return os.path.join(sub_certdir, certfilename + '.crt')
 
+def get_cert_expire(cert):
+    return (datetime.strptime(cert.get_notAfter().decode(), '%Y%m%d%H%M%SZ') -
+            datetime.utcnow()
+           ).total_seconds()
+
+def load_subcert(certfile):
+    try:
+        with open(certfile, 'rb') as fp:
+            return crypto.load_certificate(crypto.FILETYPE_PEM, fp.read())
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logging.warning('CertUtil.load_subcert：证书 %r 读取失败：%r', certfile, e)
+
+def dump_subcert(certfile, cert):
+    #证书交由后台线程写入磁盘
+    global sub_dumping
+    sub_dump_queue.put((certfile, cert))
     with sub_lock:
-        if os.path.exists(certfile):
-            try:
-                cert = sub_certs[certfile]
-            except KeyError:
-                with open(certfile, 'rb') as fp:
-                    cert = crypto.load_certificate(crypto.FILETYPE_PEM, fp.read())
-                sub_certs[certfile] = cert
-            expire = (datetime.strptime(cert.get_notAfter().decode(), '%Y%m%d%H%M%SZ') -
-                      datetime.utcnow()
-                     ).total_seconds()
-            if expire < 2592000:  # 最早在过期 30 天前更新证书
-                try:
-                    os.remove(certfile)
-                except OSError as e:
-                    logging.warning('CertUtil.get_cert：旧证书删除失败：%r', e)
-                else:
-                    del sub_certs[certfile]
-                    cert = None
-            if cert:
-                return certfile, expire
+        if sub_dumping:
+            return
+        sub_dumping = True
+    start_new_thread(_dump_subcerts, ())
+
+def _dump_subcerts():
+    while True:
+        certfile, cert = sub_dump_queue.get()
+        try:
+            with open(certfile, 'wb') as fp:
+                fp.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+        except OSError as e:
+            logging.warning('CertUtil.dump_subcert：证书 %r 保存失败：%r', certfile, e)
+
+def get_parent(commonname):
+    #与 ProxyHandler.get_context 相同，子域名使用上级域名的泛域名证书
+    names = commonname.split('.')
+    if len(names) > 2:
+        return '.'.join(names[1:])
 
-        sub_certs.pop(certfile, None)
-        create_subcert(certfile, commonname, ip)
-        return certfile, sub_time_e
+def get_cert(commonname, ip=False):
+    #返回证书对象和剩余有效时间，依次从内存、磁盘获取，都没有时签署新证书
+    cert = sub_certs.get(commonname)
+    if cert:
+        expire = get_cert_expire(cert)
+        if expire >= sub_time_r:
+            return cert, expire
+        if expire > sub_time_u:
+            #即将过期的证书先继续使用，返回较短的有效时间以便稍后换用新证书
+            presign(commonname, ip)
+            return cert, 600
+    return _get_cert(commonname, ip)
+
+def _get_cert(commonname, ip=False, renew=False):
+    while True:
+        cert = sub_certs.get(commonname)
+        if cert:
+            expire = get_cert_expire(cert)
+            if expire >= sub_time_r:
+                return cert, expire
+        with sub_lock:
+            signing = sub_signing.get(commonname)
+            if signing is None:
+                signing = sub_signing[commonname] = threading.Event()
+                break
+        #等待其它线程签署完成
+        signing.wait()
+
+    try:
+        certfile = get_certfile(commonname, ip)
+        cert = load_subcert(certfile)
+        if cert:
+            expire = get_cert_expire(cert)
+            if expire < sub_time_r:
+                if not renew and expire > sub_time_u:
+                    sub_certs[commonname] = cert
+                    presign(commonname, ip)
+                    return cert, 600
+                cert = None
+        if cert is None:
+            cert = create_subcert(commonname, ip)
+            expire = sub_time_e
+            dump_subcert(certfile, cert)
+            #新访问的站点，其上级域名的其它子域名很可能随后被访问
+            if not ip:
+                presign(get_parent(commonname))
+        sub_certs[commonname] = cert
+        return cert, expire
+    finally:
+        with sub_lock:
+            del sub_signing[commonname]
+        signing.set()
+
+def presign(commonname, ip=False):
+    #加入后台签署队列，已在内存中且有效期充足的证书不再处理
+    if not commonname:
+        return
+    cert = sub_certs.get(commonname)
+    if cert and get_cert_expire(cert) >= sub_time_r:
+        return
+    with sub_lock:
+        if commonname in sub_presigning:
+            return
+        start = not sub_presigning
+        sub_presigning.add(commonname)
+    sub_presign_queue.put((commonname, ip))
+    if start:
+        start_new_thread(_presign_certs, ())
+
+def _presign_certs():
+    while True:
+        commonname, ip = sub_presign_queue.get()
+        try:
+            _get_cert(commonname, ip, True)
+        except Exception as e:
+            logging.warning('CertUtil.presign：证书 %r 签署失败：%r', commonname, e)
+        with sub_lock:
+            sub_presigning.discard(commonname)
+            if not sub_presigning:
+                return
+
+def warm_certs():
+    #预先载入最近签署的证书，避免启动后首次访问常用网站时读取磁盘
+    #即将过期的证书和常用站点的上级域名证书在后台签署
+    certfiles = glob.glob(os.path.join(sub_certdir, '*.crt'))
+    try:
+        certfiles.sort(key=os.path.getmtime, reverse=True)
+    except OSError:
+        pass
+    for certfile in certfiles[:sub_warm_count]:
+        cert = load_subcert(certfile)
+        if cert is None:
+            continue
+        commonname = cert.get_subject().CN
+        ip = isip(commonname)
+        if get_cert_expire(cert) < sub_time_r:
+            presign(commonname, ip)
+            continue
+        if commonname not in sub_certs:
+            sub_certs[commonname] = cert
+        if not ip:
+            presign(get_parent(commonname))
 
 def import_ca(certfile=None):
     if certfile is None:
@@ -273,7 +415,7 @@ def check_ca():
         else:
             logging.warning('删除功能未启用或未支持，请自行删除 [%s CA] 证书' % ca_vendor)
         dump_ca()
-    global ca_privatekey, ca_subject, sub_publickey, ca_thumbprint
+    global ca_privatekey, ca_subject, sub_publickey, sub_privatekey, ca_thumbprint
     with open(ca_keyfile, 'rb') as fp:
         content = fp.read()
     ca = crypto.load_certificate(crypto.FILETYPE_PEM, content)
@@ -296,6 +438,7 @@ def check_ca():
         with open(sub_keyfile, 'rb') as fp:
             content = fp.read()
         sub_publickey = crypto.load_publickey(crypto.FILETYPE_PEM, content)
+        sub_privatekey = crypto.load_privatekey(crypto.FILETYPE_PEM, content)
     else:
         dump_subkey()
     sub_publickey_str = crypto.dump_publickey(crypto.FILETYPE_PEM, sub_publickey)
@@ -310,3 +453,5 @@ def check_ca():
                 crypto.dump_publickey(crypto.FILETYPE_PEM, cert.get_pubkey())):
             logging.error('Certs mismatch, delete Certs.')
             any(os.remove(x) for x in certfiles)
+            return
+    start_new_thread(warm_certs, ())
@@ -3,17 +3,27 @@
 import json
 import queue
 import socket
+import collections
 import dnslib
 import logging
 import random
+import OpenSSL
+import threading
 import urllib.parse as urlparse
-from select import select
 from time import mtime, sleep
+from select import select
 from _thread import start_new_thread
 from .net import servers_2_addresses, isip, isipv4, isipv6, stop_all_forward
-from .util import LRUCache
+from .util import LRUCache, spawn_later
 from ..GlobalConfig import GC
 
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+except ImportError:
+    h2 = None
+
 A = dnslib.QTYPE.A
 AAAA = dnslib.QTYPE.AAAA
 OPT = dnslib.QTYPE.OPT
@@ -75,6 +85,46 @@ def _dns_resolve(host, qtypes=qtypes, local=GC.DNS_LOCAL_HOST):
         if iplist: break
     return iplist
 
+def get_ttl(iplist):
+    ttl = getattr(iplist, 'ttl', None)
+    if ttl is None:
+        return GC.DNS_CACHE_EXPIRATION
+    return max(min(ttl, GC.DNS_CACHE_MAXTTL), GC.DNS_CACHE_MINTTL)
+
+def cache_iplist(host, iplist, hits=0):
+    #按记录的 TTL 设置新鲜时间，缓存时间额外保留 stale 秒用于返回旧结果
+    ttl = get_ttl(iplist)
+    iplist = classlist(set(iplist))
+    iplist.ttl = ttl
+    iplist.fresh = mtime() + ttl
+    iplist.hits = hits
+    iplist.refreshing = False
+    dns.set(host, iplist, ttl + GC.DNS_CACHE_STALE)
+    return iplist
+
+def check_refresh(host, iplist, qtypes):
+    #超过新鲜时间的记录先返回旧结果并在后台更新，常用的记录在过期前预先更新
+    iplist.hits += 1
+    refresh_at = iplist.fresh
+    if GC.DNS_CACHE_PREFETCH and iplist.hits >= GC.DNS_CACHE_PREFETCH:
+        refresh_at -= max(iplist.ttl // 10, min(5, iplist.ttl // 2))
+    if mtime() >= refresh_at and not iplist.refreshing:
+        iplist.refreshing = True
+        start_new_thread(_dns_refresh, (host, iplist, qtypes))
+
+def _dns_refresh(host, stale_iplist, qtypes):
+    try:
+        iplist = _dns_resolve(host, qtypes)
+    except Exception as e:
+        logging.debug('_dns_refresh %r 失败：%r', host, e)
+        iplist = None
+    if iplist:
+        cache_iplist(host, iplist, stale_iplist.hits)
+    else:
+        #更新失败时继续使用旧结果，稍后再试
+        stale_iplist.fresh = mtime() + GC.DNS_CACHE_MINTTL
+        stale_iplist.refreshing = False
+
 def dns_resolve(host, qtypes=qtypes):
     if isip(host):
         dns[host] = iplist = [host]
@@ -84,9 +134,11 @@ def dns_resolve(host, qtypes=qtypes):
         dns.setpadding(host)
         iplist = _dns_resolve(host, qtypes)
         if iplist:
-            dns[host] = iplist = list(set(iplist))
+            iplist = cache_iplist(host, iplist)
         else:
             dns.set(host, 0, 300)
+    elif hasattr(iplist, 'fresh'):
+        check_refresh(host, iplist, qtypes)
     if iplist == [NXDOMAIN]:
         return []
     return iplist
@@ -116,11 +168,11 @@ from .region import ipdb, islocal, direct_domains_black_tree
 from ..FilterUtil import get_action
 from ..HTTPUtil import http_gws, http_nor
 
-#待处理：IP 数据库尚未支持 IPv6 地址
 def check_servers(servers, local):
+    #旧格式的 IP 数据库不包含 IPv6 地址
     return tuple((sv, d) for sv, d in servers
                  if not ipdb or (not local and d != 53) or
-                 isipv6(sv) or (sv in ipdb) is local)
+                 isipv6(sv) and not ipdb.ipv6 or (sv in ipdb) is local)
 
 dns_remote_servers = servers_2_addresses(GC.DNS_SERVERS, 53)
 dns_remote_servers = check_servers(dns_remote_servers, False) or \
@@ -149,6 +201,19 @@ class doh_params:
         self.port = port
         self.path = path
         self.url = 'https://%s%s' % (host, path)
+        #查询用时的指数加权移动平均，用于服务器排序
+        self.rtt = None
+        # HTTP/2 连接，False 表示服务器不支持
+        self.h2 = None
+        self.h2_lock = threading.Lock()
+
+    def record(self, ok, t):
+        if not ok:
+            t = max(t, doh_fail_time)
+        if self.rtt is None:
+            self.rtt = t
+        else:
+            self.rtt += 0.3 * (t - self.rtt)
 
     def set_dns(self):
         action, target = get_action('https', self.host, self.path, self.url)
@@ -165,6 +230,9 @@ class doh_params:
 
 doh_servers = set()
 doh_servers_bad = set()
+doh_hedge_delay = GC.DNS_OVER_HTTPS_HEDGE
+doh_fail_time = 4
+doh_h2 = h2 and GC.DNS_OVER_HTTPS_H2
 for _sv in GC.DNS_OVER_HTTPS_SERVERS:
     _sv = urlparse.urlsplit('http://' + _sv)
     doh_servers.add(doh_params(_sv.hostname.encode('idna').decode(),
@@ -180,16 +248,37 @@ def mark_bad_doh(server):
     doh_servers.discard(server)
     doh_servers_bad.add(server)
 
+def _parse_doh_reply(data, qtype):
+    iplist = []
+    ttl = None
+    ok = False
+    reply = dnslib.DNSRecord.parse(data)
+    if reply:
+        if reply.header.rcode is NXDOMAIN:
+            ok = True
+            iplist.append(NXDOMAIN)
+        else:
+            ok = reply.header.rcode is NOERROR
+            for r in reply.rr:
+                if r.rtype is qtype:
+                    iplist.append(str(r.rdata))
+                    ttl = r.ttl if ttl is None else min(ttl, r.ttl)
+    return iplist, ttl, ok
+
+def get_doh_http_util(server):
+    return http_gws if server.hostname.startswith('google') else http_nor
+
 def _https_resolve(server, qname, qtype, query_data):
     '此函数功能实现仅限于解析为 A、AAAA 记录'
     # https://developers.cloudflare.com/1.1.1.1/dns-over-https/wireformat/
 
     iplist = []
     xip = None
+    ttl = None
     response = None
     noerror = False
     ok = False
-    http_util = http_gws if server.hostname.startswith('google') else http_nor
+    http_util = get_doh_http_util(server)
     connection_cache_key = '%s:%d' % (server.hostname, server.port)
     try:
         response = http_util.request(server, query_data, headers=server.headers.copy(), connection_cache_key=connection_cache_key)
@@ -197,16 +286,7 @@ def _https_resolve(server, qname, qtype, query_data):
             data = response.read()
             noerror = True
             if response.status == 200:
-                reply = dnslib.DNSRecord.parse(data)
-                if reply:
-                    if reply.header.rcode is NXDOMAIN:
-                        ok = True
-                        iplist.append(NXDOMAIN)
-                    else:
-                        ok = reply.header.rcode is NOERROR
-                        for r in reply.rr:
-                            if r.rtype is qtype:
-                                iplist.append(str(r.rdata))
+                iplist, ttl, ok = _parse_doh_reply(data, qtype)
             else:
                 raise DoHError((response.status, data))
     except DoHError as e:
@@ -221,52 +301,239 @@ def _https_resolve(server, qname, qtype, query_data):
             xip = response.xip
             if noerror:
                 if GC.GAE_KEEPALIVE or http_util is not http_gws:
-                    http_util.ssl_connection_cache[connection_cache_key].append((mtime(), response.sock))
+                    http_util.ssl_connection_cache.checkin(connection_cache_key, response.sock)
                 else:
                     response.sock.close()
-        return iplist, xip, ok
-
-def _dns_over_https_resolve(qname, qtypes=qtypes):
+        return iplist, xip, ttl, ok
+
+class DoHH2Connection:
+    '''A HTTP/2 connection to a DoH server, concurrent queries share it
+    as separate streams.'''
+
+    def __init__(self, server):
+        self.server = server
+        self.closed = False
+        self.streams = {}
+        self.lock = threading.Lock()
+        http_util = get_doh_http_util(server)
+        self.keeptime = http_util.keeptime
+        # h2: 前缀的连接键值会在 TLS 握手时协商 h2 协议，不与 HTTP/1.1 连接混用
+        cache_key = 'h2:%s:%d' % (server.hostname, server.port)
+        self.sock = sock = http_util.create_ssl_connection((server.host, server.port), server.hostname, cache_key)
+        self.xip = sock.xip
+        if sock.get_alpn_proto_negotiated() != b'h2':
+            sock.close()
+            raise DoHError('不支持 HTTP/2')
+        config = h2.config.H2Configuration(client_side=True, header_encoding=None)
+        self.conn = h2.connection.H2Connection(config=config)
+        self.conn.initiate_connection()
+        sock.sendall(self.conn.data_to_send())
+        sock.settimeout(self.keeptime)
+        start_new_thread(self._receive, ())
+
+    def query(self, query_data, timeout):
+        server = self.server
+        queobj = queue.Queue()
+        error = None
+        with self.lock:
+            if self.closed:
+                raise DoHError('连接已关闭')
+            stream_id = self.conn.get_next_available_stream_id()
+            self.streams[stream_id] = [queobj, None, []]
+            self.conn.send_headers(stream_id, [
+                (b':method', b'POST'),
+                (b':scheme', b'https'),
+                (b':authority', server.host.encode()),
+                (b':path', server.path.encode()),
+                (b'accept', b'application/dns-message'),
+                (b'content-type', b'application/dns-message'),
+                (b'content-length', str(len(query_data)).encode())])
+            self.conn.send_data(stream_id, query_data, end_stream=True)
+            try:
+                self.sock.sendall(self.conn.data_to_send())
+            except (OSError, OpenSSL.SSL.Error) as e:
+                error = e
+        if error:
+            #close 需要获取 self.lock，所以在释放后调用
+            self.close()
+            raise error
+        try:
+            result = queobj.get(timeout=timeout)
+        except queue.Empty:
+            #超时的连接可能已经失效，关闭后下次查询重新建立
+            self.close()
+            raise socket.timeout('DoH HTTP/2 查询超时')
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _receive(self):
+        sock = self.sock
+        conn = self.conn
+        try:
+            while not self.closed:
+                #在锁外等待可读，收发都在锁内进行，避免同时读写同一个 SSL 连接
+                if not sock.pending():
+                    ins, _, err = select([sock], [], [sock], self.keeptime)
+                    if err:
+                        break
+                    if not ins:
+                        if self.streams:
+                            continue
+                        break
+                with self.lock:
+                    if self.closed:
+                        break
+                    data = sock.recv(65535)
+                    if not data:
+                        break
+                    events = conn.receive_data(data)
+                    for event in events:
+                        stream = self.streams.get(getattr(event, 'stream_id', None))
+                        if isinstance(event, h2.events.ResponseReceived):
+                            if stream:
+                                stream[1] = dict(event.headers).get(b':status')
+                        elif isinstance(event, h2.events.DataReceived):
+                            conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                            if stream:
+                                stream[2].append(event.data)
+                        elif isinstance(event, h2.events.StreamEnded):
+                            if stream:
+                                del self.streams[event.stream_id]
+                                stream[0].put((stream[1], b''.join(stream[2])))
+                        elif isinstance(event, h2.events.StreamReset):
+                            if stream:
+                                del self.streams[event.stream_id]
+                                stream[0].put(DoHError('stream reset: %s' % event.error_code))
+                        elif isinstance(event, h2.events.ConnectionTerminated):
+                            self.closed = True
+                    sock.sendall(conn.data_to_send())
+        except Exception as e:
+            logging.debug('%s DoHH2Connection 接收错误：%r', address_string(self), e)
+        finally:
+            self.close()
+
+    def close(self):
+        with self.server.h2_lock:
+            if self.server.h2 is self:
+                self.server.h2 = None
+        with self.lock:
+            self.closed = True
+            streams = list(self.streams.values())
+            self.streams.clear()
+            self.sock.close()
+        for stream in streams:
+            stream[0].put(DoHError('连接已关闭'))
+
+def get_doh_h2(server):
+    #每个服务器只维持一个 HTTP/2 连接
+    with server.h2_lock:
+        h2conn = server.h2
+        if h2conn is None:
+            try:
+                h2conn = server.h2 = DoHH2Connection(server)
+            except DoHError:
+                logging.warning('DoH 服务器 %r 不支持 HTTP/2，使用 HTTP/1.1。', server.host)
+                h2conn = server.h2 = False
+        return h2conn
 
-    def get_wire():
-        return dnslib.DNSRecord(q=dnslib.DNSQuestion(qname, qtype)).pack()
+def _h2_resolve(server, qname, qtype, query_data, h2conn):
+    iplist = []
+    ttl = None
+    ok = False
+    try:
+        status, data = h2conn.query(query_data, http_nor.timeout)
+        if status == b'200':
+            iplist, ttl, ok = _parse_doh_reply(data, qtype)
+        else:
+            raise DoHError((status, data))
+    except DoHError as e:
+        logging.error('%s _h2_resolve %r 失败：%r',
+                      address_string(h2conn), qname, e)
+    except Exception as e:
+        logging.debug('%s _h2_resolve %r 失败：%r',
+                      address_string(h2conn), qname, e)
+    return iplist, h2conn.xip, ttl, ok
 
-    iplist = classlist()
-    xips = []
-    qtypes = list(qtypes)
-    qtype = qtypes.pop()
-    query_data = get_wire()
-    while True:
-        try:
-            servers = random.sample(tuple(doh_servers), len(doh_servers))
-            break
-        except ValueError:
-            pass
-    if doh_servers_bad:
-        servers += list(doh_servers_bad)
-    for server in servers:
-        while True:
-            ok = False
-            server.set_dns()
-            if server.hostname is None:
-                break
-            _iplist, xip, ok = _https_resolve(server, qname, qtype, query_data)
-            iplist += _iplist
-            if xip and xip not in xips:
-                xips.append(xip)
-            if ok and qtypes:
-                qtype = qtypes.pop()
-                query_data = get_wire()
-            else:
-                break
+def _doh_query(server, qname, qtype, query_data):
+    start = mtime()
+    result = [], None, None, False
+    try:
+        server.set_dns()
+        if server.hostname is None:
+            return result
+        h2conn = None
+        if doh_h2 and server.h2 is not False:
+            try:
+                h2conn = get_doh_h2(server)
+            except Exception as e:
+                logging.debug('DoH 服务器 %r 连接失败：%r', server.host, e)
+                return result
+        if h2conn:
+            result = _h2_resolve(server, qname, qtype, query_data, h2conn)
+        else:
+            result = _https_resolve(server, qname, qtype, query_data)
+        return result
+    finally:
+        ok = result[-1]
+        server.record(ok, mtime() - start)
         if ok:
             mark_good_doh(server)
-            if not qtypes:
-                break
         else:
             mark_bad_doh(server)
+
+def _doh_race(qname, qtype, servers, queobj):
+    #按排序依次对服务器发起查询，前一个查询未在 hedge 时间内完成时
+    #对下一个服务器发起对冲查询，前一个查询失败时立即发起，使用最先成功的结果
+    def query(server):
+        results.put(_doh_query(server, qname, qtype, query_data))
+
+    query_data = dnslib.DNSRecord(q=dnslib.DNSQuestion(qname, qtype)).pack()
+    results = queue.Queue()
+    servers = collections.deque(servers)
+    running = 0
+    launch = True
+    result = [], None, None, False
+    while servers or running:
+        if launch and servers:
+            start_new_thread(query, (servers.popleft(),))
+            running += 1
+            launch = False
+        try:
+            _result = results.get(timeout=doh_hedge_delay if servers else None)
+        except queue.Empty:
+            launch = True
+            continue
+        running -= 1
+        launch = True
+        if _result[-1] or not result[-1]:
+            result = _result
+        if result[-1]:
+            break
+    queobj.put(result)
+
+def _dns_over_https_resolve(qname, qtypes=qtypes):
+    iplist = classlist()
+    xips = []
+    ttls = []
+    #用时较短的服务器优先，失败过的服务器最后
+    servers = list(set(tuple(doh_servers) + tuple(doh_servers_bad)))
+    random.shuffle(servers)
+    servers.sort(key=lambda sv: (sv in doh_servers_bad, sv.rtt or 0))
+    queobj = queue.Queue()
+    for qtype in qtypes:
+        start_new_thread(_doh_race, (qname, qtype, servers, queobj))
+    for _ in qtypes:
+        _iplist, xip, ttl, ok = queobj.get()
+        iplist += _iplist
+        if xip and xip not in xips:
+            xips.append(xip)
+        if ttl is not None:
+            ttls.append(ttl)
     if xips:
         iplist.xip = xips
+    if ttls:
+        iplist.ttl = min(ttls)
     return iplist
 
 remote_query_opt = dnslib.EDNS0(flags='do', udp_len=1024)  # 1232
@@ -284,28 +551,126 @@ def check_edns_opt(ar):
     for r in ar:
         return r.rtype is OPT and r.edns_do
 
+class DNSUDPService:
+    '''UDP sockets shared by DNS queries, replies are dispatched to the
+    waiting query by transaction ID and server address. Sockets are rotated
+    periodically so the source port does not stay fixed.'''
+
+    rotate_count = 64
+    rotate_time = 60
+    close_delay = 10
+
+    def __init__(self):
+        self.socks = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def get_sock(self, family):
+        with self.lock:
+            sockinfo = self.socks.get(family)
+            if sockinfo is not None:
+                sock, count, create_time = sockinfo
+                #定期更换套接字，使源端口随机变化
+                if count < self.rotate_count and mtime() - create_time < self.rotate_time:
+                    sockinfo[1] += 1
+                    return sock
+                #旧套接字延迟关闭，继续接收已发出查询的回应
+                spawn_later(self.close_delay, sock.close)
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+            self.socks[family] = [sock, 1, mtime()]
+            start_new_thread(self._receive, (family, sock))
+        return sock
+
+    def register(self, queobj, dnsservers):
+        #分配一个对所有服务器都未使用的事务 ID
+        with self.lock:
+            while True:
+                txid = random.randrange(1, 65536)
+                if all((txid, dnsserver) not in self.pending for dnsserver in dnsservers):
+                    for dnsserver in dnsservers:
+                        self.pending[(txid, dnsserver)] = queobj
+                    return txid
+
+    def unregister(self, txids, dnsservers):
+        with self.lock:
+            for txid in txids:
+                for dnsserver in dnsservers:
+                    self.pending.pop((txid, dnsserver), None)
+
+    def sendto(self, data, dnsserver):
+        family = socket.AF_INET if isipv4(dnsserver[0]) else socket.AF_INET6
+        self.get_sock(family).sendto(data, dnsserver)
+
+    def _receive(self, family, sock):
+        while True:
+            try:
+                reply_data, xip = sock.recvfrom(4096)
+            except ConnectionResetError:
+                # Windows 会将 ICMP 端口不可达报告为接收错误
+                continue
+            except OSError as e:
+                with self.lock:
+                    sockinfo = self.socks.get(family)
+                    current = sockinfo is not None and sockinfo[0] is sock
+                    if current:
+                        del self.socks[family]
+                if current:
+                    logging.warning('DNSUDPService 接收错误，重新建立套接字：%r', e)
+                sock.close()
+                return
+            if len(reply_data) < 12:
+                continue
+            #丢弃来源不是所查询服务器的回应
+            queobj = self.pending.get((int.from_bytes(reply_data[:2], 'big'), xip[:2]))
+            if queobj:
+                queobj.put((reply_data, xip[:2]))
+
+class DNSInflight:
+    __slots__ = 'event', 'result'
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+
+dns_udp_service = DNSUDPService()
+dns_udp_inflight = {}
+dns_udp_inflight_lock = threading.Lock()
+
 def _dns_udp_resolve(qname, dnsservers, timeout=2, qtypes=qtypes):
+    #合并相同的并发查询，只发送一组请求
+    key = qname, dnsservers, tuple(qtypes)
+    with dns_udp_inflight_lock:
+        inflight = dns_udp_inflight.get(key)
+        if inflight is None:
+            inflight = dns_udp_inflight[key] = DNSInflight()
+            owner = True
+        else:
+            owner = False
+    if not owner:
+        inflight.event.wait(timeout + 1)
+        #查询出错或超时未完成时与查询失败一样返回空列表
+        if inflight.result is None:
+            return []
+        return inflight.result
+    try:
+        inflight.result = _dns_udp_query(qname, dnsservers, timeout, qtypes)
+        return inflight.result
+    finally:
+        with dns_udp_inflight_lock:
+            del dns_udp_inflight[key]
+        inflight.event.set()
+
+def _dns_udp_query(qname, dnsservers, timeout=2, qtypes=qtypes):
     # https://gfwrev.blogspot.com/2009/11/gfwdns.html
     # https://zh.wikipedia.org/wiki/域名服务器缓存污染
     # http://support.microsoft.com/kb/241352 (已删除)
 
-    def get_sock(v4):
-        nonlocal sock_v4, sock_v6
-        if v4:
-            if sock_v4 is None:
-                sock_v4 = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                socks.append(sock_v4)
-            return sock_v4
-        else:
-            if sock_v6 is None:
-                sock_v6 = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
-                socks.append(sock_v6)
-            return sock_v6
-
-    socks = []
-    sock_v4 = sock_v6 = None
+    queobj = queue.Queue()
+    txids = []
+    sent_qtypes = {}
     query_times = 0
     iplists = {'remote': []}
+    ttls = {}
     local_servers = ()
     pollution = qname in polluted_hosts
     remote_resolve = dnsservers is dns_remote_servers
@@ -321,11 +686,14 @@ def _dns_udp_resolve(qname, dnsservers, timeout=2, qtypes=qtypes):
         query = dnslib.DNSRecord(q=dnslib.DNSQuestion(qname, qtype))
         if remote_resolve:
             query.ar.append(remote_query_opt)
+        txid = dns_udp_service.register(queobj, dnsservers)
+        txids.append(txid)
+        sent_qtypes[txid] = qtype
+        query.header.id = txid
         query_data = query.pack()
         for dnsserver in dnsservers:
-            sock = get_sock(isipv4(dnsserver[0]))
             try:
-                sock.sendto(query_data, dnsserver)
+                dns_udp_service.sendto(query_data, dnsserver)
                 query_times += 1
             except socket.error as e:
                 logging.warning('send dns qname=%r \nsocket: %r', qname, e)
@@ -349,19 +717,28 @@ def _dns_udp_resolve(qname, dnsservers, timeout=2, qtypes=qtypes):
         resolved |= bv6_remote | bv6_local
     if not local_servers:
         resolved |= bv4_local | bv6_local
-    udp_len = remote_resolve and remote_query_opt.edns_len or 512
-    while mtime() < timeout_at and (allresolved ^ resolved) and query_times:
-        ins, _, _ = select(socks, [], [], 0.1)
-        for sock in ins:
+    try:
+        while (allresolved ^ resolved) and query_times:
+            timeout_left = timeout_at - mtime()
+            if timeout_left <= 0:
+                break
+            try:
+                reply_data, xip = queobj.get(timeout=timeout_left)
+            except queue.Empty:
+                break
             iplist.clear()
             qtype = None
+            reply_ttl = None
             try:
-                reply_data, xip = sock.recvfrom(udp_len)
-                xip = xip[:2]
                 local = xip in local_servers
                 if local and pollution:
                     continue
                 reply = dnslib.DNSRecord.parse(reply_data)
+                #丢弃问题部分与所发送查询不一致的回应
+                if reply.q.qname != qname or \
+                        reply.q.qtype != sent_qtypes.get(reply.header.id):
+                    query_times += 1
+                    continue
                 qtype = reply.q.qtype
                 rr_alone = len(reply.rr) == 1 and reply.a.rtype is qtype
                 if is_resolved(qtype):
@@ -404,6 +781,7 @@ def _dns_udp_resolve(qname, dnsservers, timeout=2, qtypes=qtypes):
                             #    #break
                             else:
                                 iplist.append(ip)
+                                reply_ttl = r.ttl if reply_ttl is None else min(reply_ttl, r.ttl)
                 elif reply.header.rcode is NXDOMAIN:
                     timeout_at = 0
                     iplist.append(NXDOMAIN)
@@ -417,27 +795,31 @@ def _dns_udp_resolve(qname, dnsservers, timeout=2, qtypes=qtypes):
             finally:
                 query_times -= 1
                 if iplist:
+                    key = 'local' if local else 'remote'
                     if local:
                         resolved |= bv4_local if qtype is A else bv6_local
-                        iplists['local'].extend(iplist)
                     else:
                         resolved |= bv4_remote if qtype is A else bv6_remote
-                        iplists['remote'].extend(iplist)
+                    iplists[key].extend(iplist)
+                    if reply_ttl is not None:
+                        ttls[key] = min(ttls.get(key, reply_ttl), reply_ttl)
                 #大概率没有 AAAA 结果
                 elif qtype is AAAA and is_resolved(A):
                     resolved |= bv6_local if local else bv6_remote
                 if xip not in xips:
                     xips.append(xip)
-    for sock in socks:
-        sock.close()
+    finally:
+        dns_udp_service.unregister(txids, dnsservers)
     logging.debug('query qname=%r reply iplist=%s', qname, iplists)
     if pollution or not remote_resolve or not local_servers or not dns_local_prefer:
-        iplist = iplists['remote']
+        key = 'remote'
     else:
-        iplist = iplists['local']
+        key = 'local'
+    iplist = iplists[key]
     if xips:
         iplist = classlist(iplist)
         iplist.xip = xips
+        iplist.ttl = ttls.get(key)
     if pollution:
         logging.warning('发现 DNS 污染, 域名: %r, 解析结果:\n%r', qname, iplists)
     return iplist
@@ -1,15 +1,21 @@
 # coding:utf-8
 
+import os
 import re
 import errno
 import socket
 import random
 import ipaddress
+import heapq
 import logging
+import selectors
+import threading
 import OpenSSL
 import urllib.request
 from time import mtime
 from select import select
+from _thread import start_new_thread
+from ..compat.openssl import SSLConnection
 
 NetWorkIOError = OSError, OpenSSL.SSL.Error
 reset_errno = errno.ECONNRESET, errno.ENAMETOOLONG
@@ -262,11 +268,71 @@ all_forward_sockets = set()
 
 def stop_all_forward():
     all_forward_sockets.clear()
+    forward_engine.stop_all()
+
+class ForwardCounter:
+    #转发流量计数，up：本地到远程，down：远程到本地
+    def __init__(self):
+        self.up = 0
+        self.down = 0
+
+    def add(self, counter):
+        self.up += counter.up
+        self.down += counter.down
+
+#所有已结束转发的流量合计
+forward_counter = ForwardCounter()
+
+splice = getattr(os, 'splice', None)
+if splice:
+    splice_flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+
+def get_raw_socket(sock):
+    #返回未加密的原始套接字，加密套接字返回 None
+    if isinstance(sock, SSLConnection):
+        return
+    if not isinstance(sock, socket.socket):
+        #连接限制包装
+        sock = getattr(sock, '_sock', None)
+        if not isinstance(sock, socket.socket):
+            return
+    return sock
+
+def splice_send(fd, pipe, other, other_fd, bufsize):
+    #套接字 -> 管道 -> 套接字，数据不经过用户空间
+    pipe_r, pipe_w = pipe
+    try:
+        ndata = splice(fd, pipe_w, bufsize, flags=splice_flags)
+    except BlockingIOError:
+        return -1
+    left = ndata
+    while left:
+        try:
+            left -= splice(pipe_r, other_fd, left, flags=splice_flags)
+        except BlockingIOError:
+            _, outs, err = select([], [other], [other], other.gettimeout())
+            if err:
+                raise socket.error(err)
+            if not outs:
+                raise socket.timeout('The write operation timed out')
+    return ndata
 
 def forward_socket(local, remote, payload=None, timeout=60, tick=4, bufsize=8192, maxping=None, maxpong=None):
+    counter = ForwardCounter()
     if payload:
         remote.sendall(payload)
-    buf = memoryview(bytearray(bufsize))
+        counter.up += len(payload)
+    pipe = None
+    if splice:
+        local_raw = get_raw_socket(local)
+        remote_raw = get_raw_socket(remote)
+        if local_raw and remote_raw:
+            #只有未加密的原始套接字才能使用 splice 在内核中直接转发
+            local_fd = local_raw.fileno()
+            remote_fd = remote_raw.fileno()
+            pipe = os.pipe()
+    if pipe is None:
+        buf = memoryview(bytearray(bufsize))
     maxpong = maxpong or timeout
     allins = [local, remote]
     timecount = timeout
@@ -283,12 +349,28 @@ def forward_socket(local, remote, payload=None, timeout=60, tick=4, bufsize=8192
             for sock in ins:
                 if remote not in all_forward_sockets:
                     raise ConnectionAbortedError(errno.ECONNABORTED)
-                ndata = sock.recv_into(buf)
+                if sock is remote:
+                    other = local
+                else:
+                    other = remote
+                if pipe:
+                    if sock is remote:
+                        ndata = splice_send(remote_fd, pipe, local, local_fd, bufsize)
+                    else:
+                        ndata = splice_send(local_fd, pipe, remote, remote_fd, bufsize)
+                    if ndata < 0:
+                        #虚假的可读状态
+                        continue
+                else:
+                    ndata = sock.recv_into(buf)
+                    if ndata:
+                        other.sendall(buf[:ndata])
                 if ndata:
-                    other = local if sock is remote else remote
-                    other.sendall(buf[:ndata])
-                    if not connected and sock is remote:
+                    if sock is remote:
+                        counter.down += ndata
                         connected = True
+                    else:
+                        counter.up += ndata
                 elif sock is remote:
                     return
                 else:
@@ -304,3 +386,230 @@ def forward_socket(local, remote, payload=None, timeout=60, tick=4, bufsize=8192
     finally:
         all_forward_sockets.discard(remote)
         remote.close()
+        if pipe:
+            os.close(pipe[0])
+            os.close(pipe[1])
+        forward_counter.add(counter)
+        logging.debug('forward_socket 转发结束：上行 %d 字节，下行 %d 字节%s',
+                      counter.up, counter.down, '（splice）' if pipe else '')
+
+class ForwardTunnel:
+    #转发引擎中的一对套接字及其状态
+    __slots__ = ('local', 'remote', 'raw', 'pending', 'eof', 'events',
+                 'deadline', 'tick', 'maxpong', 'connected', 'counter', 'callback')
+
+    def __init__(self, local, remote, local_raw, remote_raw, timeout, tick, maxpong, callback):
+        self.local = local
+        self.remote = remote
+        self.raw = local_raw, remote_raw
+        #发往本地、远程的未发送数据
+        self.pending = [None, None]
+        self.eof = [False, False]
+        self.events = [0, 0]
+        self.deadline = mtime() + timeout
+        self.tick = tick
+        self.maxpong = maxpong or timeout
+        self.connected = False
+        self.counter = ForwardCounter()
+        self.callback = callback
+
+class ForwardEngine:
+    #所有隧道共用一个选择器循环进行转发，空闲超时使用定时堆处理
+    #转发开始后不再占用请求处理线程
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending_tunnels = []
+        self.locals = set()
+        self.waker_w = None
+        self.running = False
+        self.stopping = False
+
+    def __contains__(self, sock):
+        #该本地连接是否由转发引擎接管
+        return sock in self.locals
+
+    def wakeup(self):
+        if self.waker_w:
+            try:
+                self.waker_w.send(b'\0')
+            except OSError:
+                pass
+
+    def stop_all(self):
+        self.stopping = True
+        self.wakeup()
+
+    def forward(self, local, remote, payload=None, timeout=60, tick=4, maxping=None, maxpong=None, callback=None):
+        #接管转发成功返回 True，加密套接字等无法接管的情况返回 False
+        local_raw = get_raw_socket(local)
+        remote_raw = get_raw_socket(remote)
+        if not (local_raw and remote_raw):
+            return False
+        if payload:
+            remote.sendall(payload)
+        tunnel = ForwardTunnel(local, remote, local_raw, remote_raw, timeout, tick, maxpong, callback)
+        if payload:
+            tunnel.counter.up += len(payload)
+        all_forward_sockets.add(remote)
+        with self.lock:
+            self.locals.add(local)
+            self.pending_tunnels.append(tunnel)
+            if not self.running:
+                self.running = True
+                waker, self.waker_w = socket.socketpair()
+                waker.setblocking(False)
+                start_new_thread(self._run, (waker,))
+        self.wakeup()
+        return True
+
+    def _run(self, waker):
+        selector = selectors.DefaultSelector()
+        selector.register(waker, selectors.EVENT_READ)
+        timers = []
+        n = 0
+        buf = memoryview(bytearray(1024 * 64))
+        tunnels = set()
+        while True:
+            timeout = 4
+            if timers:
+                timeout = max(min(timers[0][0] - mtime(), timeout), 0)
+            for key, mask in selector.select(timeout):
+                if key.fileobj is waker:
+                    try:
+                        while waker.recv(1024):
+                            pass
+                    except OSError:
+                        pass
+                    continue
+                tunnel, i = key.data
+                if tunnel not in tunnels:
+                    continue
+                try:
+                    self._relay(tunnel, i, mask, buf)
+                except ConnectionResetError as e:
+                    if not (tunnel.connected or check_connection_dead(tunnel.local)):
+                        if tunnel.callback:
+                            tunnel.callback()
+                    self._close(selector, tunnels, tunnel, e)
+                except Exception as e:
+                    self._close(selector, tunnels, tunnel, e)
+                else:
+                    if tunnel.eof[1] and tunnel.pending[0] is None:
+                        #远程连接关闭且数据已发送完毕
+                        self._close(selector, tunnels, tunnel)
+                    else:
+                        self._update_events(selector, tunnel)
+            with self.lock:
+                pending_tunnels = self.pending_tunnels
+                self.pending_tunnels = []
+            for tunnel in pending_tunnels:
+                tunnels.add(tunnel)
+                n += 1
+                heapq.heappush(timers, (tunnel.deadline, n, tunnel))
+                for raw in tunnel.raw:
+                    raw.setblocking(False)
+                try:
+                    self._update_events(selector, tunnel)
+                except Exception as e:
+                    self._close(selector, tunnels, tunnel, e)
+            if self.stopping:
+                #转发被全部停止
+                self.stopping = False
+                for tunnel in [tunnel for tunnel in tunnels if tunnel.remote not in all_forward_sockets]:
+                    self._close(selector, tunnels, tunnel, ConnectionAbortedError(errno.ECONNABORTED))
+            now = mtime()
+            while timers and timers[0][0] <= now:
+                _, _, tunnel = heapq.heappop(timers)
+                if tunnel not in tunnels:
+                    continue
+                if tunnel.deadline > now:
+                    #有数据活动，超时时间已延长
+                    n += 1
+                    heapq.heappush(timers, (tunnel.deadline, n, tunnel))
+                else:
+                    self._close(selector, tunnels, tunnel)
+
+    def _relay(self, tunnel, i, mask, buf):
+        # i == 0：本地套接字，i == 1：远程套接字
+        raw = tunnel.raw[i]
+        if mask & selectors.EVENT_WRITE:
+            data = tunnel.pending[i]
+            sent = raw.send(data)
+            tunnel.pending[i] = data[sent:] if sent < len(data) else None
+        if mask & selectors.EVENT_READ:
+            o = 1 - i
+            try:
+                ndata = raw.recv_into(buf)
+            except BlockingIOError:
+                return
+            if not ndata:
+                tunnel.eof[i] = True
+                return
+            try:
+                sent = tunnel.raw[o].send(buf[:ndata])
+            except BlockingIOError:
+                sent = 0
+            if sent < ndata:
+                tunnel.pending[o] = buf[sent:ndata].tobytes()
+            if i:
+                tunnel.counter.down += ndata
+                tunnel.connected = True
+            else:
+                tunnel.counter.up += ndata
+            if not (tunnel.eof[0] or tunnel.eof[1]):
+                #双方都在活动，延长超时时间
+                now = mtime()
+                timeleft = max(min((tunnel.deadline - now) * 2, tunnel.maxpong), tunnel.tick)
+                tunnel.deadline = now + timeleft
+
+    def _update_events(self, selector, tunnel):
+        for i in (0, 1):
+            events = 0
+            #对方有未发送数据时暂停读取
+            if not tunnel.eof[i] and tunnel.pending[1 - i] is None:
+                events |= selectors.EVENT_READ
+            if tunnel.pending[i] is not None:
+                events |= selectors.EVENT_WRITE
+            if events != tunnel.events[i]:
+                raw = tunnel.raw[i]
+                if not events:
+                    selector.unregister(raw)
+                elif not tunnel.events[i]:
+                    selector.register(raw, events, (tunnel, i))
+                else:
+                    selector.modify(raw, events, (tunnel, i))
+                tunnel.events[i] = events
+
+    def _close(self, selector, tunnels, tunnel, e=None):
+        tunnels.discard(tunnel)
+        for i in (0, 1):
+            if tunnel.events[i]:
+                try:
+                    selector.unregister(tunnel.raw[i])
+                except (KeyError, ValueError):
+                    pass
+                tunnel.events[i] = 0
+        all_forward_sockets.discard(tunnel.remote)
+        with self.lock:
+            self.locals.discard(tunnel.local)
+        try:
+            tunnel.remote.close()
+        except OSError:
+            pass
+        try:
+            tunnel.local.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        try:
+            tunnel.local.close()
+        except OSError:
+            pass
+        counter = tunnel.counter
+        forward_counter.add(counter)
+        if e and not (e.args and e.args[0] in bypass_errno):
+            logging.debug('forward_engine except: %r', e)
+        logging.debug('forward_engine 转发结束：上行 %d 字节，下行 %d 字节',
+                      counter.up, counter.down)
+
+forward_engine = ForwardEngine()
@@ -0,0 +1,170 @@
+# coding:utf-8
+
+import heapq
+import threading
+import collections
+import logging
+from time import mtime
+from _thread import start_new_thread
+from .net import check_connection_dead
+
+class ConnectionPool:
+    '''A LIFO pool of idle connections keyed by cache key.'''
+
+    def __init__(self, keeptime, max_per_key=16, max_items=512, name=None):
+        self.keeptime = keeptime
+        self.max_per_key = max_per_key
+        self.max_items = max_items
+        self.name = name
+        #键名 -> deque[(序号, 放入时间, 连接)]，右端为最近放入的连接
+        self.cache = {}
+        #序号 -> 键名，用于定时堆的惰性删除
+        self.entries = {}
+        #定时堆 [(过期时间, 序号)]
+        self.timers = []
+        self.n = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.dead = 0
+        self.lock = threading.Lock()
+        self.reaper = threading.Condition(self.lock)
+        self.running = False
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.cache
+
+    def keys(self):
+        with self.lock:
+            return tuple(self.cache.keys())
+
+    def checkin(self, key, sock):
+        #放回空闲连接
+        close_socks = []
+        with self.lock:
+            self.n += 1
+            n = self.n
+            ctime = mtime()
+            cache = self.cache.get(key)
+            if cache is None:
+                cache = self.cache[key] = collections.deque()
+            cache.append((n, ctime, sock))
+            self.entries[n] = key
+            heapq.heappush(self.timers, (ctime + self.keeptime, n))
+            #超出每个键名或总数限制时关闭最早放入的连接
+            if len(cache) > self.max_per_key:
+                close_socks.append(self._remove(key, cache[0][0]))
+            while len(self.entries) > self.max_items:
+                _, n = heapq.heappop(self.timers)
+                if n in self.entries:
+                    close_socks.append(self._remove(self.entries[n], n))
+            self.evictions += len(close_socks)
+            if not self.running:
+                self.running = True
+                start_new_thread(self._reap, ())
+            elif len(self.timers) == 1:
+                self.reaper.notify()
+        for sock in close_socks:
+            sock.close()
+
+    def checkout(self, key, unused=False):
+        #取出最近放入的可用连接，unused 为真时跳过已被使用过的连接
+        while True:
+            sock = self._checkout(key, unused)
+            if sock is None:
+                with self.lock:
+                    self.misses += 1
+                return
+            if check_connection_dead(sock):
+                with self.lock:
+                    self.dead += 1
+                continue
+            with self.lock:
+                self.hits += 1
+            return sock
+
+    def _checkout(self, key, unused):
+        sock = None
+        close_socks = []
+        with self.lock:
+            cache = self.cache.get(key)
+            if cache:
+                skiped = []
+                while cache:
+                    n, ctime, _sock = cache.pop()
+                    if unused and hasattr(_sock, 'used'):
+                        skiped.append((n, ctime, _sock))
+                        continue
+                    del self.entries[n]
+                    if mtime() - ctime > self.keeptime:
+                        self.evictions += 1
+                        close_socks.append(_sock)
+                    else:
+                        sock = _sock
+                        break
+                if skiped:
+                    skiped.reverse()
+                    cache.extend(skiped)
+                if not cache:
+                    del self.cache[key]
+        for _sock in close_socks:
+            _sock.close()
+        return sock
+
+    def _remove(self, key, n):
+        #需在锁内调用
+        cache = self.cache[key]
+        for entry in cache:
+            if entry[0] == n:
+                cache.remove(entry)
+                break
+        del self.entries[n]
+        if not cache:
+            del self.cache[key]
+        return entry[2]
+
+    def _reap(self):
+        #按定时堆关闭空闲超时的连接
+        timers = self.timers
+        while True:
+            close_socks = []
+            with self.lock:
+                while not timers:
+                    self.reaper.wait()
+                now = mtime()
+                while timers and timers[0][0] <= now:
+                    _, n = heapq.heappop(timers)
+                    if n in self.entries:
+                        close_socks.append(self._remove(self.entries[n], n))
+                self.evictions += len(close_socks)
+                if not close_socks and timers:
+                    self.reaper.wait(timers[0][0] - now)
+            for sock in close_socks:
+                try:
+                    sock.close()
+                except Exception as e:
+                    logging.debug('ConnectionPool(%s) 关闭连接错误：%r', self.name, e)
+
+    def clear(self):
+        with self.lock:
+            caches = list(self.cache.values())
+            self.cache.clear()
+            self.entries.clear()
+            del self.timers[:]
+        for cache in caches:
+            for _, _, sock in cache:
+                sock.close()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'keys': len(self.cache),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'dead': self.dead
+            }
@@ -1,9 +1,14 @@
 # coding:utf-8
 
 import os
+import sys
+import mmap
 import socket
 import logging
 from time import sleep
+from array import array
+from bisect import bisect_right
+from struct import unpack, unpack_from
 from ipaddress import IPv6Address
 from _thread import start_new_thread
 from .net import isipv4, isipv6
@@ -11,6 +16,11 @@ from .path import data_dir, launcher_dir
 from .util import LRUCache, DomainsTree
 from ..GlobalConfig import GC
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 direct_ipdb = os.path.join(data_dir, 'directip.db')
 direct_domains = os.path.join(data_dir, 'directdomains.txt')
 direct_cache = LRUCache(GC.DNS_CACHE_ENTRIES//2)
@@ -98,8 +108,8 @@ direct_tlds = (
     'test',
     )
 
-class IPv4Database:
-    #载入 IPv4 保留地址和 CN 地址数据库，数据来源：
+class IPDatabase:
+    #载入 IPv4/IPv6 保留地址和 CN 地址数据库，数据来源：
     #    https://ftp.apnic.net/apnic/stats/apnic/delegated-apnic-latest
     #    https://github.com/17mon/china_ip_list/raw/master/china_ip_list.txt
     #    https://github.com/gaoyifan/china-operator-ip/raw/ip-lists/china.txt
@@ -109,36 +119,74 @@ class IPv4Database:
     #    | 224 * 4 bytes |               <- first ip number index
     #    +---------------+
     #    |  2n * 4 bytes |               <- cn ip ranges data
+    #    +---------------------+
+    #    | b'IPv6' and 4 bytes |         <- IPv6 data length (可选)
+    #    +---------------------+
+    #    | 65537 * 4 bytes |             <- first 16 bits index (可选)
+    #    +-----------------+
+    #    |  2m * 8 bytes |               <- cn ip ranges data (可选)
     #    +------------------------+
     #    | b'end' and update info |      <- end verify
     #    +------------------------+
+    #IPv6 范围只保存地址的前 64 位，路由前缀不会长于 /64
+    #IPv6 索引保存每个前 16 位开始的范围序数，多一个结束序数
+    #批量查询数量达到此值时使用 numpy
+    batch_threshold = 16
+
     def __init__(self, filename):
-        from struct import unpack, iter_unpack
-        with open(filename, 'rb') as f:
+        with open(filename, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
             #读取 IP 范围数据长度 BE Ulong -> int
-            data_len, = unpack('>L', f.read(4))
-            #读取索引数据
-            index = f.read(224 * 4)
-            #读取 IP 范围数据
-            data = f.read(data_len)
+            data_len, = unpack_from('>L', mm)
+            data_offset = 4 + 224 * 4
+            end_offset = data_offset + data_len
+            #格式化并缓存索引数据
+            #每 4 字节为一个索引范围 fip：BE short -> int，对应 IP 范围序数
+            self.index = unpack_from('>%dh' % (224 * 2), mm, 4)
+            #每 8 字节对应一段直连 IP 范围和一段非直连 IP 范围
+            #数据复制到紧凑的数组后即关闭映射，以免占用文件无法更新
+            data = array('I' if array('I').itemsize == 4 else 'L')
+            data.frombytes(mm[data_offset:end_offset])
+            #读取 IPv6 数据，旧格式文件没有此部分
+            if mm[end_offset:end_offset + 4] == b'IPv6':
+                data_len, = unpack_from('>L', mm, end_offset + 4)
+                index_offset = end_offset + 8
+                data_offset = index_offset + 65537 * 4
+                end_offset = data_offset + data_len
+                index6 = array(data.typecode)
+                index6.frombytes(mm[index_offset:data_offset])
+                #每 16 字节对应一段直连 IP 范围和一段非直连 IP 范围
+                data6 = array('Q')
+                data6.frombytes(mm[data_offset:end_offset])
+            else:
+                index6 = data6 = None
             #简单验证结束
-            if f.read(3) != b'end':
+            if len(mm) < end_offset + 3 or mm[end_offset:end_offset + 3] != b'end':
                 raise ValueError('%s 文件格式损坏！' % filename)
             #读取更新信息
-            self.update = f.read().decode('ascii')
-        #格式化并缓存索引数据
-        #每 4 字节为一个索引范围 fip：BE short -> int，对应 IP 范围序数
-        #self.index = unpack('>%dh' % (224 * 2), index)
-        self.index = [i for i, in iter_unpack('>h', index)]
-        #每 8 字节对应一段直连 IP 范围和一段非直连 IP 范围
-        #self.data = unpack('4s' * (data_len // 4), data)
-        self.data = [d for d, in iter_unpack('4s', data)]
+            self.update = mm[end_offset + 3:].decode('ascii')
+        if data.itemsize != 4 or data6 and data6.itemsize != 8:
+            raise ValueError('不支持的数组类型：%r' % data.typecode)
+        #数据为大端序
+        if sys.byteorder == 'little':
+            data.byteswap()
+            if data6:
+                index6.byteswap()
+                data6.byteswap()
+        self.data = data
+        self.index6 = index6
+        self.data6 = data6
+        self.ipv6 = data6 is not None
+        if numpy:
+            #共享数组内存
+            self.np_data = numpy.frombuffer(data, numpy.uint32)
+            index = numpy.array(self.index, numpy.int64)
+            self.np_lo = index[0::2]
+            self.np_hi = index[1::2]
 
-    def __contains__(self, ip, inet_aton=socket.inet_aton):
-        #转换 IP 为 BE Uint32，实际类型 bytes
-        nip = inet_aton(ip)
+    def _contains(self, nip):
         #确定索引范围
-        fip = nip[0]
+        fip = nip >> 24
         #从 224 开始都属于保留地址
         if fip >= 224:
             return True
@@ -146,17 +194,59 @@ class IPv4Database:
         lo = self.index[fip]
         if lo < 0:
             return False
-        hi = self.index[fip + 1]
         #与 IP 范围比较确定 IP 位置
-        data = self.data
-        while lo < hi:
-            mid = (lo + hi) // 2
-            if data[mid] > nip:
-                hi = mid
-            else:
-                lo = mid + 1
         #根据位置序数奇偶确定是否属于直连 IP
-        return lo & 1
+        return bisect_right(self.data, nip, lo, self.index[fip + 1]) & 1 == 1
+
+    def _contains6(self, ip, inet_pton=socket.inet_pton):
+        nip = inet_pton(socket.AF_INET6, ip)
+        # IPv4 映射地址
+        if nip[:12] == b'\0' * 10 + b'\xff\xff':
+            return self._contains(unpack('>I', nip[12:])[0])
+        #转换 IP 前 64 位为 BE Uint64 -> int
+        nip, = unpack('>Q', nip[:8])
+        fip = nip >> 48
+        #组播地址属于保留地址
+        if fip >= 0xff00:
+            return True
+        if self.data6 is None:
+            return False
+        index = self.index6
+        return bisect_right(self.data6, nip, index[fip], index[fip + 1]) & 1 == 1
+
+    def __contains__(self, ip, inet_aton=socket.inet_aton):
+        if ':' in ip:
+            return self._contains6(ip)
+        #转换 IP 为 BE Uint32 -> int
+        nip, = unpack('>I', inet_aton(ip))
+        return self._contains(nip)
+
+    def contains_many(self, ips, inet_aton=socket.inet_aton):
+        '''Batch lookup of IPv4/IPv6 addresses, return a list of bool.'''
+        results = [None] * len(ips)
+        pos4 = []
+        nips = []
+        for i, ip in enumerate(ips):
+            if ':' in ip:
+                results[i] = self._contains6(ip)
+            else:
+                pos4.append(i)
+                nips.append(unpack('>I', inet_aton(ip))[0])
+        if numpy is None or len(nips) < self.batch_threshold:
+            found = [self._contains(nip) for nip in nips]
+        else:
+            nips = numpy.array(nips, numpy.uint32)
+            fips = nips >> 24
+            reserved = fips >= 224
+            fips = numpy.minimum(fips, 223)
+            lo = self.np_lo[fips]
+            hi = self.np_hi[fips]
+            #全局搜索后限制在索引范围内，结果与逐个搜索相同
+            pos = numpy.clip(numpy.searchsorted(self.np_data, nips, 'right'), lo, hi)
+            found = (reserved | (lo >= 0) & (pos & 1 == 1)).tolist()
+        for i, direct in zip(pos4, found):
+            results[i] = direct
+        return results
 
 def isdirect(host):
     if islocal(host):
@@ -169,10 +259,11 @@ def isdirect(host):
         pass
     direct = host in direct_domains_temp_tree
     if not direct:
-        for ip in dns_resolve(host):
-            if isipv4(ip) and ip in ipdb:
-                direct = True
-                break
+        ips = [ip for ip in dns_resolve(host) if isipv4(ip) or ipdb.ipv6 and isipv6(ip)]
+        if len(ips) > 1:
+            direct = any(ipdb.contains_many(ips))
+        else:
+            direct = bool(ips) and ips[0] in ipdb
     direct_cache[host] = direct
     return direct
 
@@ -191,9 +282,9 @@ def islocal(host):
 if '4' in GC.LINK_PROFILE:
     from .dns import dns_resolve
 else:
-    from .dns import _dns_resolve, A
+    from .dns import _dns_resolve, A, AAAA
 
-    def dns_resolve(host, qtypes=[A]):
+    def dns_resolve(host, qtypes=[A, AAAA]):
         if isipv6(host):
             ipaddr = IPv6Address(host)
             host = ipaddr.ipv4_mapped or ipaddr.teredo or ipaddr.sixtofour or host
@@ -204,6 +295,7 @@ else:
 direct_domains_temp_tree = DomainsTree('直连/临时规则白名单')
 for domain in GC.LINK_TEMPWHITELIST:
     direct_domains_temp_tree.add(domain)
+direct_domains_temp_tree.freeze()
 
 direct_domains_black_tree = DomainsTree('直连/本地 DNS 黑名单')
 for domain in GC.DNS_LOCAL_BLACKLIST + (
@@ -211,11 +303,12 @@ for domain in GC.DNS_LOCAL_BLACKLIST + (
         'macaudailytimes.com.mo',
         'tdm.com.mo'):
     direct_domains_black_tree.add(domain)
+direct_domains_black_tree.freeze()
 
 def load_ipdb():
     global ipdb, IPDBVer
     if os.path.exists(direct_ipdb):
-        ipdb = IPv4Database(direct_ipdb)
+        ipdb = IPDatabase(direct_ipdb)
         IPDBVer = ipdb.update
     else:
         ipdb = None
@@ -228,7 +321,7 @@ def load_domains():
     global direct_domains_tree, DDTVer
     domains_tree = DomainsTree('直连/白名单')
     if os.path.exists(direct_domains):
-        domains_tree.add_file(direct_domains)
+        domains_tree.add_file(direct_domains, GC.MISC_DOMAINSCACHE)
         DDTVer = '%s, domains count: %d, IPs count: %d' % (
                 domains_tree.update, domains_tree.count_dm, domains_tree.count_ip)
     else:
@@ -242,7 +335,7 @@ def load_domains():
     logging.test('开始添加用户本地域名列表')
     for domain in GC.DNS_LOCAL_WHITELIST:
         domains_tree.add(domain)
-    direct_domains_tree = domains_tree
+    direct_domains_tree = domains_tree.freeze()
 
 def check_modify():
     if os.path.exists(direct_ipdb):
@@ -0,0 +1,105 @@
+# coding:utf-8
+'''运行缓存快照，用于重启后快速恢复 DNS、直连判断和 IP 统计数据'''
+
+import os
+import json
+import zlib
+import logging
+from time import time, mtime
+from .dns import dns, polluted_hosts
+from .path import data_dir
+from .region import direct_cache, local_cache
+from ..GlobalConfig import GC
+from ..HTTPUtil import IPStats, http_nor, http_cfw, http_gws
+
+snapshot_file = os.path.join(data_dir, 'snapshot.dat')
+snapshot_version = 1
+http_utils = {'nor': http_nor, 'cfw': http_cfw, 'gws': http_gws}
+
+def dump_dns():
+    items = []
+    now = mtime()
+    for host, iplist, expire in dns.items():
+        #只保存解析所得的记录，固定列表由配置生成
+        if expire > 0 and hasattr(iplist, 'fresh'):
+            items.append((host, list(iplist), iplist.fresh - now,
+                          iplist.ttl, iplist.hits, expire))
+    return items
+
+def load_dns(items, age):
+    now = mtime()
+    for host, iplist, fresh, ttl, hits, expire in items:
+        if expire <= age:
+            continue
+        iplist = classlist(iplist)
+        iplist.ttl = ttl
+        #恢复原来的新鲜时间，过期的记录会在下次使用时后台更新
+        iplist.fresh = now + fresh - age
+        iplist.hits = hits
+        iplist.refreshing = False
+        dns.set(host, iplist, expire - age)
+
+def dump_bool_cache(cache):
+    return [(host, value) for host, value, _ in cache.items()]
+
+def load_bool_cache(cache, items):
+    for host, value in items:
+        cache[host] = value
+
+def dump_ip_stats():
+    return {name: [(list(addr), stats.dump()) for addr, stats, _ in http_util.ip_stats.items()]
+            for name, http_util in http_utils.items()}
+
+def load_ip_stats(data):
+    for name, items in data.items():
+        http_util = http_utils.get(name)
+        if http_util is None:
+            continue
+        for addr, stats in items:
+            http_util.ip_stats[tuple(addr)] = IPStats.load(stats)
+
+def save_snapshot():
+    if not GC.MISC_SNAPSHOT:
+        return
+    data = {
+        'version': snapshot_version,
+        'time': time(),
+        'dns': dump_dns(),
+        'direct': dump_bool_cache(direct_cache),
+        'local': dump_bool_cache(local_cache),
+        'polluted': list(polluted_hosts),
+        'ipstats': dump_ip_stats()
+    }
+    data = zlib.compress(json.dumps(data, separators=(',', ':')).encode())
+    tmpfile = snapshot_file + '.tmp'
+    try:
+        with open(tmpfile, 'wb') as fp:
+            fp.write(data)
+        os.replace(tmpfile, snapshot_file)
+    except OSError as e:
+        logging.warning('运行缓存快照保存失败：%r', e)
+    else:
+        logging.debug('运行缓存快照已保存：%d 字节', len(data))
+
+def load_snapshot():
+    if not GC.MISC_SNAPSHOT or not os.path.exists(snapshot_file):
+        return
+    try:
+        with open(snapshot_file, 'rb') as fp:
+            data = json.loads(zlib.decompress(fp.read()))
+        if data['version'] != snapshot_version:
+            return
+        age = int(time() - data['time'])
+        if not 0 <= age < GC.MISC_SNAPSHOTMAXAGE:
+            logging.test('运行缓存快照已过期，不再使用。')
+            return
+        load_dns(data['dns'], age)
+        load_bool_cache(direct_cache, data['direct'])
+        load_bool_cache(local_cache, data['local'])
+        polluted_hosts.update(data['polluted'])
+        load_ip_stats(data['ipstats'])
+    except Exception as e:
+        logging.warning('运行缓存快照读取失败：%r', e)
+    else:
+        logging.test('已载入 %d 秒前的运行缓存快照：DNS %d 条，污染域名 %d 个。',
+                     age, len(data['dns']), len(data['polluted']))
@@ -2,7 +2,9 @@
 
 import os
 import re
+import sys
 import socket
+import marshal
 import string
 import weakref
 import threading
@@ -16,6 +18,52 @@ from .net import isipv4, isipv6
 
 _lock_i_lock = make_lock_decorator('lock')
 
+class ExpireWheel:
+    #所有 LRUCache 实例共用的时间轮，每秒检查一个槽位中的到期项目
+    slots = 512
+
+    def __init__(self):
+        self.wheel = [[] for _ in range(self.slots)]
+        self.lock = threading.Lock()
+        self.running = False
+
+    def add(self, cache_ref, key, expire):
+        with self.lock:
+            self.wheel[expire % self.slots].append((expire, cache_ref, key))
+            if not self.running:
+                self.running = True
+                start_new_thread(self._run, ())
+
+    def _run(self):
+        slots = self.slots
+        wheel = self.wheel
+        lock = self.lock
+        last = int(mtime())
+        while True:
+            sleep(1)
+            now = int(mtime())
+            #时钟跳跃超过一圈时全部检查一遍
+            for tick in range(max(last + 1, now - slots + 1), now + 1):
+                index = tick % slots
+                with lock:
+                    items = wheel[index]
+                    wheel[index] = []
+                later = []
+                for item in items:
+                    expire, cache_ref, key = item
+                    if expire > now:
+                        later.append(item)
+                        continue
+                    cache = cache_ref()
+                    if cache is not None:
+                        cache._expire_timer(key, expire)
+                if later:
+                    with lock:
+                        wheel[index].extend(later)
+            last = now
+
+expire_wheel = ExpireWheel()
+
 class LRUCache:
     # Modified from http://pypi.python.org/pypi/lru/
     #最近最少使用缓存，支持过期时间设置
@@ -25,18 +73,16 @@ class LRUCache:
     def __init__(self, max_items, expire=0):
         # expire == 0：最近最少使用过期
         # expire >  0：最近最少使用过期 + 时间过期
-        self.cache = {}
-        self.key_order = collections.deque()
+        #有序字典尾部为最近使用的项目
+        self.cache = collections.OrderedDict()
         self.max_items = int(max_items)
         self.expire = int(expire)
         self.lock = threading.Lock()
-        if self.expire > 0:
-            start_new_thread(self._cleanup, ())
+        self.ref = weakref.ref(self)
 
     @_lock_i_lock
     def __delitem__(self, key):
         del self.cache[key]
-        self.key_order.remove(key)
 
     def __setitem__(self, key, value):
         _ve = self.cache.get(key)
@@ -61,7 +107,7 @@ class LRUCache:
 
     @_lock_i_lock
     def __len__(self):
-        return len(self.key_order)
+        return len(self.cache)
 
     @_lock_i_lock
     def set(self, key, value, expire=None):
@@ -77,26 +123,26 @@ class LRUCache:
             expire = int(expire)
         if expire > 0:
             expire += int(mtime())
+            expire_wheel.add(self.ref, key, expire)
         cache = self.cache
-        key_order = self.key_order
-        max_items = self.max_items
-        if key in cache:
-            key_order.remove(key)
-        key_order.appendleft(key)
         cache[key] = value, expire
-        while len(key_order) > max_items:
-            key = key_order.pop()
-            value, expire = cache[key]
-            if expire < 0:
-                key_order.appendleft(key)
+        cache.move_to_end(key)
+        skip = 0
+        while len(cache) > self.max_items:
+            key = next(iter(cache))
+            if cache[key][1] < 0:
+                #跳过永不过期项目，全部都是永不过期项目时终止
+                skip += 1
+                if skip > len(cache):
+                    break
+                cache.move_to_end(key)
             else:
                 del cache[key]
 
     @_lock_i_lock
     def get(self, key, value=None):
         if key in self.cache and not self._expire_check(key):
-            self.key_order.remove(key)
-            self.key_order.appendleft(key)
+            self.cache.move_to_end(key)
             value = self.cache[key][0]
         return value
 
@@ -122,7 +168,7 @@ class LRUCache:
             if n > timeout:
                 return None
             sleep(timeout_interval)
-            value = self.cache[key][0]
+            value = self.get(key)
         return value
 
     @_lock_i_lock
@@ -134,31 +180,22 @@ class LRUCache:
         except KeyError:
             if value is self.__marker:
                 raise
-        else:
-            self.key_order.remove(key)
         return value
 
     @_lock_i_lock
     def popitem(self, last=True):
-        if last:
-            index = -1
-            pop = self.key_order.pop
+        # last 为 True 时弹出最近最少使用的项目
+        cache = self.cache
+        while cache:
+            key = next(iter(cache)) if last else next(reversed(cache))
+            if not self._expire_check(key):
+                break
         else:
-            index = 0
-            pop = self.key_order.popleft
-        try:
-            while True:
-                if not self._expire_check(index=index):
-                    break
-            key = pop()
-        except IndexError:
             raise IndexError('popitem from empty LRUCache')
-        value = self.cache.pop(key)[0]
+        value = cache.pop(key)[0]
         return key, value
 
-    def _expire_check(self, key=__marker, index=None):
-        if key is self.__marker and isinstance(index, int):
-            key = self.key_order[index]
+    def _expire_check(self, key):
         cache = self.cache
         if key in cache:
             value, expire = cache[key]
@@ -167,63 +204,50 @@ class LRUCache:
                 timeleft = expire - now
                 if timeleft <= 0:
                     del cache[key]
-                    if isinstance(index, int):
-                        del self.key_order[index]
-                    else:
-                        self.key_order.remove(key)
                     return True
                 elif timeleft < 8:
                     #为可能存在的紧接的调用保持足够的反应时间
-                    cache[key] = value, now + 8
+                    expire = now + 8
+                    cache[key] = value, expire
+                    expire_wheel.add(self.ref, key, expire)
 
-    def _cleanup(self):
-        #按每秒一次的频率循环检查并清除靠后的 l/m 个项目中的过期项目
-        m = 4
-        n = 1
-        lock = self.lock
-        key_order = self.key_order
-        cache = self.cache
-        clean_items = self.max_items // m
-        while True:
-            sleep(1)
-            with lock:
-                l = len(key_order)
-                if l < clean_items:
-                    n = 1
+    @_lock_i_lock
+    def _expire_timer(self, key, expire):
+        #由时间轮调用，项目被更新过时跳过
+        _ve = self.cache.get(key)
+        if _ve is not None and _ve[1] == expire:
+            del self.cache[key]
+
+    @_lock_i_lock
+    def items(self):
+        #返回 (键, 值, 剩余时间) 列表，最近使用的在后，剩余时间 0 为不按时间过期，负数为永不过期
+        now = int(mtime())
+        items = []
+        for key, (value, expire) in self.cache.items():
+            if value is self.__marker2:
+                continue
+            if expire > 0:
+                if expire <= now:
                     continue
-                l = l // m
-                if n > l:
-                    n = 1
-                now = int(mtime())
-                while True:
-                    try:
-                        key = key_order[-n]
-                    except IndexError:
-                        break
-                    expire = self.cache[key][1]
-                    if expire < 0:
-                        del key_order[-n]
-                        key_order.appendleft(key)
-                        #终止全部都是永不过期项目的极端情况
-                        break
-                    elif 0 < expire <= now:
-                        del key_order[-n]
-                        del cache[key]
-                    else:
-                        n += 1
-                        break
+                expire -= now
+            items.append((key, value, expire))
+        return items
 
     @_lock_i_lock
     def clear(self):
         self.cache.clear()
-        self.key_order.clear()
 
 class DomainsTree:
     leaf = object()
     check_domain = re.compile(r'^[a-zA-z0-9\-\.]+$').match
+    cache_version = 1
 
     def __init__(self, logger):
         self.root = {}
+        #冻结后使用的域名集合，以后缀逐级查找
+        self.domains = None
+        #冻结后添加的域名，再次调用 freeze 时统一移除被其覆盖的子域名
+        self.frozen_added = []
         self.ips = set()
         self.update = 'N/A'
         self.count_dm = 0
@@ -252,10 +276,13 @@ class DomainsTree:
         if domain[0] == '.':
             domain = domain[1:]
         domain = domain.lower()
+        if self.domains is not None:
+            return self._add_frozen(domain)
         names = domain.split('.')
         node = self.root
         while names:
-            name = names.pop()
+            #相同标签共用一个字符串
+            name = sys.intern(names.pop())
             try:
                 child = node[name]
             except KeyError:
@@ -277,6 +304,59 @@ class DomainsTree:
             node = child
         self.count_dm += 1
 
+    def _add_frozen(self, domain):
+        #冻结后仍可少量添加，用于在载入列表文件后添加内置域名
+        domains = self.domains
+        i = len(domain)
+        while i > 0:
+            i = domain.rfind('.', 0, i)
+            lname = domain[i + 1:]
+            if lname in domains:
+                self.logger.test('发现重复域名：%s < %s', domain, lname)
+                return
+        domains.add(domain)
+        self.frozen_added.append(domain)
+        self.count_dm += 1
+
+    def _prune_frozen(self):
+        #遍历一次域名集合，移除被冻结后添加的域名覆盖的子域名
+        added = set(self.frozen_added)
+        self.frozen_added = []
+        covered = []
+        for name in self.domains:
+            i = name.find('.')
+            while i > 0:
+                lname = name[i + 1:]
+                if lname in added:
+                    self.logger.test('发现重复域名：%s > *.%s', name, lname)
+                    self.logger.debug('移除域名：%s', name)
+                    covered.append(name)
+                    break
+                i = name.find('.', i + 1)
+        self.domains.difference_update(covered)
+        self.count_dm -= len(covered)
+
+    def freeze(self):
+        '''Convert the tree into a set of domains, it costs less memory and
+        lookups still run over the labels of host.'''
+        if self.domains is not None:
+            if self.frozen_added:
+                self._prune_frozen()
+            return self
+        domains = set()
+        stack = [(self.root, None)]
+        while stack:
+            node, pname = stack.pop()
+            for k, v in node.items():
+                lname = k if pname is None else '%s.%s' % (k, pname)
+                if v is self.leaf:
+                    domains.add(lname)
+                else:
+                    stack.append((v, lname))
+        self.domains = domains
+        self.root = None
+        return self
+
     def add_ip(self, ip):
         if isipv6(ip):
             ip = socket.inet_pton(socket.AF_INET6, ip)
@@ -285,7 +365,42 @@ class DomainsTree:
         self.ips.add(ip)
         return True
 
-    def add_file(self, file):
+    def _load_cache(self, file, stat):
+        try:
+            with open(file + '.cache', 'rb') as fd:
+                version, mtime, size, update, domains, ips = marshal.load(fd)
+        except (OSError, EOFError, ValueError, TypeError):
+            return
+        if version != self.cache_version or \
+                mtime != stat.st_mtime_ns or size != stat.st_size:
+            return
+        self.update = update
+        self.domains = set(domains)
+        self.count_dm = len(domains)
+        self.ips.update(ips)
+        self.root = None
+        return True
+
+    def _dump_cache(self, file, stat):
+        data = (self.cache_version, stat.st_mtime_ns, stat.st_size,
+                self.update, tuple(self.domains), tuple(self.ips))
+        cache_file = file + '.cache'
+        try:
+            #先写入临时文件再替换，避免读到写了一半的缓存
+            with open(cache_file + '.tmp', 'wb') as fd:
+                marshal.dump(data, fd)
+            os.replace(cache_file + '.tmp', cache_file)
+        except OSError as e:
+            self.logger.debug('保存域名列表缓存 %r 失败：%r', file, e)
+
+    def add_file(self, file, cache=False):
+        #使用缓存时直接载入上次冻结的结果，列表文件修改后会重新生成
+        if cache:
+            stat = os.stat(file)
+            if self.root == {} and not self.ips and self._load_cache(file, stat):
+                return
+            cache = self.root == {} and not self.ips
+
         def add_line(line):
             domain = line.split()
             if domain:
@@ -303,12 +418,25 @@ class DomainsTree:
                 add_line(line)
             if has_update and line[:4] != '#end':
                 self.logger.warning('域名列表文件 %r 不完整，请更新', file)
+        if cache:
+            self.freeze()
+            self._dump_cache(file, stat)
 
     def __contains__(self, host):
         if isipv6(host):
             host = socket.inet_pton(socket.AF_INET6, host)
         elif not isipv4(host):
-            names = host.lower().split('.')
+            host = host.lower()
+            domains = self.domains
+            if domains is not None:
+                #从顶级域名开始逐级检查后缀
+                i = len(host)
+                while i > 0:
+                    i = host.rfind('.', 0, i)
+                    if host[i + 1:] in domains:
+                        return True
+                return False
+            names = host.split('.')
             node = self.root
             while names:
                 name = names.pop()
@@ -15,6 +15,8 @@ SSL.TLSv1_3_METHOD = SSL.TLSv1_2_METHOD + 1
 res_ciphers = f'{ssl._RESTRICTED_SERVER_CIPHERS}:!SSLv3'.encode()
 # py3.10+ 兼容一些旧的应用和系统
 def_ciphers = res_ciphers.replace(b':!SHA1:', b':')
+#使用 ECDSA 证书时优先选择 ECDSA 加密套件
+def_ecc_ciphers = b'ECDHE-ECDSA+AESGCM:ECDHE-ECDSA+CHACHA20:' + def_ciphers
 
 zero_errno = errno.ECONNABORTED, errno.ECONNRESET, errno.ENOTSOCK
 zero_EOF_error = -1, 'Unexpected EOF'
@@ -151,6 +153,9 @@ class SSLConnection:
 
     def close(self):
         if hasattr(self._sock, 'close'):
+            #未发送 close_notify 的连接释放时其会话会被标记为不可恢复，
+            #这里按已关闭处理，以便会话缓存中的会话继续使用
+            self._connection.set_shutdown(SSL.SENT_SHUTDOWN)
             self._sock.close()
             self._sock = None
 
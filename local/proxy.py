@@ -90,6 +90,9 @@ from .common.dns import _dns_resolve as dns_resolve, dns_system_servers, dns_rem
 from .common.net import isip, isipv4, isipv6
 from .common.path import icon_gotox
 from .common.region import IPDBVer, DDTVer
+from .common.snapshot import load_snapshot, save_snapshot
+from .common.util import spawn_loop
+from .HTTPCache import http_cache
 from .ProxyServer import network_test, start_proxyserver
 from . import GIPManager
 
@@ -318,7 +321,12 @@ GC.LISTEN_ACT == 'CFW' and f"""
     del pre_start, info
 
     check_ca()
+    load_snapshot()
     start_proxyserver()
+    if GC.MISC_SNAPSHOT:
+        spawn_loop(GC.MISC_SNAPSHOTINTERVAL, save_snapshot)
+    if http_cache:
+        spawn_loop(600, http_cache.report)
 
     if GC.GAE_TESTGWSIPLIST:
         GIPManager.start_ip_check()